@@ -8,11 +8,37 @@ Lark OAuth認証サーバー + トークン管理API
 
 import os
 import json
+import math
+import time
 import secrets
 import requests
-import threading
 from datetime import datetime
-from flask import Flask, redirect, request, jsonify, render_template_string
+from functools import lru_cache
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, g, has_request_context, redirect, request, jsonify, stream_with_context
+
+from singleflight import SingleFlight, SingleFlightTimeout
+from token_backend import StoreDict, LockTimeout, create_backend_from_env
+from token_vault import TokenVault, UserToken
+from oauth_state import OAuthStateStore, pkce_pair
+from upstream import UpstreamClient, UpstreamDeadlineExceeded, RequestBodyStream, relay_headers, iter_raw
+from response_cache import ResponseCache, is_cacheable, make_etag
+from pagination import Paginator, PageError, parse_page, stream_ndjson, stream_json_array
+from ratelimit import TokenBucketLimiter, RateLimitExceeded
+from batch import BatchValidationError, parse_batch, execute_subrequest
+from broadcast import BroadcastValidationError, build_message, broadcast_id, message_uuid, deliver, summarize
+from lark_events import EventVerificationError, parse_event, event_type, event_id, message_item
+from message_index import MessageIndex, encode_cursor, decode_cursor, split_windows
+from task_mirror import TaskMirror, ORDERS as TASK_ORDERS, parse_time_ms
+from task_bulk import TaskBulkValidationError, IdempotencyStore, bulk_id, parse_operations, build_request, run_operation, summarize_operations
+from directory import DirectoryCache, user_summary, department_summary, chunks
+from doc_cache import DocumentCache, SAFE_ID as SAFE_DOCUMENT_ID, document_body, render_text
+from bitable_mirror import (BitableMirror, BitableQueryError, parse_mirrors, parse_query as parse_bitable_query,
+                            search_body, table_key, table_key_from_path)
+from event_stream import EventLog, format_sse
+from metrics import Metrics, WAIT_BUCKETS
+from refresher import BackgroundRefresher
 
 app = Flask(__name__)
 
@@ -23,30 +49,180 @@ BASE_URL = os.environ.get('BASE_URL', '')
 API_KEY = os.environ.get('API_KEY', 'kakushin-manus-lark-2026')  # API認証用キー
 
 # OAuth URLs
+# LARK_API_BASE を変えると、トークン取得を含む全てのAPI呼び出しの接続先が変わる（ローカルのスタブでの計測用）
 AUTH_URL = "https://accounts.larksuite.com/open-apis/authen/v1/authorize"
-TOKEN_URL = "https://open.larksuite.com/open-apis/authen/v2/oauth/token"
-LARK_API_BASE = "https://open.larksuite.com/open-apis"
+LARK_API_BASE = os.environ.get('LARK_API_BASE', 'https://open.larksuite.com/open-apis').rstrip('/')
+TOKEN_URL = f"{LARK_API_BASE}/authen/v2/oauth/token"
 
 # スコープ（全機能対応）
 SCOPES = "auth:user.id:read offline_access task:task:read task:task:write task:tasklist:read task:tasklist:write im:message im:message.group_msg im:message.group_at_msg:readonly im:chat im:chat:readonly docx:document docx:document:readonly bitable:app bitable:app:readonly drive:drive drive:drive:readonly drive:file drive:file:readonly wiki:wiki wiki:wiki:readonly wiki:space:read wiki:space:retrieve wiki:node:read wiki:node:retrieve contact:contact.base:readonly contact:user.base:readonly contact:department.base:readonly contact:user.employee_id:readonly"
 
-# トークンストア（本番環境ではRedis等を推奨）
-# スレッドセーフにするためのロック
-token_lock = threading.Lock()
-token_store = {
-    'refresh_token': os.environ.get('INITIAL_REFRESH_TOKEN', ''),
-    'access_token': '',
-    'access_token_expires_at': 0,
-    'updated_at': ''
-}
+# トークン更新設定
+TOKEN_REFRESH_MARGIN = 300  # 有効期限の何秒前から更新対象とするか
+TOKEN_REFRESH_WAIT_TIMEOUT = float(os.environ.get('TOKEN_REFRESH_WAIT_TIMEOUT', '15'))  # 他リクエストの更新完了を待つ上限（秒）
+
+# イベント購読（Webhook）の検証用（Larkの開発者コンソールの「イベントとコールバック」で確認）
+LARK_VERIFICATION_TOKEN = os.environ.get('LARK_VERIFICATION_TOKEN', '')
+LARK_ENCRYPT_KEY = os.environ.get('LARK_ENCRYPT_KEY', '')
+
+# メトリクス（/metrics）
+# 各ワーカーの値を METRICS_DIR に書き出し、/metrics で全ワーカー分を合算する
+metrics = Metrics(
+    os.environ.get('METRICS_DIR', 'data/metrics'),
+    flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', '5')),
+    enabled=os.environ.get('METRICS', '1') != '0'
+)
+# 0 にするとAPIキーなしで /metrics を読める（スクレイパーがネットワーク内に限られる場合など）
+METRICS_REQUIRE_AUTH = os.environ.get('METRICS_REQUIRE_AUTH', '1') != '0'
+metrics.histogram('lark_oauth_http_request_duration_seconds', 'Time to handle a request (until the response headers for streams).')
+metrics.counter('lark_oauth_http_requests_total', 'Requests handled, by route and status.')
+metrics.gauge('lark_oauth_http_requests_in_flight', 'Requests currently being handled.')
+metrics.histogram('lark_oauth_upstream_request_duration_seconds', 'Time of a single Lark API call, by API family.')
+metrics.counter('lark_oauth_upstream_requests_total', 'Lark API calls, by API family and status.')
+metrics.histogram('lark_oauth_token_refresh_duration_seconds', 'Time of a token refresh call to Lark, by token kind.')
+metrics.counter('lark_oauth_token_refresh_total', 'Token refresh attempts, by token kind and result.')
+metrics.histogram('lark_oauth_token_lock_wait_seconds', 'Time spent waiting to acquire token_lock.', buckets=WAIT_BUCKETS)
+
+# トークンストア
+# TOKEN_STORE_BACKEND（memory / sqlite / redis）で保存先を切り替える
+# sqlite / redis は複数gunicornワーカーで共有され、再起動後も残る
+store_backend = create_backend_from_env()
+
+# スレッドセーフにするためのロック（メモリ上の読み取り・差し替えのみに使用し、通信中は保持しない）
+token_lock = metrics.timed_lock('lark_oauth_token_lock_wait_seconds')
+# トークン種別（userはユーザーごと）に実行中の更新を1つにまとめる（プロセス内）
+# プロセス間は store_backend のロックで1回にまとめる
+refresh_flight = SingleFlight()
+
+# ユーザーごとのトークン保管庫（open_id で管理し、ユーザーごとのAPIキーで引く）
+# 共通の API_KEY は既定ユーザー（最初に認証したユーザー）として動作し、ユーザー管理APIも使える
+token_vault = TokenVault(store_backend, lock=token_lock)
+
+# 従来の1ユーザー分のトークン（user_token）と初期Refresh Tokenは、既定ユーザーがいない場合のみ投入
+# （更新済みのトークンを上書きしない）。open_id は INITIAL_OPEN_ID（Larkで認証し直すと実際の open_id で別に保存される）
+INITIAL_OPEN_ID = os.environ.get('INITIAL_OPEN_ID', 'default')
+with token_vault.lock(INITIAL_OPEN_ID):
+    if not token_vault.default_open_id:
+        legacy_store = StoreDict(store_backend, 'user_token')
+        initial_refresh_token = legacy_store.get('refresh_token') or os.environ.get('INITIAL_REFRESH_TOKEN')
+        if initial_refresh_token:
+            token_vault.save(UserToken(
+                INITIAL_OPEN_ID,
+                access_token=legacy_store.get('access_token', ''),
+                refresh_token=initial_refresh_token,
+                expires_at=legacy_store.get('access_token_expires_at', 0)
+            ))
+            token_vault.default_open_id = INITIAL_OPEN_ID
 
 # Tenant Access Token用ストア
-tenant_token_store = {
+tenant_token_store = StoreDict(store_backend, 'tenant_token', defaults={
     'access_token': '',
     'expires_at': 0
-}
+})
+
+# ログイン開始ごとの state（とPKCEの code_verifier）。有効期限つき・1回限りで、全ワーカーで共有
+oauth_states = OAuthStateStore(
+    store_backend,
+    ttl=float(os.environ.get('OAUTH_STATE_TTL', '600')),
+    max_pending=int(os.environ.get('OAUTH_STATE_MAX_PENDING', '10000'))
+)
+OAUTH_PKCE_ENABLED = os.environ.get('OAUTH_PKCE', '1') != '0'
+
+# Lark API呼び出し用の共通クライアント（ワーカーごとにkeep-aliveのコネクションプールを共有）
+# UPSTREAM_POOL_SIZE / UPSTREAM_CONNECT_TIMEOUT / UPSTREAM_READ_TIMEOUT / UPSTREAM_DEADLINE で調整
+# APIの種類 × user/tenant ごとのレート制限（状態は store_backend で全ワーカー共有）
+lark_http = UpstreamClient.from_env(rate_limiter=TokenBucketLimiter(
+    StoreDict(store_backend, 'ratelimit'),
+    default_rate=float(os.environ.get('RATE_LIMIT_DEFAULT_RPS', '20')),
+    max_wait=float(os.environ.get('RATE_LIMIT_MAX_WAIT', '10'))
+), metrics=metrics)
+
+# 同じ内容の読み取り系GETが同時に来た場合、上流への呼び出しを1回にまとめる
+get_flight = SingleFlight()
+
+# 読み取り系Lark APIのレスポンスキャッシュ（ルートごとのTTL、バイト数上限のLRU）
+# 書き込み時の無効化は store_backend 経由で他のワーカーにも反映される
+response_cache = ResponseCache(
+    StoreDict(store_backend, 'cache_generation'),
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    max_entry_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(2 * 1024 * 1024))),
+    enabled=os.environ.get('RESPONSE_CACHE', '1') != '0'
+)
+
+# チャットメッセージのインデックス（上流から取り込んだ分とWebhookで受信した分を保持）
+# /api/messages/<chat_id> は同期済みのチャットをインデックスから返し、上流を呼ばない
+# イベント購読が設定されていれば新着は自動で届くため、上流との再同期は MESSAGE_INDEX_MAX_AGE ごとで足りる
+MESSAGE_EVENTS_ENABLED = bool(LARK_VERIFICATION_TOKEN or LARK_ENCRYPT_KEY)
+MESSAGE_INDEX_ENABLED = os.environ.get('MESSAGE_INDEX', '1') != '0'
+message_index = MessageIndex(
+    os.environ.get('MESSAGE_INDEX_PATH', 'data/messages.db'),
+    max_age=float(os.environ.get('MESSAGE_INDEX_MAX_AGE', '3600' if MESSAGE_EVENTS_ENABLED else '10'))
+) if MESSAGE_INDEX_ENABLED else None
+# 同じチャットの同期が同時に走らないようにまとめる
+message_sync_flight = SingleFlight()
+
+# /api/stream で配信する新着メッセージ・タスク変更のイベントログ（全ワーカーで共有）
+event_log = EventLog(
+    os.environ.get('EVENT_LOG_PATH', 'data/events.db'),
+    retention=float(os.environ.get('EVENT_LOG_RETENTION', '86400'))
+)
+# 1回の同期でたどる新着ページ数の上限（残りは次回の同期で続きから取得）
+MESSAGE_SYNC_MAX_PAGES = int(os.environ.get('MESSAGE_SYNC_MAX_PAGES', '10'))
+
+# タスクのミラー（ユーザーごとに task/v2/tasks を取り込み、/api/tasks の絞り込みをローカルで返す）
+# Webhookでタスクの変更通知を受けるとバックグラウンドで取り直すため、通知があれば TASK_MIRROR_MAX_AGE は長くてよい
+TASK_MIRROR_ENABLED = os.environ.get('TASK_MIRROR', '1') != '0'
+task_mirror = TaskMirror(
+    os.environ.get('TASK_MIRROR_PATH', 'data/tasks.db'),
+    max_age=float(os.environ.get('TASK_MIRROR_MAX_AGE', '3600' if MESSAGE_EVENTS_ENABLED else '300'))
+) if TASK_MIRROR_ENABLED else None
+# 同じユーザーの同期が同時に走らないようにまとめる
+task_sync_flight = SingleFlight()
+# 1回の同期でたどるページ数の上限（上限に達した同期では削除の判定をしない）
+TASK_SYNC_MAX_PAGES = int(os.environ.get('TASK_SYNC_MAX_PAGES', '100'))
+# 同期中の他のリクエストが完了を待つ上限（秒）
+TASK_SYNC_WAIT_TIMEOUT = float(os.environ.get('TASK_SYNC_WAIT_TIMEOUT', '60'))
 
-state_store = {}
+# ユーザー・部署のディレクトリキャッシュ（?expand=users でメッセージ・タスクに名前と部署を付ける。ワーカーごと）
+directory = DirectoryCache(
+    max_entries=int(os.environ.get('DIRECTORY_CACHE_MAX_ENTRIES', '10000')),
+    ttl=float(os.environ.get('DIRECTORY_CACHE_TTL', '3600')),
+    negative_ttl=float(os.environ.get('DIRECTORY_NEGATIVE_TTL', '300'))
+)
+# 有効期限が近づいた項目をバックグラウンドで取り直すスレッド数
+directory_refresh_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DIRECTORY_REFRESH_WORKERS', '2')),
+    thread_name_prefix='directory-refresh'
+)
+
+# ドキュメントの内容キャッシュ（document_id × revision_id ごとにブロックとテキストをファイルに保存。全ワーカーで共有）
+document_cache = DocumentCache(
+    os.environ.get('DOC_CACHE_DIR', 'data/docs'),
+    max_bytes=int(os.environ.get('DOC_CACHE_MAX_BYTES', str(512 * 1024 * 1024))),
+    mmap_threshold=int(os.environ.get('DOC_CACHE_MMAP_THRESHOLD', str(1024 * 1024)))
+)
+# 同じ revision のブロック取得が同時に走らないようにまとめる
+document_flight = SingleFlight()
+# 1ドキュメントでたどるブロックのページ数（500件/ページ）の上限と、取得中の他のリクエストが完了を待つ上限（秒）
+DOC_BLOCKS_MAX_PAGES = int(os.environ.get('DOC_BLOCKS_MAX_PAGES', '200'))
+DOC_FETCH_WAIT_TIMEOUT = float(os.environ.get('DOC_FETCH_WAIT_TIMEOUT', '120'))
+
+# Bitable（Base）のミラー（BITABLE_MIRRORS に設定したテーブルを取り込み、問い合わせ・集計をローカルで返す）
+# Webhookでレコードの変更通知を受けると該当テーブルだけを取り直すため、通知があれば BITABLE_MIRROR_MAX_AGE は長くてよい
+BITABLE_MIRROR_TABLES = parse_mirrors(os.environ.get('BITABLE_MIRRORS', ''))
+bitable_mirror = BitableMirror(
+    os.environ.get('BITABLE_MIRROR_PATH', 'data/bitable.db'),
+    BITABLE_MIRROR_TABLES,
+    max_age=float(os.environ.get('BITABLE_MIRROR_MAX_AGE', '3600' if MESSAGE_EVENTS_ENABLED else '300')),
+    full_sync_interval=float(os.environ.get('BITABLE_FULL_SYNC_INTERVAL', '21600'))
+) if BITABLE_MIRROR_TABLES else None
+# 同期に使うトークン（'user': 既定ユーザー / 'tenant': アプリ。アプリをBaseの共同編集者に追加しておく）
+BITABLE_MIRROR_CREDENTIAL = os.environ.get('BITABLE_MIRROR_CREDENTIAL', 'user')
+# 同じテーブルの同期が同時に走らないようにまとめる
+bitable_sync_flight = SingleFlight()
+# 1回の同期でたどるページ数（500件/ページ）の上限と、同期中の他のリクエストが完了を待つ上限（秒）
+BITABLE_SYNC_MAX_PAGES = int(os.environ.get('BITABLE_SYNC_MAX_PAGES', '2000'))
+BITABLE_SYNC_WAIT_TIMEOUT = float(os.environ.get('BITABLE_SYNC_WAIT_TIMEOUT', '300'))
 
 # ========================================
 # HTMLテンプレート
@@ -149,7 +325,7 @@ INDEX_HTML = """
             • オフラインアクセス
         </div>
         
-        <a href="{{ auth_url }}" class="button">Larkでログイン{% if has_token %}（再認証）{% endif %}</a>
+        <a href="/login" class="button">Larkでログイン{% if has_token %}（再認証）{% endif %}</a>
         
         <p class="footer">認証後、トークンはサーバーに自動保存されます。<br>Manusは自動的にアクセス可能になります。</p>
     </div>
@@ -213,6 +389,15 @@ SUCCESS_HTML = """
             手動でトークンをコピーする必要はありません。
         </div>
         
+        {% if api_key %}
+        <div class="info-box">
+            <strong>🔑 {{ user_name }} さん用のAPIキー：</strong><br>
+            <code style="word-break: break-all;">{{ api_key }}</code><br>
+            このキーで呼び出すと、{{ user_name }} さんのトークンでLarkにアクセスします。<br>
+            この画面でのみ表示されます（再発行は管理者に依頼してください）。
+        </div>
+        {% endif %}
+        
         <div class="info-box">
             <strong>📋 次のステップ：</strong><br>
             Manusに「Larkのタスクを取得して」などと指示するだけで、<br>
@@ -275,6 +460,19 @@ ERROR_HTML = """
 </html>
 """
 
+# テンプレートは起動時に1回だけコンパイルする（リクエストごとに文字列から作り直さない）
+INDEX_TEMPLATE = app.jinja_env.from_string(INDEX_HTML)
+SUCCESS_TEMPLATE = app.jinja_env.from_string(SUCCESS_HTML)
+ERROR_TEMPLATE = app.jinja_env.from_string(ERROR_HTML)
+
+# トップページは認証状態の表示だけなので、共有キャッシュにも短時間置いてよい
+INDEX_MAX_AGE = int(os.environ.get('INDEX_MAX_AGE', '10'))
+
+# 認可URLのうちリクエストごとに変わらない部分（client_id・scope など）は起動時に組み立てておく
+AUTH_URL_PREFIX = f"{AUTH_URL}?" + "&".join(
+    f"{k}={quote(v)}" for k, v in (('client_id', APP_ID), ('response_type', 'code'), ('scope', SCOPES))
+)
+
 # ========================================
 # ヘルパー関数
 # ========================================
@@ -285,69 +483,171 @@ def get_redirect_uri():
         return f"{BASE_URL}/callback"
     return request.url_root.rstrip('/') + '/callback'
 
-def refresh_access_token():
-    """Refresh Tokenを使ってAccess Tokenを更新"""
-    global token_store
+@lru_cache(maxsize=16)
+def _quoted(value):
+    return quote(value)
+
+def build_auth_url(state, code_challenge=''):
+    """Larkの認可URL（固定部分は AUTH_URL_PREFIX、リダイレクトURIのエンコード結果はキャッシュ）"""
+    auth_url = f"{AUTH_URL_PREFIX}&redirect_uri={_quoted(get_redirect_uri())}&state={state}"
+    if code_challenge:
+        auth_url += f"&code_challenge={code_challenge}&code_challenge_method=S256"
+    return auth_url
+
+def render_page(template, cache_control='no-store', **context):
+    """コンパイル済みテンプレートでHTMLを返す（トークン・APIキーを含む画面は保存させない）"""
+    response = Response(template.render(**context), mimetype='text/html')
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def error_page(error_message):
+    return render_page(ERROR_TEMPLATE, error_message=error_message)
+
+@lru_cache(maxsize=8)
+def _index_page(has_token, updated_at):
+    """トップページの本文とETag（表示内容が変わった時だけ描画し直す）"""
+    body = INDEX_TEMPLATE.render(has_token=has_token, updated_at=updated_at).encode()
+    return body, make_etag(body)
+
+def _tenant_token_is_fresh(min_ttl=TOKEN_REFRESH_MARGIN):
+    """token_lock保持中に呼ぶこと。Tenant Access Tokenが残りmin_ttl秒以上有効か（既定は5分のマージン）"""
+    return bool(tenant_token_store.get('access_token')) and \
+        tenant_token_store.get('expires_at', 0) > datetime.now().timestamp() + min_ttl
+
+def _run_refresh(kind, fn, key=None):
+    """トークン更新を single-flight で実行（同時更新は1回にまとめる。key 省略時は kind 単位）"""
+    try:
+        return refresh_flight.do(key or kind, fn, timeout=TOKEN_REFRESH_WAIT_TIMEOUT)
+    except SingleFlightTimeout:
+        metrics.inc('lark_oauth_token_refresh_total', kind=kind, result='wait_timeout')
+        return None, f"トークン更新待機がタイムアウトしました（{TOKEN_REFRESH_WAIT_TIMEOUT}秒）"
+
+def _observe_refresh(kind, started, error):
+    """Larkへの更新呼び出し1回分の所要時間と結果を記録"""
+    metrics.observe('lark_oauth_token_refresh_duration_seconds', time.perf_counter() - started, kind=kind)
+    metrics.inc('lark_oauth_token_refresh_total', kind=kind, result='failure' if error else 'success')
+
+def current_user_id():
+    """リクエストのAPIキーに対応するユーザー（リクエスト外・共通キーでは既定ユーザー）"""
+    if has_request_context() and g.get('user_id'):
+        return g.user_id
+    return token_vault.default_open_id
+
+def _do_refresh_access_token(open_id, min_ttl=None):
+    """
+    Refresh Tokenを使ってAccess Tokenを更新（single-flightのリーダーが実行）
+    Refresh Tokenは更新のたびに差し替わるため、プロセス間ロックを取ってから読み直す
+    min_ttl: 指定時、現在のトークンが残りmin_ttl秒以上有効なら更新せず再利用
+    """
+    try:
+        with token_vault.lock(open_id, timeout=TOKEN_REFRESH_WAIT_TIMEOUT):
+            return _refresh_access_token_locked(open_id, min_ttl)
+    except LockTimeout:
+        metrics.inc('lark_oauth_token_refresh_total', kind='user', result='lock_timeout')
+        return None, "他のワーカーのトークン更新待機がタイムアウトしました"
+
+def _refresh_access_token_locked(open_id, min_ttl):
+    """プロセス間ロック取得後の更新処理（通信中はどのロックも保持しない）"""
+    # 待機中に他の更新（他ワーカーを含む）が完了していれば再利用
+    token = token_vault.load(open_id)
+    if token is not None and min_ttl is not None and token.is_fresh(min_ttl):
+        metrics.inc('lark_oauth_token_refresh_total', kind='user', result='reused')
+        return token.access_token, None
     
-    with token_lock:
-        refresh_token = token_store.get('refresh_token')
-        if not refresh_token:
-            return None, "Refresh Tokenがありません。認証が必要です。"
-        
-        try:
-            response = requests.post(
-                TOKEN_URL,
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-                data={
-                    "grant_type": "refresh_token",
-                    "refresh_token": refresh_token,
-                    "client_id": APP_ID,
-                    "client_secret": APP_SECRET
-                }
-            )
-            result = response.json()
-            
-            if result.get('code') == 0 or 'access_token' in result:
-                # 新しいトークンを保存
-                token_store['access_token'] = result['access_token']
-                token_store['refresh_token'] = result['refresh_token']
-                token_store['access_token_expires_at'] = datetime.now().timestamp() + result.get('expires_in', 7200)
-                token_store['updated_at'] = datetime.now().isoformat()
-                
-                return result['access_token'], None
-            else:
-                error_msg = result.get('error_description', result.get('msg', str(result)))
-                return None, f"トークン更新失敗: {error_msg}"
-                
-        except Exception as e:
-            return None, f"トークン更新エラー: {str(e)}"
+    if token is None or not token.refresh_token:
+        metrics.inc('lark_oauth_token_refresh_total', kind='user', result='no_refresh_token')
+        return None, "Refresh Tokenがありません。認証が必要です。"
+    
+    started = time.perf_counter()
+    access_token, error = _exchange_refresh_token(token)
+    _observe_refresh('user', started, error)
+    return access_token, error
 
-def get_valid_access_token():
-    """有効なAccess Tokenを取得（必要に応じて更新）"""
-    global token_store
+def _exchange_refresh_token(token):
+    """Refresh TokenをLarkに送り、新しいトークンを保存"""
+    try:
+        response = lark_http.post(
+            TOKEN_URL,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": token.refresh_token,
+                "client_id": APP_ID,
+                "client_secret": APP_SECRET
+            }
+        )
+        result = response.json()
+    except Exception as e:
+        return None, f"トークン更新エラー: {str(e)}"
     
-    with token_lock:
-        # 現在のAccess Tokenが有効か確認（5分のマージン）
-        if token_store.get('access_token') and token_store.get('access_token_expires_at', 0) > datetime.now().timestamp() + 300:
-            return token_store['access_token'], None
+    if result.get('code') == 0 or 'access_token' in result:
+        # 新しいトークンを保存
+        _apply_token_result(token, result)
+        token_vault.save(token)
+        return token.access_token, None
     
-    # 更新が必要
-    return refresh_access_token()
+    error_msg = result.get('error_description', result.get('msg', str(result)))
+    return None, f"トークン更新失敗: {error_msg}"
 
-def get_tenant_access_token():
-    """
-    Tenant Access Tokenを取得（アプリ認証）
-    ボットが参加しているグループのメッセージ取得に必要
-    """
-    global tenant_token_store
+def _apply_token_result(token, result):
+    """OAuthのトークン応答を UserToken に反映"""
+    now = datetime.now().timestamp()
+    token.access_token = result['access_token']
+    token.refresh_token = result.get('refresh_token', token.refresh_token)
+    token.expires_at = now + result.get('expires_in', 7200)
+    if result.get('refresh_token_expires_in'):
+        token.refresh_expires_at = now + result['refresh_token_expires_in']
+
+def refresh_access_token(open_id=None):
+    """Refresh Tokenを使ってAccess Tokenを更新"""
+    open_id = open_id or current_user_id()
+    if not open_id:
+        return None, "認証済みのユーザーがいません。認証が必要です。"
+    return _run_refresh('user', lambda: _do_refresh_access_token(open_id), key=('user', open_id))
+
+def get_valid_access_token(open_id=None):
+    """有効なAccess Tokenを取得（必要に応じて更新）。open_id 省略時はAPIキーのユーザー"""
+    open_id = open_id or current_user_id()
+    if not open_id:
+        return None, "認証済みのユーザーがいません。認証が必要です。"
+    
+    # 現在のAccess Tokenが有効か確認（5分のマージン）
+    token = token_vault.get(open_id, min_ttl=TOKEN_REFRESH_MARGIN)
+    if token is not None and token.is_fresh(TOKEN_REFRESH_MARGIN):
+        return token.access_token, None
     
+    # 更新が必要（同じユーザーで同時に期限切れを検知した呼び出し元は1回の更新を共有）
+    return _run_refresh(
+        'user',
+        lambda: _do_refresh_access_token(open_id, min_ttl=TOKEN_REFRESH_MARGIN),
+        key=('user', open_id)
+    )
+
+def _do_refresh_tenant_token(min_ttl=TOKEN_REFRESH_MARGIN):
+    """Tenant Access Tokenを取得（single-flightのリーダーが実行）"""
+    try:
+        with tenant_token_store.lock('refresh', timeout=TOKEN_REFRESH_WAIT_TIMEOUT):
+            return _refresh_tenant_token_locked(min_ttl)
+    except LockTimeout:
+        metrics.inc('lark_oauth_token_refresh_total', kind='tenant', result='lock_timeout')
+        return None, "他のワーカーのTenant Token取得待機がタイムアウトしました"
+
+def _refresh_tenant_token_locked(min_ttl):
+    """プロセス間ロック取得後のTenant Access Token取得処理"""
     with token_lock:
-        # 現在のトークンが有効か確認（5分のマージン）
-        if tenant_token_store.get('access_token') and tenant_token_store.get('expires_at', 0) > datetime.now().timestamp() + 300:
+        if _tenant_token_is_fresh(min_ttl):
+            metrics.inc('lark_oauth_token_refresh_total', kind='tenant', result='reused')
             return tenant_token_store['access_token'], None
     
+    started = time.perf_counter()
+    access_token, error = _fetch_tenant_token()
+    _observe_refresh('tenant', started, error)
+    return access_token, error
+
+def _fetch_tenant_token():
+    """App ID / App SecretでTenant Access Tokenを取得して保存"""
     try:
-        response = requests.post(
+        response = lark_http.post(
             f"{LARK_API_BASE}/auth/v3/tenant_access_token/internal",
             headers={"Content-Type": "application/json"},
             json={
@@ -356,72 +656,808 @@ def get_tenant_access_token():
             }
         )
         result = response.json()
-        
-        if result.get('code') == 0:
-            with token_lock:
-                tenant_token_store['access_token'] = result['tenant_access_token']
-                tenant_token_store['expires_at'] = datetime.now().timestamp() + result.get('expire', 7200)
-            return result['tenant_access_token'], None
-        else:
-            return None, f"Tenant Token取得失敗: {result.get('msg', str(result))}"
     except Exception as e:
         return None, f"Tenant Token取得エラー: {str(e)}"
+    
+    if result.get('code') == 0:
+        with token_lock:
+            tenant_token_store.update({
+                'access_token': result['tenant_access_token'],
+                'expires_at': datetime.now().timestamp() + result.get('expire', 7200)
+            })
+        return result['tenant_access_token'], None
+    
+    return None, f"Tenant Token取得失敗: {result.get('msg', str(result))}"
+
+def get_tenant_access_token():
+    """
+    Tenant Access Tokenを取得（アプリ認証）
+    ボットが参加しているグループのメッセージ取得に必要
+    """
+    with token_lock:
+        # 現在のトークンが有効か確認（5分のマージン）
+        if _tenant_token_is_fresh():
+            return tenant_token_store['access_token'], None
+    
+    return _run_refresh('tenant', _do_refresh_tenant_token)
+
+# ========================================
+# バックグラウンド更新
+# ========================================
+
+# リクエスト処理側の判定（5分のマージン）より前に更新しておく
+BACKGROUND_REFRESH_LEAD = TOKEN_REFRESH_MARGIN + float(os.environ.get('BACKGROUND_REFRESH_LEAD', '300'))
+
+# ユーザーのトークンを同時に更新する数の上限（ワーカーごと。数千ユーザーでもLarkへの同時呼び出しを抑える）
+USER_REFRESH_CONCURRENCY = int(os.environ.get('USER_REFRESH_CONCURRENCY', '8'))
+user_refresh_executor = ThreadPoolExecutor(max_workers=USER_REFRESH_CONCURRENCY, thread_name_prefix='user-refresh')
+
+def _refresh_due_users(min_ttl):
+    """
+    残り有効期間がmin_ttl秒未満の全ユーザーを USER_REFRESH_CONCURRENCY 並列で更新
+    失敗したユーザーはバックオフして他のユーザーの更新を妨げない（全員失敗した場合のみエラーを返す）
+    """
+    open_ids = token_vault.due(min_ttl)
+    futures = {
+        user_refresh_executor.submit(
+            _run_refresh, 'user', lambda open_id=open_id: _do_refresh_access_token(open_id, min_ttl=min_ttl),
+            ('user', open_id)
+        ): open_id
+        for open_id in open_ids
+    }
+    failed = 0
+    for future in as_completed(futures):
+        _, error = future.result()
+        if error:
+            failed += 1
+            token_vault.record_failure(futures[future])
+    if open_ids and failed == len(open_ids):
+        return None, f"{failed}人のトークン更新に失敗しました"
+    return len(open_ids) - failed, None
+
+def _tenant_token_expires_at():
+    return tenant_token_store.get('expires_at', 0)
+
+# タスクのミラーを同時に同期するユーザー数の上限（ワーカーごと）
+TASK_SYNC_CONCURRENCY = int(os.environ.get('TASK_SYNC_CONCURRENCY', '2'))
+# 同期から TASK_MIRROR_MAX_AGE 秒たつ何秒前にバックグラウンドで取り直すか
+TASK_MIRROR_LEAD = float(os.environ.get('TASK_MIRROR_LEAD', '60'))
+task_sync_executor = ThreadPoolExecutor(max_workers=TASK_SYNC_CONCURRENCY, thread_name_prefix='task-sync')
+
+def _background_sync_tasks(open_id, min_ttl):
+    """他のワーカーが同期中・同期済みでなければ同期する（失敗したユーザーはバックオフ）"""
+    if not task_mirror.claim_sync(open_id, min_ttl):
+        return
+    try:
+        access_token, error = get_valid_access_token(open_id)
+        if error:
+            raise RuntimeError(error)
+        sync_tasks(open_id, access_token)
+    except Exception:
+        task_mirror.record_failure(open_id)
+
+def _sync_due_task_mirrors(min_ttl):
+    """
+    同期が古くなりかけたユーザー・変更通知を受けたユーザーのミラーを TASK_SYNC_CONCURRENCY 並列で取り直す
+    ジョブのスレッドはトークン更新と共用のため、同期の完了は待たない
+    """
+    open_ids = task_mirror.due(min_ttl)
+    for open_id in open_ids:
+        task_sync_executor.submit(_background_sync_tasks, open_id, min_ttl)
+    return len(open_ids), None
+
+def request_task_resync(open_id=None):
+    """タスクの変更を知った（open_id 省略時は全ユーザー）。ミラーは返し続けたまま、バックグラウンドで取り直す"""
+    if task_mirror is None:
+        return
+    task_mirror.mark_dirty(open_id)
+    _sync_due_task_mirrors(0)
+
+# Bitableのテーブルを同時に同期する数の上限（ワーカーごと）
+BITABLE_SYNC_CONCURRENCY = int(os.environ.get('BITABLE_SYNC_CONCURRENCY', '2'))
+# 同期から BITABLE_MIRROR_MAX_AGE 秒たつ何秒前にバックグラウンドで取り直すか
+BITABLE_MIRROR_LEAD = float(os.environ.get('BITABLE_MIRROR_LEAD', '60'))
+bitable_sync_executor = ThreadPoolExecutor(max_workers=BITABLE_SYNC_CONCURRENCY, thread_name_prefix='bitable-sync')
+# 同期中のテーブルの次のページを先に取得するスレッド（テーブルごとに1つ使う）
+bitable_page_executor = ThreadPoolExecutor(max_workers=BITABLE_SYNC_CONCURRENCY + 2, thread_name_prefix='bitable-page')
+
+def _background_sync_bitable(key, min_ttl):
+    """他のワーカーが同期中・同期済みでなければ同期する（失敗したテーブルはバックオフ）"""
+    if not bitable_mirror.claim_sync(key, min_ttl):
+        return
+    try:
+        sync_bitable_table(key)
+    except Exception:
+        bitable_mirror.record_failure(key)
+
+def _sync_due_bitable_mirrors(min_ttl):
+    """
+    未同期・同期が古くなりかけた・変更通知を受けたテーブルを BITABLE_SYNC_CONCURRENCY 並列で取り直す
+    ジョブのスレッドはトークン更新と共用のため、同期の完了は待たない
+    """
+    keys = bitable_mirror.due(min_ttl)
+    for key in keys:
+        bitable_sync_executor.submit(_background_sync_bitable, key, min_ttl)
+    return len(keys), None
+
+def request_bitable_resync(key=None, full=False):
+    """レコードの変更を知った（key 省略時は全テーブル）。ミラーは返し続けたまま、バックグラウンドで取り直す"""
+    if bitable_mirror is None or (key is not None and key not in bitable_mirror.tables):
+        return
+    bitable_mirror.mark_dirty(key, full=full)
+    _sync_due_bitable_mirrors(0)
+
+token_refresher = BackgroundRefresher.from_env()
+token_refresher.add_job(
+    'user',
+    token_vault.next_expiry,
+    _refresh_due_users,
+    lead=BACKGROUND_REFRESH_LEAD
+)
+token_refresher.add_job(
+    'tenant',
+    _tenant_token_expires_at,
+    lambda min_ttl: _run_refresh('tenant', lambda: _do_refresh_tenant_token(min_ttl=min_ttl)),
+    lead=BACKGROUND_REFRESH_LEAD
+)
+if task_mirror is not None:
+    token_refresher.add_job('tasks', task_mirror.next_expiry, _sync_due_task_mirrors, lead=TASK_MIRROR_LEAD)
+if bitable_mirror is not None:
+    token_refresher.add_job('bitable', bitable_mirror.next_expiry, _sync_due_bitable_mirrors, lead=BITABLE_MIRROR_LEAD)
+
+BACKGROUND_REFRESH_ENABLED = os.environ.get('BACKGROUND_REFRESH', '1') != '0'
+
+@app.before_request
+def ensure_background_refresher():
+    """ワーカーごとにバックグラウンド更新を起動（fork後の最初のリクエストで起動し直す）"""
+    if BACKGROUND_REFRESH_ENABLED:
+        token_refresher.ensure_started()
+
+@app.before_request
+def start_request_metrics():
+    metrics.ensure_started()
+    g.metrics_started = time.perf_counter()
+    metrics.add('lark_oauth_http_requests_in_flight', 1)
+
+@app.after_request
+def record_request_metrics(response):
+    """ルート（URLルールのパターン）ごとの所要時間を記録"""
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('lark_oauth_http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method)
+        metrics.inc('lark_oauth_http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    metrics.add('lark_oauth_http_requests_in_flight', -1)
 
 def verify_api_key():
-    """APIキーを検証"""
+    """
+    APIキーを検証し、呼び出し元のユーザーを g.user_id に設定
+    共通の API_KEY は既定ユーザー（ユーザー管理APIも使える）、ユーザーごとのAPIキーはそのユーザーとして動作
+    """
     auth_header = request.headers.get('Authorization', '')
     if auth_header.startswith('Bearer '):
         provided_key = auth_header[7:]
-        return provided_key == API_KEY
+    else:
+        # クエリパラメータでも許可
+        provided_key = request.args.get('api_key', '')
+    if not provided_key:
+        return False
+    
+    # compare_digest は非ASCIIの文字列を受け付けないため、バイト列で比べる
+    if secrets.compare_digest(provided_key.encode('utf-8', 'surrogatepass'), API_KEY.encode('utf-8', 'surrogatepass')):
+        g.user_id = token_vault.default_open_id
+        g.is_admin = True
+        return True
     
-    # クエリパラメータでも許可
-    provided_key = request.args.get('api_key', '')
-    return provided_key == API_KEY
+    open_id = token_vault.resolve_api_key(provided_key)
+    if open_id is None:
+        return False
+    g.user_id = open_id
+    g.is_admin = False
+    return True
 
-# ========================================
-# Webルート（認証フロー）
-# ========================================
+def fetch_user_info(access_token):
+    """User Access Tokenの持ち主（open_id・名前）を取得"""
+    response = lark_http.get(
+        f"{LARK_API_BASE}/authen/v1/user_info",
+        headers={'Authorization': f'Bearer {access_token}'},
+        credential='user'
+    )
+    result = response.json()
+    if result.get('code') != 0 or not result.get('data', {}).get('open_id'):
+        return None, f"ユーザー情報の取得に失敗しました: {result.get('msg', str(result))}"
+    return result['data'], None
 
-@app.route('/')
-def index():
-    """トップページ - 認証開始"""
-    state = secrets.token_urlsafe(16)
-    state_store['state'] = state
+# バッファして返す（キャッシュする）レスポンスで中継しないヘッダー（本文は解凍済みで、長さはFlaskが付け直す）
+BUFFERED_EXCLUDED_HEADERS = ('content-encoding', 'content-length', 'set-cookie')
+
+def _fetch_lark_get(path, access_token, params, credential, headers=None):
+    response = lark_http.get(
+        f"{LARK_API_BASE}/{path}",
+        headers=dict(headers or {}, Authorization=f'Bearer {access_token}'),
+        params=params,
+        credential=credential
+    )
+    return response.status_code, relay_headers(response, exclude=BUFFERED_EXCLUDED_HEADERS), response.content
+
+def lark_get(path, access_token, params, credential='user', headers=None):
+    """
+    読み取り系のLark API呼び出し（キャッシュ対象のパスはキャッシュを経由）
+    同じ内容のGETが同時に来た場合は上流への呼び出しを1回にまとめ、結果を共有する
+    credential: レート制限の単位（'user' / 'tenant'）
+    headers: 上流へ渡すリクエストヘッダー（レスポンスが変わりうるためキャッシュのキーに含める）
+    戻り値: (status, headers, body, etag)
+    """
+    params = list(params.items()) if isinstance(params, dict) else list(params)
+    headers = dict(headers or {})
+    key = response_cache.make_key(path, params, access_token, extra=sorted(headers.items()) if headers else '')
+    ttl = response_cache.ttl_for(path)
+    if ttl is not None:
+        entry = response_cache.get(key)
+        if entry is not None:
+            return entry.status, entry.headers, entry.body, entry.etag
     
-    redirect_uri = get_redirect_uri()
+    try:
+        status, headers, body = get_flight.do(
+            key,
+            lambda: _fetch_lark_get(path, access_token, params, credential, headers),
+            timeout=lark_http.deadline + 5
+        )
+    except SingleFlightTimeout:
+        raise UpstreamDeadlineExceeded(f"GET {path}: 同一リクエストの完了待ちがタイムアウトしました")
+    if ttl is not None and is_cacheable(status, headers, body):
+        entry = response_cache.put(key, response_cache.families_for(path, params), ttl, status, headers, body)
+        if entry is not None:
+            return entry.status, entry.headers, entry.body, entry.etag
+    return status, headers, body, make_etag(body)
+
+# 自動ページング用のクエリパラメータ（上流へは渡さない）
+PAGINATION_PARAMS = ('all', 'max_items', 'format')
+PAGINATION_MAX_PAGES = int(os.environ.get('PAGINATION_MAX_PAGES', '1000'))
+
+def wants_all_pages():
+    """?all=true または ?max_items=N が指定されているか"""
+    return request.args.get('all', '').lower() in ('1', 'true', 'yes') or bool(request.args.get('max_items'))
+
+def paginated_response(path, access_token, params, credential='user'):
+    """
+    has_more / page_token をサーバー側でたどり、アイテムをストリーミングで返す
+    ?format=ndjson で1行1アイテム、それ以外はJSON配列
+    """
+    params = [(k, v) for k, v in params if k != 'page_token']
     
-    auth_params = {
-        'client_id': APP_ID,
-        'redirect_uri': redirect_uri,
-        'response_type': 'code',
-        'scope': SCOPES,
-        'state': state
+    def fetch_page(page_token):
+        page_params = params + [('page_token', page_token)] if page_token else params
+        status, _, body, _ = lark_get(path, access_token, page_params, credential)
+        return parse_page(status, body)
+    
+    paginator = Paginator(fetch_page, max_items=request.args.get('max_items', type=int), max_pages=PAGINATION_MAX_PAGES)
+    try:
+        paginator.first_page()
+    except PageError as e:
+        return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': 'APIError', 'message': str(e)}), 500
+    
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(paginator)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(stream_json_array(paginator)), mimetype='application/json')
+
+def send_chat_message(access_token, chat_id, msg_type, content, message_uuid=None):
+    """
+    ボットとしてチャットにメッセージを送信
+    message_uuid を指定すると、同じuuidの再送はLark側で重複排除される
+    """
+    body = {
+        'receive_id': chat_id,
+        'msg_type': msg_type,
+        'content': content
     }
+    if message_uuid:
+        body['uuid'] = message_uuid
+    response = lark_http.post(
+        f"{LARK_API_BASE}/im/v1/messages",
+        headers={
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        },
+        params={'receive_id_type': 'chat_id'},
+        json=body,
+        credential='tenant'
+    )
+    # このチャットのメッセージ一覧キャッシュを無効化
+    response_cache.invalidate_path('im/v1/messages', chat_id)
+    index_sent_message(response)
+    return response
+
+def index_sent_message(response):
+    """ボット自身の送信はイベントが届かないため、送信結果をインデックスに追加"""
+    if message_index is None or response.status_code != 200:
+        return
+    try:
+        body = response.json()
+    except ValueError:
+        return
+    if body.get('code') == 0 and body.get('data'):
+        publish_messages(message_index.upsert([body['data']]))
+
+def publish_messages(items):
+    """インデックスで追加・変更されたメッセージを /api/stream の購読者へ配信"""
+    event_log.append_many([(f"chat:{item['chat_id']}", 'message', item) for item in items])
+
+def fetch_message_window(chat_id, access_token, start_time=None, end_time=None, max_pages=MESSAGE_SYNC_MAX_PAGES):
+    """
+    期間内（秒、両端を含む）のメッセージを古い順にたどってインデックスに取り込む
+    戻り値: (取り込んだ件数, 最後のページまで取得できたか)
+    """
+    params = {
+        'container_id_type': 'chat',
+        'container_id': chat_id,
+        'sort_type': 'ByCreateTimeAsc',
+        'page_size': '50'
+    }
+    if start_time is not None:
+        params['start_time'] = str(start_time)
+    if end_time is not None:
+        params['end_time'] = str(end_time)
+    
+    count = 0
+    page_token = ''
+    for _ in range(max_pages):
+        page_params = dict(params, page_token=page_token) if page_token else params
+        # レスポンスキャッシュは経由しない（古いページで high_water を進めると、その間のメッセージを取りこぼす）
+        status, _, body = _fetch_lark_get('im/v1/messages', access_token, page_params, 'tenant')
+        data = parse_page(status, body)
+        items = data.get('items') or []
+        publish_messages(message_index.upsert(items))
+        if items:
+            message_index.advance_high_water(chat_id, max(int(item['create_time']) for item in items))
+        count += len(items)
+        page_token = data.get('page_token', '')
+        if not data.get('has_more') or not page_token:
+            return count, True
+    return count, False
+
+def _sync_chat_messages(chat_id, access_token):
+    high_water = message_index.high_water(chat_id)
+    if high_water is None:
+        # 初回は最新ページだけ取り込む（それより前は /backfill で取得）
+        started_at = int(datetime.now().timestamp() * 1000)
+        # レスポンスキャッシュは経由しない（同期は上流の最新を読む）
+        status, _, body = _fetch_lark_get('im/v1/messages', access_token, {
+            'container_id_type': 'chat',
+            'container_id': chat_id,
+            'sort_type': 'ByCreateTimeDesc',
+            'page_size': '50'
+        }, 'tenant')
+        items = parse_page(status, body).get('items') or []
+        publish_messages(message_index.upsert(items))
+        message_index.advance_high_water(chat_id, max([int(item['create_time']) for item in items] or [started_at]))
+    else:
+        # 以降は前回取り込んだ最新メッセージの時刻から（同じ秒のメッセージは重複するが、変更がなければ無視される）
+        fetch_message_window(chat_id, access_token, start_time=high_water // 1000)
+    message_index.mark_synced(chat_id)
+
+def sync_chat_messages(chat_id, access_token):
+    """上流の新着分をインデックスに取り込む（初回は最新ページ、以降は前回の続きから）"""
+    message_sync_flight.do(chat_id, lambda: _sync_chat_messages(chat_id, access_token), timeout=lark_http.deadline + 5)
+
+def indexed_messages_response(chat_id, page_size, since=None):
+    """
+    インデックスからメッセージ一覧を返す（形式は im/v1/messages と同じ）
+    since（連番）を指定すると、それ以降に追加・変更されたメッセージだけを返す
+    data.cursor を次回の ?since= に渡すと差分だけを取得できる
+    """
+    if since is None:
+        descending = request.args.get('sort_type') == 'ByCreateTimeDesc'
+        items, seq = message_index.latest(chat_id, page_size, descending=descending)
+        has_more = False
+    else:
+        items, has_more, seq = message_index.changes_since(chat_id, since, page_size)
+    body = json.dumps(
+        {'code': 0, 'msg': 'success', 'data': {'has_more': has_more, 'items': items, 'cursor': encode_cursor(seq)}},
+        ensure_ascii=False
+    ).encode()
+    if wants_expand_users():
+        body = expand_users(body, message_user_ids)
+    response = conditional_response(200, [('Content-Type', 'application/json')], body, make_etag(body))
+    response.headers['X-Message-Source'] = 'index'
+    return response
+
+def _sync_tasks(open_id, access_token):
+    known = task_mirror.known_versions(open_id)
+    seen = set()
+    page_token = ''
+    for _ in range(TASK_SYNC_MAX_PAGES):
+        params = {'page_size': '100'}
+        if page_token:
+            params['page_token'] = page_token
+        # レスポンスキャッシュは経由しない（同期は上流の最新を読む）
+        status, _, body = _fetch_lark_get('task/v2/tasks', access_token, params, 'user')
+        data = parse_page(status, body)
+        items = data.get('items') or []
+        task_mirror.upsert(open_id, items, known)
+        seen.update(item['guid'] for item in items if item.get('guid'))
+        page_token = data.get('page_token', '')
+        if not data.get('has_more') or not page_token:
+            task_mirror.mark_missing_deleted(open_id, seen)
+            break
+    task_mirror.mark_synced(open_id)
+
+def sync_tasks(open_id, access_token):
+    """ユーザーのタスク一覧の全ページをたどり、updated_at が進んだタスクだけをミラーに書き込む"""
+    task_sync_flight.do(open_id, lambda: _sync_tasks(open_id, access_token), timeout=TASK_SYNC_WAIT_TIMEOUT)
+
+# ミラーへの問い合わせになる /api/tasks のクエリパラメータ
+TASK_QUERY_PARAMS = ('status', 'due_after', 'due_before', 'assignee', 'tasklist', 'updated_since', 'since')
+TASK_QUERY_MAX_LIMIT = int(os.environ.get('TASK_QUERY_MAX_LIMIT', '1000'))
+
+def wants_task_mirror():
+    """絞り込みのパラメータ（または ?source=mirror）が指定されているか"""
+    return request.args.get('source') == 'mirror' or any(request.args.get(name) for name in TASK_QUERY_PARAMS)
+
+def mirrored_tasks_response(open_id):
+    """
+    ミラーから条件に合うタスクを返す（形式は task/v2/tasks と同じ）
+    未同期・同期が古い場合だけ上流から取り直す。data.high_water を次回の ?since= に渡すと変更分だけを取得できる
+    """
+    filters = {}
+    try:
+        for name in ('due_after', 'due_before', 'updated_since'):
+            if request.args.get(name):
+                filters[name] = parse_time_ms(request.args[name])
+    except ValueError as e:
+        return jsonify({'error': 'ValidationError', 'message': str(e)}), 400
+    if request.args.get('since'):
+        if not request.args['since'].isdigit():
+            return jsonify({'error': 'ValidationError', 'message': 'since must be a high_water value'}), 400
+        filters['since'] = int(request.args['since'])
+    status = request.args.get('status')
+    if status:
+        if status not in ('todo', 'done'):
+            return jsonify({'error': 'ValidationError', 'message': 'status must be todo or done'}), 400
+        filters['status'] = status
+    if request.args.get('assignee'):
+        filters['assignee'] = open_id if request.args['assignee'] == 'me' else request.args['assignee']
+    if request.args.get('tasklist'):
+        filters['tasklist'] = request.args['tasklist']
+    order = request.args.get('order', 'due')
+    if order not in TASK_ORDERS:
+        return jsonify({'error': 'ValidationError', 'message': f"order must be one of {', '.join(TASK_ORDERS)}"}), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), TASK_QUERY_MAX_LIMIT))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    if not task_mirror.is_synced(open_id):
+        access_token, error = get_valid_access_token(open_id)
+        if error:
+            return jsonify({'error': 'TokenError', 'message': error, 'need_reauth': True}), 401
+        try:
+            sync_tasks(open_id, access_token)
+        except PageError as e:
+            return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+        except SingleFlightTimeout:
+            return jsonify({'error': 'UpstreamTimeout', 'message': 'タスクの同期の完了待ちがタイムアウトしました'}), 504
+        except RateLimitExceeded as e:
+            return rate_limited_response(e)
+        except requests.exceptions.Timeout as e:
+            return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+        except Exception as e:
+            return jsonify({'error': 'APIError', 'message': str(e)}), 500
     
-    auth_url = f"{AUTH_URL}?" + "&".join([f"{k}={requests.utils.quote(str(v))}" for k, v in auth_params.items()])
+    items, has_more, high_water = task_mirror.query(open_id, order=order, limit=limit, offset=offset, **filters)
+    synced_at = task_mirror.synced_at(open_id)
+    body = json.dumps({'code': 0, 'msg': 'success', 'data': {
+        'has_more': has_more,
+        'items': items,
+        'high_water': str(high_water),
+        'synced_at': datetime.fromtimestamp(synced_at).isoformat() if synced_at else ''
+    }}, ensure_ascii=False).encode()
+    if wants_expand_users():
+        body = expand_users(body, task_user_ids)
+    response = conditional_response(200, [('Content-Type', 'application/json')], body, make_etag(body))
+    response.headers['X-Task-Source'] = 'mirror'
+    return response
+
+def _bitable_access_token():
+    """ミラーの同期に使うトークンとレート制限の単位（BITABLE_MIRROR_CREDENTIAL）"""
+    if BITABLE_MIRROR_CREDENTIAL == 'tenant':
+        access_token, error = get_tenant_access_token()
+    else:
+        access_token, error = get_valid_access_token(token_vault.default_open_id)
+    if error:
+        raise RuntimeError(error)
+    return access_token, BITABLE_MIRROR_CREDENTIAL
+
+def _search_bitable_records(table, access_token, credential, since, page_token):
+    """records/search の1ページ（500件、作成日時・更新日時付き）"""
+    params = {'page_size': '500'}
+    if page_token:
+        params['page_token'] = page_token
+    response = lark_http.request(
+        'POST',
+        f"{LARK_API_BASE}/bitable/v1/apps/{table['app_token']}/tables/{table['table_id']}/records/search",
+        headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
+        params=params,
+        json=search_body(table['modified_field'], since),
+        credential=credential
+    )
+    return parse_page(response.status_code, response.content)
+
+def _sync_bitable_table(key):
+    table = bitable_mirror.tables[key]
+    access_token, credential = _bitable_access_token()
+    since = bitable_mirror.incremental_since(key)
+    known = bitable_mirror.known_versions(key)
+    seen = set()
+    complete = False
+    fetch = lambda page_token: _search_bitable_records(table, access_token, credential, since, page_token)
+    page = bitable_page_executor.submit(fetch, '')
+    for _ in range(BITABLE_SYNC_MAX_PAGES):
+        data = page.result()
+        page_token = data.get('page_token', '')
+        complete = not data.get('has_more') or not page_token
+        if not complete:
+            # ページはカーソルでしかたどれないため、次のページの取得とこのページの書き込みを重ねる
+            page = bitable_page_executor.submit(fetch, page_token)
+        items = data.get('items') or []
+        bitable_mirror.upsert(key, items, known)
+        seen.update(item['record_id'] for item in items if item.get('record_id'))
+        if complete:
+            break
+    if since is None and complete:
+        bitable_mirror.mark_missing_deleted(key, seen)
+    bitable_mirror.mark_synced(key, full=since is None and complete)
+
+def sync_bitable_table(key):
+    """
+    テーブルを取り込む（初回・全件の照合は全ページ、それ以外は更新日時の項目が前回以降のレコードだけ）
+    書き込むのは last_modified_time が進んだレコードだけ
+    """
+    bitable_sync_flight.do(key, lambda: _sync_bitable_table(key), timeout=BITABLE_SYNC_WAIT_TIMEOUT)
+
+def ensure_bitable_synced(key):
+    """未同期・同期が古いテーブルだけ上流から取り直す。エラー時はレスポンス、同期済みなら None"""
+    if bitable_mirror.is_synced(key):
+        return None
+    try:
+        sync_bitable_table(key)
+    except PageError as e:
+        return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+    except SingleFlightTimeout:
+        return jsonify({'error': 'UpstreamTimeout', 'message': 'テーブルの同期の完了待ちがタイムアウトしました'}), 504
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': 'APIError', 'message': str(e)}), 500
+    return None
+
+def bitable_response(key, data, high_water):
+    """ミラーの結果に同期の状態と次回の ?since= に渡す連番（high_water）を付けて返す"""
+    synced_at = bitable_mirror.synced_at(key)
+    data['high_water'] = str(high_water)
+    data['synced_at'] = datetime.fromtimestamp(synced_at).isoformat() if synced_at else ''
+    body = json.dumps({'code': 0, 'msg': 'success', 'data': data}, ensure_ascii=False).encode()
+    response = conditional_response(200, [('Content-Type', 'application/json')], body, make_etag(body))
+    response.headers['X-Bitable-Source'] = 'mirror'
+    return response
+
+def _fetch_document_blocks(document, access_token):
+    """revision のブロックを全ページ取得し、テキストと一緒にドキュメントキャッシュへ保存"""
+    document_id, revision_id = document['document_id'], document['revision_id']
+    blocks = []
+    page_token = ''
+    for _ in range(DOC_BLOCKS_MAX_PAGES):
+        params = {'page_size': '500', 'document_revision_id': str(revision_id)}
+        if page_token:
+            params['page_token'] = page_token
+        status, _, body = _fetch_lark_get(f'docx/v1/documents/{document_id}/blocks', access_token, params, 'user')
+        data = parse_page(status, body)
+        blocks.extend(data.get('items') or [])
+        page_token = data.get('page_token', '')
+        if not data.get('has_more') or not page_token:
+            break
+    else:
+        raise PageError(f'ブロックが {DOC_BLOCKS_MAX_PAGES} ページを超えています（DOC_BLOCKS_MAX_PAGES）')
+    document_cache.put(document_id, revision_id, document_body(document, blocks), render_text(document_id, blocks))
+
+def document_response(document_id, access_token):
+    """
+    ドキュメントの全ブロック（?format=text でプレーンテキスト）を返す
+    メタデータで現在の revision_id を確認し、保存済みでなければブロックを取得して保存する
+    ETag は document_id × revision_id で決まるため、変わっていなければ本文を読まずに304を返す
+    """
+    fmt = 'txt' if request.args.get('format') == 'text' else 'json'
+    status, _, body, _ = lark_get(f'docx/v1/documents/{document_id}', access_token, {})
+    document = parse_page(status, body).get('document') or {}
+    if document.get('revision_id') is None:
+        raise PageError('revision_id を取得できませんでした', json.loads(body))
+    document.setdefault('document_id', document_id)
+    revision_id = document['revision_id']
+    etag = f'doc-{document_id}-{revision_id}-{fmt}'
     
-    has_token = bool(token_store.get('refresh_token'))
-    updated_at = token_store.get('updated_at', '未設定')
+    source = 'cache'
+    if request.if_none_match.contains(etag):
+        document_cache.note_not_modified()
+        response = Response(status=304)
+    else:
+        opened = document_cache.read(document_id, revision_id, fmt)
+        if opened is None:
+            source = 'upstream'
+            document_flight.do(
+                (document_id, revision_id),
+                lambda: _fetch_document_blocks(document, access_token),
+                timeout=DOC_FETCH_WAIT_TIMEOUT
+            )
+            opened = document_cache.read(document_id, revision_id, fmt)
+            if opened is None:
+                raise PageError('保存したドキュメントを読めませんでした（DOC_CACHE_MAX_BYTES を確認してください）')
+        size, chunks = opened
+        response = Response(chunks, mimetype='text/plain' if fmt == 'txt' else 'application/json')
+        response.headers['Content-Length'] = str(size)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Document-Revision'] = str(revision_id)
+    response.headers['X-Document-Source'] = source
+    return response
+
+def rate_limited_response(e):
+    """レート制限で送信できなかった場合の429レスポンス"""
+    response = jsonify({'error': 'RateLimited', 'message': str(e), 'retry_after': round(e.retry_after, 1)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+def conditional_response(status, headers, body, etag):
+    """ETag付きで返す（If-None-Matchが一致すれば本文なしの304）。上流のエラーはETagを付けずにそのまま返す"""
+    if status != 200:
+        return Response(body, status=status, headers=headers)
+    if request.if_none_match.contains(etag):
+        response_cache.note_not_modified()
+        response = Response(status=304)
+    else:
+        response = Response(body, status=status, headers=headers)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def wants_expand_users():
+    """?expand=users が指定されているか"""
+    return 'users' in request.args.get('expand', '').split(',')
+
+def message_user_ids(item):
+    """メッセージの送信者・メンションのユーザー（open_id）"""
+    sender = item.get('sender') or {}
+    ids = [sender['id']] if sender.get('id_type') == 'open_id' and sender.get('id') else []
+    return ids + [mention['id'] for mention in item.get('mentions') or []
+                  if mention.get('id_type', 'open_id') == 'open_id' and isinstance(mention.get('id'), str) and mention['id']]
+
+def task_user_ids(item):
+    """タスクの担当者・フォロワー・作成者（open_id）"""
+    members = list(item.get('members') or []) + [item.get('creator') or {}]
+    return [member['id'] for member in members if member.get('id') and member.get('type', 'user') == 'user']
+
+def _fetch_directory(kind, ids):
+    """contact/v3 の batch API で BATCH_SIZE 件ずつ取得し、ディレクトリキャッシュに保存"""
+    access_token, error = get_tenant_access_token()
+    if error:
+        raise RuntimeError(error)
+    if kind == 'user':
+        path, id_param, id_key, summarize_item = 'contact/v3/users/batch', 'user_ids', 'open_id', user_summary
+    else:
+        path, id_param, id_key, summarize_item = ('contact/v3/departments/batch', 'department_ids',
+                                                  'open_department_id', department_summary)
+    values = {}
+    for chunk in chunks(ids):
+        params = [(id_param, value) for value in chunk]
+        params += [('user_id_type', 'open_id'), ('department_id_type', 'open_department_id')]
+        # レスポンスキャッシュは経由しない（取り直しで古い内容を読まないように。保持はディレクトリキャッシュで行う）
+        status, _, body = _fetch_lark_get(path, access_token, params, 'tenant')
+        fetched = {item[id_key]: summarize_item(item) for item in parse_page(status, body).get('items') or [] if item.get(id_key)}
+        directory.store(kind, chunk, fetched)
+        values.update(fetched)
+    return values
+
+def _refresh_directory(kind, ids):
+    try:
+        _fetch_directory(kind, ids)
+    except Exception:
+        directory.release_refresh(kind, ids)
+
+def resolve_directory(kind, ids):
+    """
+    ID -> ユーザー・部署。キャッシュにないものだけを上流からまとめて取得する
+    取り直し時期を過ぎたものはキャッシュの値を返し、バックグラウンドで取り直す
+    """
+    found, missing, stale = directory.lookup(kind, ids)
+    if stale:
+        claimed = directory.claim_refresh(kind, stale)
+        if claimed:
+            directory_refresh_executor.submit(_refresh_directory, kind, claimed)
+    if missing:
+        found.update(_fetch_directory(kind, missing))
+    return found
+
+def expand_users(body, user_ids):
+    """
+    一覧のレスポンス（JSON）の data.users に、アイテムに含まれるユーザーの名前・部署を付ける
+    user_ids(item) -> アイテムに含まれる open_id。取得に失敗した場合は取得できた分だけを付け、data.users_error に理由を入れる
+    """
+    result = json.loads(body)
+    data = result.get('data') if isinstance(result, dict) else None
+    if not isinstance(data, dict):
+        return body
+    ids = [open_id for item in data.get('items') or [] for open_id in user_ids(item)]
+    users, departments = {}, {}
+    try:
+        users = resolve_directory('user', ids)
+        departments = resolve_directory('department', [d for user in users.values() for d in user.get('department_ids', [])])
+    except Exception as e:
+        data['users_error'] = str(e)
+    data['users'] = {
+        open_id: dict(user, departments=[
+            dict(departments[d], department_id=d) for d in user.get('department_ids', []) if d in departments
+        ])
+        for open_id, user in users.items()
+    }
+    return json.dumps(result, ensure_ascii=False).encode()
+
+# ========================================
+# Webルート（認証フロー）
+# ========================================
+
+@app.route('/')
+def index():
+    """
+    トップページ（認証状態の表示）
+    state は発行しない（ログインボタンの /login で発行）ため、ヘルスチェック等で頻繁に叩かれても軽い
+    """
+    default_user = token_vault.get(token_vault.default_open_id) if token_vault.default_open_id else None
+    has_token = default_user is not None and default_user.can_refresh()
+    updated_at = default_user.public()['updated_at'] if default_user is not None else '未設定'
     
-    return render_template_string(INDEX_HTML, auth_url=auth_url, has_token=has_token, updated_at=updated_at)
+    body, etag = _index_page(has_token, updated_at)
+    response = Response(status=304) if request.if_none_match.contains(etag) else Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={INDEX_MAX_AGE}'
+    return response
+
+@app.route('/login')
+def login():
+    """認証開始 - ログインごとに state（とPKCE）を発行してLarkの認可画面へ"""
+    code_verifier, code_challenge = pkce_pair() if OAUTH_PKCE_ENABLED else ('', '')
+    state = oauth_states.issue(code_verifier)
+    response = redirect(build_auth_url(state, code_challenge))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @app.route('/callback')
 def callback():
     """OAuth コールバック"""
-    global token_store
-    
     code = request.args.get('code')
     state = request.args.get('state')
     error = request.args.get('error')
     
     if error:
-        return render_template_string(ERROR_HTML, error_message=f"認証エラー: {error}")
+        return error_page(f"認証エラー: {error}")
     
     if not code:
-        return render_template_string(ERROR_HTML, error_message="認証コードが取得できませんでした。")
+        return error_page("認証コードが取得できませんでした。")
     
-    if state != state_store.get('state'):
-        return render_template_string(ERROR_HTML, error_message="状態が一致しません。")
+    # state は1回限り（同じコールバックURLの再読み込みでは使えない）
+    code_verifier = oauth_states.consume(state)
+    if code_verifier is None:
+        return error_page("状態が一致しないか、有効期限が切れています。もう一度ログインしてください。")
     
     redirect_uri = get_redirect_uri()
     
@@ -432,30 +1468,44 @@ def callback():
         'code': code,
         'redirect_uri': redirect_uri
     }
+    if code_verifier:
+        token_data['code_verifier'] = code_verifier
     
     try:
-        response = requests.post(TOKEN_URL, json=token_data)
+        response = lark_http.post(TOKEN_URL, json=token_data)
         result = response.json()
         
         if result.get('code') != 0 and result.get('code') != '0':
             error_msg = result.get('error_description', result.get('msg', json.dumps(result)))
-            return render_template_string(ERROR_HTML, error_message=f"トークン取得エラー: {error_msg}")
+            return error_page(f"トークン取得エラー: {error_msg}")
         
-        # トークンをサーバーに保存
-        with token_lock:
-            token_store['access_token'] = result.get('access_token', '')
-            token_store['refresh_token'] = result.get('refresh_token', '')
-            token_store['access_token_expires_at'] = datetime.now().timestamp() + result.get('expires_in', 7200)
-            token_store['updated_at'] = datetime.now().isoformat()
+        # トークンの持ち主を確認し、ユーザーごとに保存（他のユーザーのトークンは上書きしない）
+        user_info, error = fetch_user_info(result['access_token'])
+        if error:
+            return error_page(error)
+        open_id = user_info['open_id']
+        with token_vault.lock(open_id, timeout=TOKEN_REFRESH_WAIT_TIMEOUT):
+            token = token_vault.load(open_id) or UserToken(open_id)
+            token.name = user_info.get('name', '')
+            _apply_token_result(token, result)
+            token_vault.save(token)
+            # APIキーは初回のみ発行して表示する（再認証では既存のキーをそのまま使える）
+            api_key = None if token.api_key_hash else token_vault.issue_api_key(open_id)
+            if not token_vault.default_open_id:
+                token_vault.default_open_id = open_id
+        # バックグラウンド更新のスケジュールを新しいトークンに合わせる
+        token_refresher.wakeup()
         
-        return render_template_string(
-            SUCCESS_HTML,
+        return render_page(
+            SUCCESS_TEMPLATE,
             access_expires=result.get('expires_in', 'N/A'),
-            refresh_expires=result.get('refresh_token_expires_in', 'N/A')
+            refresh_expires=result.get('refresh_token_expires_in', 'N/A'),
+            user_name=token.name or open_id,
+            api_key=api_key
         )
         
     except Exception as e:
-        return render_template_string(ERROR_HTML, error_message=f"エラーが発生しました: {str(e)}")
+        return error_page(f"エラーが発生しました: {str(e)}")
 
 # ========================================
 # API エンドポイント（Manus用）
@@ -480,10 +1530,12 @@ def api_get_token():
             'auth_url': request.url_root.rstrip('/')
         }), 401
     
+    user = token_vault.get(current_user_id()).public()
     return jsonify({
         'access_token': access_token,
-        'expires_at': token_store.get('access_token_expires_at'),
-        'updated_at': token_store.get('updated_at')
+        'open_id': user['open_id'],
+        'expires_at': user['expires_at'],
+        'updated_at': user['updated_at']
     })
 
 @app.route('/api/status', methods=['GET'])
@@ -492,27 +1544,86 @@ def api_status():
     if not verify_api_key():
         return jsonify({'error': 'Unauthorized'}), 401
     
-    has_token = bool(token_store.get('refresh_token'))
+    user = token_vault.get(current_user_id()) if current_user_id() else None
     
     return jsonify({
-        'authenticated': has_token,
-        'updated_at': token_store.get('updated_at', ''),
-        'auth_url': request.url_root.rstrip('/')
+        'authenticated': user is not None and user.can_refresh(),
+        'updated_at': user.public()['updated_at'] if user is not None else '',
+        'user': user.public() if user is not None else None,
+        'users': len(token_vault) if g.is_admin else None,
+        'auth_url': request.url_root.rstrip('/'),
+        'upstream': lark_http.stats(),
+        'cache': response_cache.stats(),
+        'coalescing': {
+            'upstream_calls': get_flight.stats['leaders'],
+            'coalesced': get_flight.stats['shared'],
+            'timeouts': get_flight.stats['timeouts']
+        },
+        'refresher': token_refresher.state(),
+        'message_index': message_index.stats() if message_index is not None else None,
+        'task_mirror': task_mirror.stats() if task_mirror is not None else None,
+        'directory': directory.stats(),
+        'documents': document_cache.stats(),
+        'bitable_mirror': bitable_mirror.stats() if bitable_mirror is not None else None,
+        'stream': event_log.stats()
     })
 
+@app.route('/api/users', methods=['GET'])
+def api_list_users():
+    """認証済みユーザーの一覧（共通の API_KEY のみ）"""
+    if not verify_api_key() or not g.is_admin:
+        return jsonify({'error': 'Unauthorized'}), 401
+    users = sorted((token.public() for token in token_vault.users()), key=lambda user: user['open_id'])
+    return jsonify({'default_open_id': token_vault.default_open_id, 'users': users})
+
+@app.route('/api/users/<open_id>', methods=['DELETE'])
+def api_delete_user(open_id):
+    """ユーザーのトークンとAPIキーを削除（共通の API_KEY のみ）"""
+    if not verify_api_key() or not g.is_admin:
+        return jsonify({'error': 'Unauthorized'}), 401
+    with token_vault.lock(open_id, timeout=TOKEN_REFRESH_WAIT_TIMEOUT):
+        if not token_vault.delete(open_id):
+            return jsonify({'error': 'NotFound', 'message': f'user not found: {open_id}'}), 404
+    if task_mirror is not None:
+        task_mirror.drop_owner(open_id)
+    return jsonify({'deleted': open_id})
+
+@app.route('/api/users/<open_id>/api_key', methods=['POST'])
+def api_issue_user_api_key(open_id):
+    """ユーザーのAPIキーを発行し直す（以前のキーは無効。共通の API_KEY のみ）"""
+    if not verify_api_key() or not g.is_admin:
+        return jsonify({'error': 'Unauthorized'}), 401
+    with token_vault.lock(open_id, timeout=TOKEN_REFRESH_WAIT_TIMEOUT):
+        try:
+            api_key = token_vault.issue_api_key(open_id)
+        except KeyError:
+            return jsonify({'error': 'NotFound', 'message': f'user not found: {open_id}'}), 404
+    return jsonify({'open_id': open_id, 'api_key': api_key})
+
 @app.route('/api/tasks', methods=['GET'])
 def api_get_tasks():
     """
     Larkタスクを取得するAPI（プロキシ）
     Manusはこのエンドポイントを呼び出すだけでタスクを取得可能
+    ?all=true / ?max_items=N で全ページをまとめて取得（?format=ndjson で1行1件）
+    ?status= / ?due_after= / ?due_before= / ?assignee= / ?tasklist= / ?updated_since= / ?since= を指定するとミラーから絞り込んで返す
+    ?expand=users で data.users に担当者・作成者の名前と部署を付ける（?all=true では付けない）
     """
     if not verify_api_key():
         return jsonify({'error': 'Unauthorized'}), 401
     
+    if wants_task_mirror():
+        if task_mirror is None:
+            return jsonify({'error': 'ValidationError', 'message': 'filters require the task mirror (TASK_MIRROR=1)'}), 400
+        return mirrored_tasks_response(current_user_id())
+    
     access_token, error = get_valid_access_token()
     if error:
         return jsonify({'error': 'TokenError', 'message': error, 'need_reauth': True}), 401
     
+    if wants_all_pages():
+        return paginated_response('task/v2/tasks', access_token, {'page_size': request.args.get('page_size', '100')}.items())
+    
     # Lark APIを呼び出し
     page_size = request.args.get('page_size', '50')
     page_token = request.args.get('page_token', '')
@@ -522,15 +1633,118 @@ def api_get_tasks():
         params['page_token'] = page_token
     
     try:
-        response = requests.get(
-            f"{LARK_API_BASE}/task/v2/tasks",
-            headers={'Authorization': f'Bearer {access_token}'},
-            params=params
-        )
-        return jsonify(response.json())
+        status, headers, body, etag = lark_get('task/v2/tasks', access_token, params)
+        if status == 200 and wants_expand_users():
+            body = expand_users(body, task_user_ids)
+            etag = make_etag(body)
+        return conditional_response(status, headers, body, etag)
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
 
+# タスクの一括作成・更新
+TASK_BULK_MAX_OPERATIONS = int(os.environ.get('TASK_BULK_MAX_OPERATIONS', '500'))
+TASK_BULK_MAX_ATTEMPTS = int(os.environ.get('TASK_BULK_MAX_ATTEMPTS', '3'))
+task_bulk_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('TASK_BULK_MAX_WORKERS', '8')),
+    thread_name_prefix='task-bulk'
+)
+# 実行済みの操作の結果（全ワーカーで共有。同じ冪等キーの再送には上流を呼ばずにこの結果を返す）
+task_bulk_results = IdempotencyStore(store_backend, ttl=float(os.environ.get('TASK_BULK_IDEMPOTENCY_TTL', '86400')))
+
+@app.route('/api/tasks/bulk', methods=['POST'])
+def api_bulk_tasks():
+    """
+    タスクを一括で作成・更新するAPI
+    並行して実行し（レート制限の範囲内）、完了した順に操作ごとの結果をNDJSONで返す（最後の行は集計）
+    
+    Request body:
+    {
+        "operations": [
+            {"id": "a", "op": "create", "task": {"summary": "...", "due": {...}}},
+            {"id": "b", "op": "patch", "guid": "...", "task": {"summary": "..."}, "update_fields": ["summary"]},
+            {"id": "c", "op": "complete", "guid": "..."}
+        ],
+        "bulk_id": "任意"   // 再送時に同じ値を指定すると、実行済みの操作は実行し直さない
+    }
+    操作ごとに "idempotency_key" を指定した場合は bulk_id + id の代わりにそれを使う
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    open_id = current_user_id()
+    access_token, error = get_valid_access_token(open_id)
+    if error:
+        return jsonify({'error': 'TokenError', 'message': error, 'need_reauth': True}), 401
+    
+    data = request.get_json(silent=True) or {}
+    base_id = bulk_id(data if isinstance(data, dict) else {})
+    try:
+        operations = parse_operations(data, TASK_BULK_MAX_OPERATIONS, base_id)
+    except TaskBulkValidationError as e:
+        return jsonify({'error': 'ValidationError', 'message': str(e)}), 400
+    
+    def send(operation):
+        # 長時間の一括操作でも有効なトークンを使う（通常はメモリから読むだけ）
+        token, token_error = get_valid_access_token(open_id)
+        if token_error:
+            raise requests.exceptions.RequestException(token_error)
+        method, path, body = build_request(operation, open_id)
+        return lark_http.request(
+            method,
+            f"{LARK_API_BASE}/{path}",
+            headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
+            json=body,
+            credential='user'
+        )
+    
+    def run(operation):
+        recorded = task_bulk_results.get(open_id, operation['key'])
+        if recorded is not None:
+            return dict(recorded, id=operation['id'], replayed=True)
+        result = run_operation(send, operation, TASK_BULK_MAX_ATTEMPTS)
+        if not result['ok']:
+            return result
+        # 上流では成功しているため、以降の記録・反映に失敗しても結果は返す
+        try:
+            task_bulk_results.put(open_id, operation['key'], result)
+        except Exception as e:
+            app.logger.exception('task bulk %s: failed to record the result of %s', base_id, operation['key'])
+            result['record_error'] = str(e)  # 再送すると実行し直される
+        try:
+            # クライアントが途中で切断しても反映されるよう、操作ごとにキャッシュ・ミラー・配信へ反映する
+            response_cache.invalidate_path('task/v2/tasks')
+            task = result.get('task')
+            event_log.append('tasks', 'task', {'event_type': 'api.bulk', 'bulk_id': base_id, 'op': operation['op'],
+                                               'guid': (task or {}).get('guid', operation['guid'])})
+            if task and task_mirror is not None:
+                # 結果のタスクをそのままミラーに反映する（一覧を取り直さない）
+                task_mirror.upsert(open_id, [task], {})
+        except Exception:
+            app.logger.exception('task bulk %s: failed to apply the result of %s', base_id, operation['key'])
+        return result
+    
+    futures = {task_bulk_executor.submit(run, operation): operation for operation in operations}
+    
+    def generate():
+        results = []
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # 実行済みの記録を読めなかったなど（上流は呼んでいない）
+                operation = futures[future]
+                result = {'id': operation['id'], 'op': operation['op'], 'ok': False, 'attempts': 0,
+                          'code': None, 'msg': str(e)}
+            results.append(result)
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+        yield json.dumps({'bulk_id': base_id, 'summary': summarize_operations(results)}, ensure_ascii=False) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Bulk-Id': base_id})
+
 @app.route('/api/chats', methods=['GET'])
 def api_get_chats():
     """チャット一覧を取得するAPI"""
@@ -544,12 +1758,12 @@ def api_get_chats():
     page_size = request.args.get('page_size', '50')
     
     try:
-        response = requests.get(
-            f"{LARK_API_BASE}/im/v1/chats",
-            headers={'Authorization': f'Bearer {access_token}'},
-            params={'page_size': page_size}
-        )
-        return jsonify(response.json())
+        status, headers, body, etag = lark_get('im/v1/chats', access_token, {'page_size': page_size})
+        return conditional_response(status, headers, body, etag)
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
 
@@ -558,36 +1772,302 @@ def api_get_messages(chat_id):
     """
     特定チャットのメッセージを取得するAPI
     ボットが参加しているグループのメッセージを取得するため、Tenant Access Tokenを使用
+    ?since=<cursor> で前回以降の差分だけを取得（cursor は前回のレスポンスの data.cursor、空なら全件）
+    ?expand=users で data.users に送信者・メンションされたユーザーの名前と部署を付ける
     """
     if not verify_api_key():
         return jsonify({'error': 'Unauthorized'}), 401
     
+    page_size = request.args.get('page_size', '50')
+    
+    since = request.args.get('since')
+    if since is not None:
+        if message_index is None:
+            return jsonify({'error': 'ValidationError', 'message': 'since requires the message index (MESSAGE_INDEX=1)'}), 400
+        try:
+            since = decode_cursor(since)
+        except ValueError as e:
+            return jsonify({'error': 'ValidationError', 'message': str(e)}), 400
+    
+    # ページ送り・期間指定のない問い合わせはインデックスから返す（未同期・同期が古い場合のみ上流へ）
+    use_index = message_index is not None and not any(
+        request.args.get(name) for name in ('page_token', 'start_time', 'end_time')
+    )
+    if use_index and message_index.is_synced(chat_id):
+        return indexed_messages_response(chat_id, request.args.get('page_size', 50, type=int), since)
+    
     # Tenant Access Tokenを使用（ボットが参加しているグループのメッセージ取得に必要）
     access_token, error = get_tenant_access_token()
     if error:
         return jsonify({'error': 'TokenError', 'message': error}), 401
     
-    page_size = request.args.get('page_size', '50')
+    try:
+        if use_index:
+            sync_chat_messages(chat_id, access_token)
+            return indexed_messages_response(chat_id, request.args.get('page_size', 50, type=int), since)
+        
+        params = {
+            'container_id_type': 'chat',
+            'container_id': chat_id,
+            'page_size': page_size
+        }
+        for name in ('page_token', 'start_time', 'end_time', 'sort_type'):
+            if request.args.get(name):
+                params[name] = request.args[name]
+        status, headers, body, etag = lark_get('im/v1/messages', access_token, params, credential='tenant')
+        if status == 200 and wants_expand_users():
+            body = expand_users(body, message_user_ids)
+            etag = make_etag(body)
+        return conditional_response(status, headers, body, etag)
+    except PageError as e:
+        return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': 'APIError', 'message': str(e)}), 500
+
+@app.route('/api/docs/<document_id>', methods=['GET'])
+def api_get_document(document_id):
+    """
+    ドキュメント（docx）の全ブロックを取得するAPI（?format=text でプレーンテキスト）
+    内容は revision ごとに保存し、変更がなければ上流へはメタデータの確認1回だけで返す
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if not SAFE_DOCUMENT_ID.match(document_id):
+        return jsonify({'error': 'ValidationError', 'message': f'invalid document_id: {document_id}'}), 400
+    
+    access_token, error = get_valid_access_token()
+    if error:
+        return jsonify({'error': 'TokenError', 'message': error, 'need_reauth': True}), 401
     
     try:
-        response = requests.get(
-            f"{LARK_API_BASE}/im/v1/messages",
-            headers={'Authorization': f'Bearer {access_token}'},
-            params={
-                'container_id_type': 'chat',
-                'container_id': chat_id,
-                'page_size': page_size
-            }
-        )
-        return jsonify(response.json())
+        return document_response(document_id, access_token)
+    except PageError as e:
+        return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+    except SingleFlightTimeout:
+        return jsonify({'error': 'UpstreamTimeout', 'message': 'ドキュメントの取得の完了待ちがタイムアウトしました'}), 504
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': 'APIError', 'message': str(e)}), 500
+
+BITABLE_QUERY_MAX_LIMIT = int(os.environ.get('BITABLE_QUERY_MAX_LIMIT', '1000'))
+
+def mirrored_bitable_key(app_token, table_id):
+    """ミラーしているテーブルの table_key（ミラーしていなければ None）"""
+    key = table_key(app_token, table_id)
+    return key if bitable_mirror is not None and key in bitable_mirror.tables else None
+
+def bitable_access_error(app_token):
+    """
+    呼び出し元がBaseを読めなければエラーのレスポンス（読めれば None）
+    ミラーは既定ユーザー（またはアプリ）のトークンで同期しているため、ユーザーごとのAPIキーでは
+    呼び出し元のトークンでBaseのメタデータを取得して確かめる（結果はレスポンスキャッシュに残り、毎回は呼ばない）
+    """
+    if g.is_admin or (BITABLE_MIRROR_CREDENTIAL == 'user' and current_user_id() == token_vault.default_open_id):
+        return None
+    access_token, error = get_valid_access_token()
+    if error:
+        return jsonify({'error': 'TokenError', 'message': error, 'need_reauth': True}), 401
+    try:
+        status, _, body, _ = lark_get(f'bitable/v1/apps/{app_token}', access_token, {})
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
+    try:
+        result = json.loads(body)
+    except ValueError:
+        result = {}
+    if status == 200 and result.get('code') == 0:
+        return None
+    if status >= 500:
+        return jsonify(result or {'error': 'PageError', 'message': f'HTTP {status}'}), 502
+    return jsonify({'error': 'Forbidden', 'message': result.get('msg') or 'このBaseを読む権限がありません'}), 403
+
+@app.route('/api/bitable/<app_token>/<table_id>/records', methods=['GET'])
+def api_get_bitable_records(app_token, table_id):
+    """
+    ミラーしているテーブルのレコードを返すAPI（上流を呼ばない。形式は records/search と同じ）
+    ?since=<data.high_water> で前回以降にミラーへ書き込まれた・削除されたレコードだけを返す
+    ?limit=N（既定500）&offset=N
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    key = mirrored_bitable_key(app_token, table_id)
+    if key is None:
+        return jsonify({'error': 'NotMirrored', 'message': 'BITABLE_MIRRORS に設定されていないテーブルです'}), 404
+    error_response = bitable_access_error(app_token)
+    if error_response is not None:
+        return error_response
+    since = None
+    if request.args.get('since'):
+        if not request.args['since'].isdigit():
+            return jsonify({'error': 'ValidationError', 'message': 'since must be a high_water value'}), 400
+        since = int(request.args['since'])
+    limit = max(1, min(request.args.get('limit', 500, type=int), BITABLE_QUERY_MAX_LIMIT))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    error_response = ensure_bitable_synced(key)
+    if error_response is not None:
+        return error_response
+    items, has_more, high_water = bitable_mirror.records(key, since=since, limit=limit, offset=offset)
+    return bitable_response(key, {'items': items, 'has_more': has_more}, high_water)
+
+@app.route('/api/bitable/<app_token>/<table_id>/query', methods=['POST'])
+def api_query_bitable(app_token, table_id):
+    """
+    ミラーしているテーブルへの問い合わせ（絞り込み・並べ替え・項目の選択・集計。上流を呼ばない）
+    
+    Request body:
+    {
+        "filter": [{"field": "状態", "op": "eq", "value": "完了"}],   // op: eq ne gt gte lt lte in contains empty not_empty
+        "conjunction": "and",
+        "sort": [{"field": "金額", "desc": true}],
+        "fields": ["名前", "金額"],
+        "group_by": ["担当者"],
+        "aggregates": [{"op": "sum", "field": "金額", "as": "合計"}],   // op: count count_distinct sum avg min max
+        "format": "raw",   // "flat" で比較に使う値（テキストは連結した文字列、ユーザーは名前）を返す
+        "limit": 100, "offset": 0
+    }
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    key = mirrored_bitable_key(app_token, table_id)
+    if key is None:
+        return jsonify({'error': 'NotMirrored', 'message': 'BITABLE_MIRRORS に設定されていないテーブルです'}), 404
+    error_response = bitable_access_error(app_token)
+    if error_response is not None:
+        return error_response
+    try:
+        query = parse_bitable_query(request.get_json(silent=True) or {}, BITABLE_QUERY_MAX_LIMIT)
+    except BitableQueryError as e:
+        return jsonify({'error': 'ValidationError', 'message': str(e)}), 400
+    
+    error_response = ensure_bitable_synced(key)
+    if error_response is not None:
+        return error_response
+    # 問い合わせる前の最新の連番（問い合わせ中の書き込みを次回の ?since= で取りこぼさない）
+    high_water = bitable_mirror.high_water(key)
+    return bitable_response(key, bitable_mirror.query(key, query), high_water)
+
+@app.route('/api/wiki/<node_token>/document', methods=['GET'])
+def api_get_wiki_document(node_token):
+    """Wikiノードの実体のドキュメント（docx）を /api/docs/<document_id> と同じ形で返すAPI"""
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    access_token, error = get_valid_access_token()
+    if error:
+        return jsonify({'error': 'TokenError', 'message': error, 'need_reauth': True}), 401
+    
+    try:
+        status, _, body, _ = lark_get('wiki/v2/spaces/get_node', access_token, {'token': node_token})
+        node = parse_page(status, body).get('node') or {}
+        if node.get('obj_type') != 'docx' or not SAFE_DOCUMENT_ID.match(node.get('obj_token', '')):
+            return jsonify({'error': 'ValidationError', 'message': f"not a docx node: {node.get('obj_type')}"}), 400
+        return document_response(node['obj_token'], access_token)
+    except PageError as e:
+        return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+    except SingleFlightTimeout:
+        return jsonify({'error': 'UpstreamTimeout', 'message': 'ドキュメントの取得の完了待ちがタイムアウトしました'}), 504
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': 'APIError', 'message': str(e)}), 500
+
+# 過去メッセージの取り込み（期間を分割して並行取得）
+MESSAGE_BACKFILL_MAX_WINDOWS = int(os.environ.get('MESSAGE_BACKFILL_MAX_WINDOWS', '16'))
+backfill_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('MESSAGE_BACKFILL_WORKERS', '4')),
+    thread_name_prefix='backfill'
+)
+
+@app.route('/api/messages/<chat_id>/backfill', methods=['POST'])
+def api_backfill_messages(chat_id):
+    """
+    指定期間の過去メッセージをインデックスに取り込むAPI
+    期間を windows 個に分割し、start_time / end_time を指定して並行に取得する
+    
+    Request body:
+    {
+        "start_time": 1700000000,  // 秒
+        "end_time": 1700600000,    // 秒（省略時は現在）
+        "windows": 8
+    }
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if message_index is None:
+        return jsonify({'error': 'ValidationError', 'message': 'backfill requires the message index (MESSAGE_INDEX=1)'}), 400
+    
+    data = request.json or {}
+    try:
+        start_time = int(data['start_time'])
+        end_time = int(data.get('end_time') or datetime.now().timestamp())
+        windows = min(int(data.get('windows', 8)), MESSAGE_BACKFILL_MAX_WINDOWS)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'ValidationError', 'message': 'start_time (seconds) is required'}), 400
+    if end_time < start_time:
+        return jsonify({'error': 'ValidationError', 'message': 'end_time must not be earlier than start_time'}), 400
+    
+    access_token, error = get_tenant_access_token()
+    if error:
+        return jsonify({'error': 'TokenError', 'message': error}), 401
+    
+    futures = {
+        backfill_executor.submit(fetch_message_window, chat_id, access_token, start, end, PAGINATION_MAX_PAGES): (start, end)
+        for start, end in split_windows(start_time, end_time, windows)
+    }
+    results = []
+    for future in as_completed(futures):
+        start, end = futures[future]
+        result = {'start_time': start, 'end_time': end}
+        try:
+            result['items'], result['complete'] = future.result()
+        except RateLimitExceeded as e:
+            result['error'] = {'error': 'RateLimited', 'message': str(e)}
+        except PageError as e:
+            result['error'] = e.body or {'error': 'PageError', 'message': str(e)}
+        except Exception as e:
+            result['error'] = {'error': 'APIError', 'message': str(e)}
+        results.append(result)
+    results.sort(key=lambda r: r['start_time'])
+    
+    return jsonify({
+        'chat_id': chat_id,
+        'items': sum(r.get('items', 0) for r in results),
+        'failed_windows': sum(1 for r in results if 'error' in r),
+        'windows': results
+    })
+
+# プロキシで上流へ転送するリクエストヘッダー
+PROXY_FORWARD_HEADERS = ('Content-Type', 'Accept', 'Accept-Encoding', 'Accept-Language', 'If-Modified-Since', 'Range')
+# キャッシュを経由するGETで上流へ渡し、キャッシュのキーに含めるヘッダー
+PROXY_VARY_HEADERS = ('Accept', 'Accept-Language')
+# これらのヘッダーがあるGETはキャッシュを経由しない
+PROXY_UNCACHED_HEADERS = ('Range', 'If-Modified-Since')
 
-@app.route('/api/lark/<path:endpoint>', methods=['GET', 'POST'])
+@app.route('/api/lark/<path:endpoint>', methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
 def api_lark_proxy(endpoint):
     """
     汎用Lark APIプロキシ
     任意のLark APIエンドポイントを呼び出し可能
+    一覧系のGETは ?all=true / ?max_items=N で全ページをまとめて取得できる
+    ステータス・ヘッダー・本文をデコードせずにチャンク単位で中継する（バイナリ・大きなレスポンスも可）
     """
     if not verify_api_key():
         return jsonify({'error': 'Unauthorized'}), 401
@@ -598,25 +2078,74 @@ def api_lark_proxy(endpoint):
     
     url = f"{LARK_API_BASE}/{endpoint}"
     
+    headers = {'Authorization': f'Bearer {access_token}'}
+    for name in PROXY_FORWARD_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    # クライアントが圧縮を受け付けない場合は非圧縮で受け取る（本文はそのまま中継するため）
+    headers.setdefault('Accept-Encoding', 'identity')
+    
+    # APIキーは上流へ渡さない
+    params = [(k, v) for k, v in request.args.items(multi=True) if k != 'api_key']
+    
+    if request.method == 'GET' and wants_all_pages():
+        return paginated_response(endpoint, access_token, [(k, v) for k, v in params if k not in PAGINATION_PARAMS])
+    
+    body = None
+    if request.content_length:
+        body = RequestBodyStream(request.stream, request.content_length)
+    elif request.method != 'GET':
+        # Content-Lengthのない（chunked）リクエストはまとめて読む
+        body = request.get_data() or None
+    if body is not None:
+        headers.setdefault('Content-Type', 'application/json')
+    
+    # キャッシュ対象のGET（一覧系の小さなレスポンス）はキャッシュ・同時リクエストの集約を経由
+    # 範囲・条件付きのリクエストはキャッシュせずにそのまま中継する
+    if request.method == 'GET' and not any(name in headers for name in PROXY_UNCACHED_HEADERS) \
+            and response_cache.ttl_for(endpoint) is not None:
+        forwarded = {name: headers[name] for name in PROXY_VARY_HEADERS if name in headers}
+        try:
+            return conditional_response(*lark_get(endpoint, access_token, params, headers=forwarded))
+        except RateLimitExceeded as e:
+            return rate_limited_response(e)
+        except requests.exceptions.Timeout as e:
+            return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
+        except Exception as e:
+            return jsonify({'error': 'APIError', 'message': str(e)}), 500
+    
     try:
-        if request.method == 'GET':
-            response = requests.get(
-                url,
-                headers={'Authorization': f'Bearer {access_token}'},
-                params=request.args
-            )
-        else:
-            response = requests.post(
-                url,
-                headers={
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/json'
-                },
-                json=request.json
-            )
-        return jsonify(response.json())
+        response = lark_http.request(
+            request.method,
+            url,
+            headers=headers,
+            params=params,
+            data=body,
+            stream=True,
+            credential='user'
+        )
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
+    
+    if request.method != 'GET' and response.status_code < 400:
+        # 書き込み系は同じリソースのキャッシュを無効化
+        response_cache.invalidate_path(endpoint)
+        if endpoint.startswith('task/'):
+            event_log.append('tasks', 'task', {'event_type': 'api.write', 'method': request.method, 'path': endpoint})
+            request_task_resync(current_user_id())
+        target = table_key_from_path(endpoint)
+        if target is not None:
+            request_bitable_resync(*target)
+    
+    return Response(
+        stream_with_context(iter_raw(response)),
+        status=response.status_code,
+        headers=relay_headers(response)
+    )
 
 @app.route('/api/send_message/<chat_id>', methods=['POST'])
 def api_send_message(chat_id):
@@ -644,20 +2173,12 @@ def api_send_message(chat_id):
         return jsonify({'error': 'ValidationError', 'message': 'text is required'}), 400
     
     try:
-        response = requests.post(
-            f"{LARK_API_BASE}/im/v1/messages",
-            headers={
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            },
-            params={'receive_id_type': 'chat_id'},
-            json={
-                'receive_id': chat_id,
-                'msg_type': 'text',
-                'content': json.dumps({'text': text})
-            }
-        )
+        response = send_chat_message(access_token, chat_id, 'text', json.dumps({'text': text}))
         return jsonify(response.json())
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
 
@@ -686,7 +2207,7 @@ def api_reply_message(message_id):
         return jsonify({'error': 'ValidationError', 'message': 'text is required'}), 400
     
     try:
-        response = requests.post(
+        response = lark_http.post(
             f"{LARK_API_BASE}/im/v1/messages/{message_id}/reply",
             headers={
                 'Authorization': f'Bearer {access_token}',
@@ -695,9 +2216,17 @@ def api_reply_message(message_id):
             json={
                 'msg_type': 'text',
                 'content': json.dumps({'text': text})
-            }
+            },
+            credential='tenant'
         )
+        # 返信先のチャットは分からないため、メッセージ一覧のキャッシュ全体を無効化
+        response_cache.invalidate_path('im/v1/messages')
+        index_sent_message(response)
         return jsonify(response.json())
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
 
@@ -705,6 +2234,7 @@ def api_reply_message(message_id):
 def api_get_bot_chats():
     """
     ボットが参加しているチャット一覧を取得
+    ?all=true / ?max_items=N で全ページをまとめて取得（?format=ndjson で1行1件）
     """
     if not verify_api_key():
         return jsonify({'error': 'Unauthorized'}), 401
@@ -713,6 +2243,9 @@ def api_get_bot_chats():
     if error:
         return jsonify({'error': 'TokenError', 'message': error}), 401
     
+    if wants_all_pages():
+        return paginated_response('im/v1/chats', access_token, {'page_size': request.args.get('page_size', '100')}.items(), credential='tenant')
+    
     page_size = request.args.get('page_size', '50')
     page_token = request.args.get('page_token', '')
     
@@ -721,22 +2254,378 @@ def api_get_bot_chats():
         if page_token:
             params['page_token'] = page_token
             
-        response = requests.get(
-            f"{LARK_API_BASE}/im/v1/chats",
-            headers={'Authorization': f'Bearer {access_token}'},
-            params=params
-        )
-        return jsonify(response.json())
+        status, headers, body, etag = lark_get('im/v1/chats', access_token, params, credential='tenant')
+        return conditional_response(status, headers, body, etag)
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except requests.exceptions.Timeout as e:
+        return jsonify({'error': 'UpstreamTimeout', 'message': str(e)}), 504
     except Exception as e:
         return jsonify({'error': 'APIError', 'message': str(e)}), 500
 
+# バッチ実行の設定
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '50'))
+BATCH_EXCLUDED_PATHS = {'/api/batch', '/api/stream'}
+# 全バッチで共有するワーカー（同時に実行するサブリクエスト数の上限）
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BATCH_MAX_WORKERS', '8')),
+    thread_name_prefix='batch'
+)
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """
+    複数のAPI呼び出しを1回のリクエストでまとめて実行
+    サブリクエストは並行して実行し、各結果のステータスと本文を返す
+    
+    Request body:
+    {
+        "requests": [
+            {"id": "tasks", "path": "/api/tasks"},
+            {"id": "msgs", "path": "/api/messages/oc_xxx", "query": {"page_size": 20}},
+            {"id": "doc", "method": "POST", "path": "/api/lark/...", "body": {...}}
+        ],
+        "stream": false
+    }
+    "stream": true（または ?stream=1）で、完了した順にNDJSONで返す
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    payload = request.get_json(silent=True)
+    try:
+        items = parse_batch(payload, BATCH_MAX_REQUESTS, BATCH_EXCLUDED_PATHS)
+    except BatchValidationError as e:
+        return jsonify({'error': 'ValidationError', 'message': str(e)}), 400
+    
+    # トークンは先に1回だけ確認し、サブリクエストは確認済みのトークンを読むだけにする
+    get_valid_access_token()
+    get_tenant_access_token()
+    
+    # サブリクエストも同じAPIキーで実行
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        auth_header = f"Bearer {request.args.get('api_key', '')}"
+    headers = {'Authorization': auth_header}
+    
+    futures = [batch_executor.submit(execute_subrequest, app, item, headers) for item in items]
+    
+    stream = request.args.get('stream', '').lower() in ('1', 'true') or \
+        (isinstance(payload, dict) and payload.get('stream') is True)
+    if stream:
+        def generate():
+            for future in as_completed(futures):
+                yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+    
+    return jsonify({'responses': [future.result() for future in futures]})
+
+# 一斉送信の設定
+BROADCAST_MAX_CHATS = int(os.environ.get('BROADCAST_MAX_CHATS', '1000'))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS', '3'))
+broadcast_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BROADCAST_MAX_WORKERS', '10')),
+    thread_name_prefix='broadcast'
+)
+
+def list_bot_chat_ids(access_token):
+    """ボットが参加している全チャットのIDを取得"""
+    def fetch_page(page_token):
+        params = [('page_size', '100')] + ([('page_token', page_token)] if page_token else [])
+        status, _, body, _ = lark_get('im/v1/chats', access_token, params, credential='tenant')
+        return parse_page(status, body)
+    return [item['chat_id'] for item in Paginator(fetch_page, max_pages=PAGINATION_MAX_PAGES) if item.get('chat_id')]
+
+@app.route('/api/broadcast', methods=['POST'])
+def api_broadcast():
+    """
+    複数のチャットに同じメッセージを一斉送信するAPI
+    並行して送信し（レート制限の範囲内）、チャットごとの配信結果を返す
+    
+    Request body:
+    {
+        "chat_ids": ["oc_xxx", ...],   // "all" でボットが参加している全チャット
+        "text": "送信するテキスト",      // または "card": {...}（メッセージカード）
+        "broadcast_id": "任意"          // 再送時に同じ値を指定すると、送信済みのチャットに重複送信しない
+    }
+    "stream": true（または ?stream=1）で、完了した順にNDJSONで返す
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    # Tenant Access Tokenを使用（ボットとしてメッセージ送信）
+    access_token, error = get_tenant_access_token()
+    if error:
+        return jsonify({'error': 'TokenError', 'message': error}), 401
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        msg_type, content = build_message(data)
+    except BroadcastValidationError as e:
+        return jsonify({'error': 'ValidationError', 'message': str(e)}), 400
+    
+    chat_ids = data.get('chat_ids')
+    if chat_ids == 'all':
+        try:
+            chat_ids = list_bot_chat_ids(access_token)
+        except PageError as e:
+            return jsonify(e.body or {'error': 'PageError', 'message': str(e)}), 502
+        except RateLimitExceeded as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            return jsonify({'error': 'APIError', 'message': str(e)}), 500
+    if not isinstance(chat_ids, list) or not chat_ids or not all(isinstance(c, str) and c for c in chat_ids):
+        return jsonify({'error': 'ValidationError', 'message': 'chat_ids must be a non-empty array of chat IDs or "all"'}), 400
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if len(chat_ids) > BROADCAST_MAX_CHATS:
+        return jsonify({'error': 'ValidationError', 'message': f'too many chats (max {BROADCAST_MAX_CHATS})'}), 400
+    
+    base_id = broadcast_id(data)
+    
+    def send(chat_id):
+        # 長時間の一斉送信でも有効なトークンを使う（通常はメモリから読むだけ）
+        token, token_error = get_tenant_access_token()
+        if token_error:
+            raise requests.exceptions.RequestException(token_error)
+        return send_chat_message(token, chat_id, msg_type, content, message_uuid(base_id, chat_id))
+    
+    futures = [broadcast_executor.submit(deliver, send, chat_id, BROADCAST_MAX_ATTEMPTS) for chat_id in chat_ids]
+    
+    stream = request.args.get('stream', '').lower() in ('1', 'true') or data.get('stream') is True
+    if stream:
+        def generate():
+            for future in as_completed(futures):
+                yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+    
+    results = [future.result() for future in futures]
+    return jsonify({
+        'broadcast_id': base_id,
+        'summary': summarize(results),
+        'results': results
+    })
+
+# ========================================
+# 新着の配信（SSE / ロングポーリング）
+# ========================================
+
+# SSEの接続維持用コメントを送る間隔（秒）と、1接続を保持する上限（秒、超えたらクライアントが再接続）
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', '15'))
+STREAM_MAX_DURATION = float(os.environ.get('STREAM_MAX_DURATION', '3600'))
+STREAM_POLL_MAX_WAIT = 60
+
+def stream_topic_filter():
+    """?chats=oc_1,oc_2（* で全チャット）&tasks=1 から購読対象の判定関数を作る"""
+    chats = {chat for chat in request.args.get('chats', '').split(',') if chat}
+    tasks = request.args.get('tasks', '').lower() in ('1', 'true', 'yes')
+    if not chats and not tasks:
+        return None
+    topics = {f'chat:{chat}' for chat in chats}
+    if tasks:
+        topics.add('tasks')
+    if '*' in chats:
+        return lambda topic: topic in topics or topic.startswith('chat:')
+    return lambda topic: topic in topics
+
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """
+    新着メッセージ・タスク変更を配信するAPI
+    - 既定はSSE（event: message / task、id を Last-Event-ID に渡すと続きから再開）
+    - ?format=json はロングポーリング（イベントが届くか ?timeout= 秒たつまで待って返す）
+    ?chats=oc_1,oc_2&tasks=1
+    """
+    if not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    match = stream_topic_filter()
+    if match is None:
+        return jsonify({'error': 'ValidationError', 'message': 'chats or tasks=1 is required'}), 400
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '')
+    if last_event_id and not last_event_id.isdigit():
+        return jsonify({'error': 'ValidationError', 'message': 'Last-Event-ID must be an integer'}), 400
+    after = int(last_event_id) if last_event_id else event_log.last_id()
+    # 保持期間を過ぎたイベントは失われているため、クライアントに取り直しを促す
+    oldest = event_log.oldest_id()
+    reset = bool(last_event_id) and oldest is not None and after + 1 < oldest
+    
+    if request.args.get('format') == 'json':
+        timeout = min(request.args.get('timeout', 25, type=float), STREAM_POLL_MAX_WAIT)
+        deadline = time.monotonic() + timeout
+        with event_log.subscribe():
+            events, after = event_log.read(after, match)
+            while not events and time.monotonic() < deadline:
+                if event_log.wait(after, deadline - time.monotonic()):
+                    events, after = event_log.read(after, match)
+        return jsonify({'events': events, 'last_event_id': after, 'reset': reset})
+    
+    def generate(after):
+        with event_log.subscribe():
+            yield 'retry: 3000\n\n'
+            if reset:
+                yield 'event: reset\ndata: {}\n\n'
+            deadline = time.monotonic() + STREAM_MAX_DURATION
+            while time.monotonic() < deadline:
+                events, after = event_log.read(after, match)
+                for event in events:
+                    yield format_sse(event)
+                if not events and not event_log.wait(after, STREAM_HEARTBEAT):
+                    yield ': keepalive\n\n'
+    
+    return Response(
+        stream_with_context(generate(after)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# ========================================
+# イベント購読（Webhook）
+# ========================================
+
+def handle_event(payload):
+    """受信したイベントをメッセージインデックス・タスクとBitableのミラーに反映し、/api/stream の購読者へ配信"""
+    kind = event_type(payload)
+    event = payload.get('event') or {}
+    if kind.startswith('task.'):
+        response_cache.invalidate_path('task/v2/tasks')
+        event_log.append('tasks', 'task', dict(event, event_type=kind))
+        # どのユーザーのタスクかはイベントからは決まらないため、ミラーのある全ユーザーを取り直す
+        request_task_resync()
+    elif kind.startswith('drive.file.bitable_'):
+        handle_bitable_event(kind, event)
+    elif message_index is None:
+        return
+    elif kind == 'im.message.receive_v1':
+        item = message_item(event)
+        publish_messages(message_index.upsert([item]))
+        message_index.note_event(item['chat_id'])
+        # 一覧キャッシュは上流の内容なので無効化しておく
+        response_cache.invalidate_path('im/v1/messages', item['chat_id'])
+    elif kind == 'im.message.recalled_v1':
+        item = message_index.mark_recalled(event.get('message_id', ''))
+        if item is not None:
+            publish_messages([item])
+        if event.get('chat_id'):
+            message_index.note_event(event['chat_id'])
+            response_cache.invalidate_path('im/v1/messages', event['chat_id'])
+    elif kind in ('im.chat.member.bot.deleted_v1', 'im.chat.disbanded_v1'):
+        if event.get('chat_id'):
+            message_index.invalidate_chat(event['chat_id'])
+
+def handle_bitable_event(kind, event):
+    """
+    drive.file.bitable_record_changed_v1: 削除されたレコードはその場でミラーから除き、追加・更新があれば取り直す
+    drive.file.bitable_field_changed_v1: 項目の変更は更新日時からわからないため、全件を取り直す
+    """
+    key = mirrored_bitable_key(event.get('file_token', ''), event.get('table_id', ''))
+    if key is None:
+        return
+    if kind == 'drive.file.bitable_field_changed_v1':
+        request_bitable_resync(key, full=True)
+        return
+    actions = event.get('action_list') or []
+    deleted = [action['record_id'] for action in actions
+               if action.get('action') == 'record_deleted' and action.get('record_id')]
+    if deleted:
+        bitable_mirror.delete_records(key, deleted)
+    if len(deleted) < len(actions):
+        request_bitable_resync(key)
+
+@app.route('/webhook/event', methods=['POST'])
+def webhook_event():
+    """
+    Larkのイベント購読の受信口（開発者コンソールのリクエストURLに設定）
+    im.message.receive_v1 / im.message.recalled_v1 などをメッセージインデックスに取り込む
+    task.* のイベントは /api/stream の購読者へそのまま配信し、タスクのミラーをバックグラウンドで取り直す
+    drive.file.bitable_*（Baseのファイルごとに購読が必要）はBitableのミラーに反映する
+    """
+    try:
+        payload = parse_event(request.get_data(), request.headers, LARK_VERIFICATION_TOKEN, LARK_ENCRYPT_KEY)
+    except EventVerificationError as e:
+        return jsonify({'error': 'EventVerificationError', 'message': str(e)}), 401
+    
+    if event_type(payload) == 'url_verification':
+        return jsonify({'challenge': payload.get('challenge', '')})
+    
+    # Larkは3秒以内に応答がないと再送するため、重複はイベントIDで除く
+    if message_index is not None and not message_index.claim_event(event_id(payload)):
+        return jsonify({'code': 0})
+    try:
+        handle_event(payload)
+    except Exception as e:
+        if message_index is not None:
+            message_index.release_event(event_id(payload))
+        return jsonify({'error': 'EventError', 'message': str(e)}), 500
+    return jsonify({'code': 0})
+
+# ========================================
+# メトリクス
+# ========================================
+
+def _component_metrics():
+    """キャッシュ・集約・コネクションプール・配信の統計を書き出し時に取り込む"""
+    samples = []
+    cache = response_cache.stats()
+    for name in ('hits', 'misses', 'evictions', 'invalidations', 'not_modified'):
+        samples.append(('counter', f'lark_oauth_cache_{name}_total', {}, cache[name]))
+    samples.append(('gauge', 'lark_oauth_cache_entries', {}, cache['entries']))
+    samples.append(('gauge', 'lark_oauth_cache_bytes', {}, cache['bytes']))
+    for flight_name, flight in (('get', get_flight), ('refresh', refresh_flight), ('message_sync', message_sync_flight)):
+        samples.append(('counter', 'lark_oauth_coalescing_leaders_total', {'flight': flight_name}, flight.stats['leaders']))
+        samples.append(('counter', 'lark_oauth_coalescing_shared_total', {'flight': flight_name}, flight.stats['shared']))
+        samples.append(('counter', 'lark_oauth_coalescing_timeouts_total', {'flight': flight_name}, flight.stats['timeouts']))
+    pool = lark_http.stats()
+    samples.append(('counter', 'lark_oauth_upstream_pool_requests_total', {}, pool['requests']))
+    samples.append(('counter', 'lark_oauth_upstream_new_connections_total', {}, pool['new_connections']))
+    samples.append(('counter', 'lark_oauth_upstream_reused_connections_total', {}, pool['reused_connections']))
+    samples.append(('gauge', 'lark_oauth_upstream_in_flight', {}, pool['in_flight']))
+    samples.append(('gauge', 'lark_oauth_upstream_peak_in_flight', {}, pool['peak_in_flight']))
+    samples.append(('gauge', 'lark_oauth_upstream_pool_size', {}, pool['pool_size']))
+    samples.append(('gauge', 'lark_oauth_stream_subscribers', {}, event_log.stats()['subscribers']))
+    return samples
+
+for _name in ('hits', 'misses', 'evictions', 'invalidations', 'not_modified'):
+    metrics.counter(f'lark_oauth_cache_{_name}_total', f'Response cache {_name.replace("_", " ")}.')
+metrics.gauge('lark_oauth_cache_entries', 'Entries in the response cache.')
+metrics.gauge('lark_oauth_cache_bytes', 'Bytes held by the response cache.')
+metrics.ratio('lark_oauth_cache_hit_ratio', 'Response cache hits / lookups.',
+              'lark_oauth_cache_hits_total', ['lark_oauth_cache_hits_total', 'lark_oauth_cache_misses_total'])
+metrics.counter('lark_oauth_coalescing_leaders_total', 'Calls that ran the work themselves (single-flight leaders).')
+metrics.counter('lark_oauth_coalescing_shared_total', 'Calls that shared the result of a concurrent identical call.')
+metrics.counter('lark_oauth_coalescing_timeouts_total', 'Calls that gave up waiting for a concurrent identical call.')
+metrics.ratio('lark_oauth_coalescing_ratio', 'Shared calls / all calls, by single-flight group.',
+              'lark_oauth_coalescing_shared_total',
+              ['lark_oauth_coalescing_leaders_total', 'lark_oauth_coalescing_shared_total'])
+metrics.counter('lark_oauth_upstream_pool_requests_total', 'Requests sent through the upstream connection pool.')
+metrics.counter('lark_oauth_upstream_new_connections_total', 'New upstream connections (TCP + TLS handshakes).')
+metrics.counter('lark_oauth_upstream_reused_connections_total', 'Upstream requests that reused a pooled connection.')
+metrics.ratio('lark_oauth_upstream_pool_hit_ratio', 'Upstream requests that reused a pooled connection / all.',
+              'lark_oauth_upstream_reused_connections_total', ['lark_oauth_upstream_pool_requests_total'])
+metrics.gauge('lark_oauth_upstream_in_flight', 'Lark API calls currently in progress.')
+metrics.gauge('lark_oauth_upstream_peak_in_flight', 'Highest number of concurrent Lark API calls per worker, summed.')
+metrics.gauge('lark_oauth_upstream_pool_size', 'Upstream keep-alive connections kept per host, summed over workers.')
+metrics.gauge('lark_oauth_stream_subscribers', 'Open /api/stream connections.')
+metrics.add_collector(_component_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus形式のメトリクス（全ワーカーの合計）"""
+    if METRICS_REQUIRE_AUTH and not verify_api_key():
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not metrics.enabled:
+        return jsonify({'error': 'MetricsDisabled', 'message': 'METRICS=0 で無効になっています'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health')
 def health():
     """ヘルスチェック"""
+    default_user = token_vault.get(token_vault.default_open_id) if token_vault.default_open_id else None
     return jsonify({
         'status': 'ok',
-        'authenticated': bool(token_store.get('refresh_token')),
-        'updated_at': token_store.get('updated_at', '')
+        'authenticated': default_user is not None and default_user.can_refresh(),
+        'updated_at': default_user.public()['updated_at'] if default_user is not None else '',
+        'refresher': token_refresher.state()
     })
 
 if __name__ == '__main__':
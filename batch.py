@@ -0,0 +1,77 @@
+"""
+バッチ実行
+- 既存の /api/* ルートと同じ形のサブリクエストを、1回のHTTPリクエストでまとめて実行する
+- サブリクエストはアプリ内で直接ディスパッチする（HTTPの往復・APIキー検証の通信なし）
+"""
+
+import json
+import time
+import base64
+from urllib.parse import urlsplit
+
+
+class BatchValidationError(Exception):
+    """バッチの内容が不正"""
+
+
+def parse_batch(payload, max_requests, excluded_paths):
+    """
+    リクエストボディからサブリクエストの一覧を取り出す
+    {"requests": [{"id": "...", "method": "GET", "path": "/api/tasks", "query": {...}, "body": {...}}]}
+    または配列そのものを受け付ける
+    """
+    items = payload.get('requests') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise BatchValidationError('requests must be a non-empty array')
+    if len(items) > max_requests:
+        raise BatchValidationError(f'too many requests (max {max_requests})')
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise BatchValidationError(f'requests[{index}].path is required')
+        path = urlsplit(item['path']).path
+        if not path.startswith('/api/') or path.rstrip('/') in excluded_paths:
+            raise BatchValidationError(f'requests[{index}].path is not allowed: {path}')
+        parsed.append({
+            'id': item.get('id', index),
+            'method': str(item.get('method', 'GET')).upper(),
+            'path': item['path'],
+            'query': item.get('query') or {},
+            'body': item.get('body')
+        })
+    return parsed
+
+
+def encode_response_body(response):
+    """サブリクエストのレスポンス本文をJSONに埋め込める形にする"""
+    data = response.get_data()
+    if response.is_json:
+        try:
+            return {'body': json.loads(data)}
+        except ValueError:
+            pass
+    if (response.mimetype or '').startswith('text/') or response.mimetype == 'application/x-ndjson':
+        return {'body': data.decode(response.mimetype_params.get('charset', 'utf-8'), errors='replace')}
+    return {'body': base64.b64encode(data).decode(), 'body_encoding': 'base64'}
+
+
+def execute_subrequest(app, item, headers):
+    """アプリ内でサブリクエストを実行し、結果を返す"""
+    started = time.monotonic()
+    try:
+        with app.test_request_context(
+            item['path'],
+            method=item['method'],
+            query_string=item['query'],
+            json=item['body'] if item['body'] is not None else None,
+            headers=headers
+        ):
+            response = app.make_response(app.full_dispatch_request())
+            result = {'id': item['id'], 'status': response.status_code}
+            result.update(encode_response_body(response))
+            response.close()
+    except Exception as e:
+        result = {'id': item['id'], 'status': 500, 'body': {'error': 'BatchError', 'message': str(e)}}
+    result['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+    return result
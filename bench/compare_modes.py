@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+同期ワーカーとasync（gevent）ワーカーの比較ベンチマーク
+
+ローカルのLarkスタブ（lark_stub.py、応答に --latency 秒かかる）に対して、同じ設定のgunicornを
+SERVER_MODE=sync / async で順に起動し、/api/lark/... へ --concurrency 並列でリクエストを送る。
+実際のLark APIには接続しない。
+
+    python bench/compare_modes.py --concurrency 200 --requests 2000 --latency 0.2
+"""
+
+import os
+import argparse
+import tempfile
+
+import requests
+
+from lark_stub import LarkStub, StubConfig
+from loadtest import SCENARIOS, start_app, run_load, summarize
+
+
+def measure(mode, args, data_dir):
+    # 初期Refresh Tokenは1回しか使えないため、モードごとに新しいスタブを使う
+    stub_server = LarkStub(StubConfig(latency=args.latency)).serve()
+    stub_url = f'http://127.0.0.1:{stub_server.server_port}'
+    process, base = start_app(stub_url, mode, args.workers, data_dir=data_dir, extra_env={'RESPONSE_CACHE': '0'})
+    try:
+        # トークン取得を済ませてから計測する
+        requests.get(f'{base}/api/lark/bench/warmup', headers={'Authorization': 'Bearer bench-key'}, timeout=60)
+        results, elapsed = run_load(base, SCENARIOS['proxy'], args.concurrency, total=args.requests)
+        status = requests.get(f'{base}/api/status', headers={'Authorization': 'Bearer bench-key'}, timeout=10).json()
+    finally:
+        process.terminate()
+        process.wait()
+        stub_server.shutdown()
+    result = summarize(results, elapsed)['TOTAL']
+    result['peak_upstream_in_flight'] = status['upstream'].get('peak_in_flight')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.2, help='スタブの応答にかける秒数')
+    parser.add_argument('--workers', type=int, default=1, help='gunicornのワーカー数')
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for mode in args.modes.split(','):
+            os.makedirs(os.path.join(data_dir, mode))
+            results[mode] = measure(mode, args, os.path.join(data_dir, mode))
+
+    print(f"upstream latency={args.latency}s concurrency={args.concurrency} "
+          f"requests={args.requests} workers={args.workers}")
+    columns = ['rps', 'requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_upstream_in_flight']
+    print(f"{'mode':<8}" + ''.join(f"{c:>{len(c) + 2}}" for c in columns))
+    for mode, result in results.items():
+        print(f"{mode:<8}" + ''.join(f"{result[c]:>{len(c) + 2}}" for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+計測用のLark APIスタブ（実際のLarkには接続しない）
+
+このサーバーが使うエンドポイントを最小限の動作で返す:
+- POST authen/v2/oauth/token                    : User Access Token（Refresh Tokenは毎回差し替え、code=X なら open_id は ou_X）
+- GET  authen/v1/user_info                      : トークンの持ち主（open_id）
+- POST auth/v3/tenant_access_token/internal     : Tenant Access Token
+- GET  task/v2/tasks, task/v2/tasks/<id>        : タスク一覧（ページング）・詳細
+- POST task/v2/tasks                            : タスクの作成（同じ client_token の再送は作成済みのタスクを返す）
+- PATCH/DELETE task/v2/tasks/<id>               : タスクの更新（update_fields の項目、updated_at が進む）・削除
+- GET  im/v1/chats                              : チャット一覧（ページング）
+- GET  docx/v1/documents/<id>(/blocks)           : ドキュメントのメタデータ（revision_id）・ブロック（ページング）
+  docx/v1/documents/<id>/... への書き込みは revision_id を進める
+- POST bitable/v1/apps/<app>/tables/<table>/records/search: レコード（ページング、「更新日時」の isGreater で絞り込み）
+  POST .../records・PUT/DELETE .../records/<id> で作成・更新・削除（last_modified_time が進む）
+- GET  contact/v3/users/batch, departments/batch: ユーザー・部署（ou_ で始まるIDのユーザーと、その部署 od-N）
+- GET  im/v1/messages                           : メッセージ一覧（ページング・期間指定・並び順）
+- POST im/v1/messages, im/v1/messages/<id>/reply: 送信・返信
+- それ以外                                      : リクエスト内容をそのまま返す（echo）
+
+遅延・エラー率・429の発生率・トークンの有効期限を設定できる。
+GET /_stub/stats でルートごとの呼び出し回数、POST /_stub/reset で回数をリセット。
+
+    python bench/lark_stub.py --port 9000 --latency 0.05 --error-rate 0.01 --rate-limit-rate 0.01
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from dataclasses import dataclass
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Larkのエラーコード
+CODE_INVALID_ACCESS_TOKEN = 99991663
+CODE_INVALID_REFRESH_TOKEN = 20064
+CODE_RATE_LIMITED = 99991400
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.0          # 1リクエストあたりの応答時間（秒）
+    jitter: float = 0.0           # 応答時間に加えるランダムな揺らぎ（秒）
+    error_rate: float = 0.0       # 500を返す割合
+    rate_limit_rate: float = 0.0  # 429（code 99991400）を返す割合
+    token_ttl: int = 7200         # 発行するトークンの有効期限（秒）
+    tasks: int = 200
+    document_blocks: int = 1200   # ドキュメントあたりのブロック数
+    bitable_records: int = 3000   # Bitableのテーブルあたりのレコード数
+    chats: int = 50
+    messages_per_chat: int = 200
+
+
+def route_name(method, path):
+    """呼び出し回数の集計に使うルート名（IDの部分は :id にまとめる）"""
+    parts = path.split('/open-apis/', 1)[-1].strip('/').split('/')
+    if parts[:3] in (['task', 'v2', 'tasks'], ['docx', 'v1', 'documents']) and len(parts) > 3:
+        parts = parts[:3] + [':id'] + parts[4:]
+    elif parts[:3] == ['bitable', 'v1', 'apps'] and len(parts) > 6:
+        parts = parts[:3] + [':app', 'tables', ':table', parts[6]] + [p if p == 'search' else ':id' for p in parts[7:8]]
+    elif parts[:3] == ['im', 'v1', 'messages'] and len(parts) > 3:
+        parts = parts[:3] + [':id'] + parts[4:]
+    elif parts[:2] not in (['task', 'v2'], ['im', 'v1'], ['authen', 'v2'], ['auth', 'v3']) and len(parts) > 2:
+        parts = parts[:2] + ['*']
+    return f"{method} {'/'.join(parts)}"
+
+
+class LarkStub:
+    """スタブの状態（発行済みトークン・データ・呼び出し回数）"""
+
+    def __init__(self, config=None):
+        self.config = config or StubConfig()
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.access_tokens = {}  # token -> 有効期限
+        self.refresh_tokens = {'r-initial': 'ou_initial'}  # token -> open_id
+        self.token_users = {}  # User Access Token -> open_id
+        self.client_tokens = {}  # タスク作成の client_token -> guid
+        self.documents = {}  # document_id -> {'revision_id', 'blocks'}（初めて参照したときに作る）
+        self.bitable_tables = {}  # (app_token, table_id) -> レコードの一覧（初めて参照したときに作る）
+        self.counter = 0
+        now = int(time.time())
+        self.tasks = [self._task(i, now) for i in range(self.config.tasks)]
+        self.chat_ids = [f'oc_{i:05d}' for i in range(self.config.chats)]
+        self.messages = {
+            chat_id: [
+                self._message(chat_id, f'om_{chat_id}_{j:05d}', (now - (self.config.messages_per_chat - j) * 60) * 1000, f'message {j}')
+                for j in range(self.config.messages_per_chat)
+            ]
+            for chat_id in self.chat_ids
+        }
+
+    @staticmethod
+    def _task(i, now):
+        """task/v2 と同じ形のタスク（担当者・期限・タスクリストは番号から決める）"""
+        done = i % 4 == 0
+        updated_at = (now - (i % 100) * 3600) * 1000
+        return {
+            'guid': f'task-{i:05d}', 'summary': f'Task {i}', 'status': 'done' if done else 'todo',
+            'completed_at': str(updated_at) if done else '0',
+            'due': {'timestamp': str((now + (i % 30 - 10) * 86400) * 1000), 'is_all_day': True} if i % 3 else None,
+            'members': [{'id': f'ou_member{i % 5}', 'type': 'user', 'role': 'assignee'}],
+            'tasklists': [{'tasklist_guid': f'tasklist-{i % 3}', 'section_guid': ''}],
+            'created_at': str(updated_at), 'updated_at': str(updated_at)
+        }
+
+    @staticmethod
+    def _message(chat_id, message_id, create_time, text):
+        return {
+            'message_id': message_id, 'root_id': '', 'parent_id': '', 'msg_type': 'text',
+            'create_time': str(create_time), 'update_time': str(create_time), 'deleted': False, 'updated': False,
+            'chat_id': chat_id, 'sender': {'id': 'cli_stub', 'id_type': 'app_id', 'sender_type': 'app', 'tenant_key': 'stub'},
+            'body': {'content': json.dumps({'text': text})}, 'mentions': []
+        }
+
+    def document(self, document_id):
+        with self.lock:
+            if document_id not in self.documents:
+                blocks = [{'block_id': f'{document_id}-{i}', 'block_type': 4 if i % 20 == 0 else 2, 'parent_id': document_id,
+                           'heading2' if i % 20 == 0 else 'text': {'elements': [{'text_run': {'content': f'Paragraph {i}'}}]}}
+                          for i in range(1, self.config.document_blocks)]
+                root = {'block_id': document_id, 'block_type': 1, 'children': [b['block_id'] for b in blocks],
+                        'page': {'elements': [{'text_run': {'content': f'Document {document_id}'}}]}}
+                self.documents[document_id] = {'revision_id': 1, 'blocks': [root] + blocks}
+            return self.documents[document_id]
+
+    @staticmethod
+    def _record(record_id, fields, created_time, modified_time):
+        """records/search（automatic_fields）と同じ形のレコード。「更新日時」は last_modified_time と同じ値"""
+        return {'record_id': record_id, 'fields': dict(fields, 更新日時=modified_time),
+                'created_time': created_time, 'last_modified_time': modified_time}
+
+    def bitable_table(self, app_token, table_id):
+        with self.lock:
+            if (app_token, table_id) not in self.bitable_tables:
+                now = int(time.time())
+                self.bitable_tables[(app_token, table_id)] = [
+                    self._record(f'rec{i:06d}', {
+                        '名前': [{'text': f'案件 {i}', 'type': 'text'}], '金額': (i % 50) * 1000,
+                        '状態': ('未着手', '進行中', '完了')[i % 3], 'タグ': ['A', 'B', 'C'][:i % 3 + 1],
+                        '担当者': [{'id': f'ou_member{i % 5}', 'name': f'User {i % 5}'}]
+                    }, (now - 30 * 86400 + i) * 1000, (now - (i % 500) * 60) * 1000)
+                    for i in range(self.config.bitable_records)
+                ]
+            return self.bitable_tables[(app_token, table_id)]
+
+    def _next(self, prefix):
+        with self.lock:
+            self.counter += 1
+            return f'{prefix}-{self.counter}'
+
+    def issue_access_token(self, prefix, open_id=None):
+        token = self._next(prefix)
+        with self.lock:
+            self.access_tokens[token] = time.time() + self.config.token_ttl
+            if open_id:
+                self.token_users[token] = open_id
+        return token
+
+    def token_valid(self, authorization):
+        token = authorization[7:] if authorization.startswith('Bearer ') else ''
+        with self.lock:
+            return self.access_tokens.get(token, 0) > time.time()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def serve(self, host='127.0.0.1', port=0):
+        """別スレッドで起動し、サーバーを返す（server.server_port でポートを取得）"""
+        stub = self
+
+        class Handler(_Handler):
+            pass
+        Handler.stub = stub
+        server = _Server((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='lark-stub', daemon=True).start()
+        return server
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def _page(items, query, default_size=20):
+    size = int(query.get('page_size', default_size))
+    offset = int(query.get('page_token') or 0)
+    page = items[offset:offset + size]
+    has_more = offset + size < len(items)
+    return {'items': page, 'has_more': has_more, 'page_token': str(offset + size) if has_more else ''}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, status=200, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            body = {k: v[-1] for k, v in parse_qs(raw.decode()).items()}
+        else:
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {'raw': raw.decode('utf-8', 'replace')}
+
+        if url.path.startswith('/_stub/'):
+            if url.path == '/_stub/reset':
+                self.stub.reset()
+            return self._reply(self.stub.stats())
+
+        stub, config = self.stub, self.stub.config
+        with stub.lock:
+            stub.calls[route_name(self.command, url.path)] += 1
+        if config.latency or config.jitter:
+            time.sleep(config.latency + random.uniform(0, config.jitter))
+        if config.rate_limit_rate and random.random() < config.rate_limit_rate:
+            return self._reply({'code': CODE_RATE_LIMITED, 'msg': 'request trigger frequency limit'}, 429,
+                               [('x-ogw-ratelimit-limit', '50'), ('x-ogw-ratelimit-reset', '1')])
+        if config.error_rate and random.random() < config.error_rate:
+            return self._reply({'code': 1, 'msg': 'internal error (stub)'}, 500)
+
+        path = url.path.split('/open-apis/', 1)[-1].strip('/')
+        parts = path.split('/')
+
+        if path == 'authen/v2/oauth/token':
+            return self._oauth_token(body)
+        if path == 'auth/v3/tenant_access_token/internal':
+            return self._reply({'code': 0, 'msg': 'ok', 'tenant_access_token': stub.issue_access_token('t'),
+                                'expire': config.token_ttl})
+
+        if not stub.token_valid(self.headers.get('Authorization', '')):
+            return self._reply({'code': CODE_INVALID_ACCESS_TOKEN, 'msg': 'Invalid access token for authorization.'}, 400)
+
+        if path == 'authen/v1/user_info':
+            token = self.headers.get('Authorization', '')[7:]
+            with stub.lock:
+                open_id = stub.token_users.get(token)
+            return self._ok({'open_id': open_id, 'name': open_id}) if open_id else \
+                self._reply({'code': CODE_INVALID_ACCESS_TOKEN, 'msg': 'not a user access token'}, 400)
+        if parts[:3] == ['task', 'v2', 'tasks'] and self.command == 'GET':
+            if len(parts) == 3:
+                return self._ok(_page(stub.tasks, query, 50))
+            task = next((t for t in stub.tasks if t['guid'] == parts[3]), None)
+            if task is None:
+                return self._reply({'code': 1470404, 'msg': 'task not found'}, 404)
+            return self._ok({'task': task})
+        if path == 'task/v2/tasks' and self.command == 'POST':
+            return self._create_task(body)
+        if parts[:3] == ['task', 'v2', 'tasks'] and len(parts) == 4 and self.command in ('PATCH', 'DELETE'):
+            return self._update_task(parts[3], body)
+        if path == 'contact/v3/users/batch' and self.command == 'GET':
+            return self._ok({'items': [
+                {'open_id': open_id, 'name': f'User {open_id}', 'department_ids': [f'od-{sum(map(ord, open_id)) % 3}']}
+                for open_id in self._query_list('user_ids') if open_id.startswith('ou_')
+            ]})
+        if path == 'contact/v3/departments/batch' and self.command == 'GET':
+            return self._ok({'items': [
+                {'open_department_id': department_id, 'name': f'Department {department_id}', 'parent_department_id': '0'}
+                for department_id in self._query_list('department_ids')
+            ]})
+        if parts[:3] == ['docx', 'v1', 'documents'] and len(parts) > 3:
+            document = stub.document(parts[3])
+            if self.command != 'GET':
+                with stub.lock:
+                    document['revision_id'] += 1
+                return self._ok({'document_revision_id': document['revision_id']})
+            if len(parts) == 4:
+                return self._ok({'document': {'document_id': parts[3], 'revision_id': document['revision_id'],
+                                              'title': f'Document {parts[3]}'}})
+            if parts[4] == 'blocks' and len(parts) == 5:
+                return self._ok(_page(document['blocks'], query, 500))
+        if parts[:3] == ['bitable', 'v1', 'apps'] and parts[4:5] == ['tables'] and parts[6:7] == ['records']:
+            return self._bitable_records(stub.bitable_table(parts[3], parts[5]), parts[7:], query, body)
+        if path == 'im/v1/chats' and self.command == 'GET':
+            return self._ok(_page([{'chat_id': c, 'name': c} for c in stub.chat_ids], query))
+        if path == 'im/v1/messages' and self.command == 'GET':
+            return self._ok(self._list_messages(query))
+        if path == 'im/v1/messages' and self.command == 'POST':
+            return self._ok(self._append_message(query.get('receive_id') or body.get('receive_id', ''), body))
+        if parts[:3] == ['im', 'v1', 'messages'] and parts[-1] == 'reply' and self.command == 'POST':
+            parent = next((m for ms in stub.messages.values() for m in ms if m['message_id'] == parts[3]), None)
+            chat_id = parent['chat_id'] if parent else stub.chat_ids[0]
+            return self._ok(self._append_message(chat_id, body, parent_id=parts[3]))
+
+        return self._ok({'method': self.command, 'path': path, 'query': query, 'body': body})
+
+    def _ok(self, data):
+        self._reply({'code': 0, 'msg': 'success', 'data': data})
+
+    def _oauth_token(self, body):
+        stub = self.stub
+        if body.get('grant_type') == 'refresh_token':
+            with stub.lock:
+                # 使用済みのRefresh Tokenは無効になる（Larkと同じく毎回差し替え）
+                open_id = stub.refresh_tokens.pop(body.get('refresh_token'), None)
+            if open_id is None:
+                return self._reply({'code': CODE_INVALID_REFRESH_TOKEN, 'error': 'invalid_grant',
+                                    'error_description': 'refresh token is invalid'}, 400)
+        else:
+            open_id = f"ou_{body.get('code', 'user')}"
+        refresh_token = stub._next('r')
+        with stub.lock:
+            stub.refresh_tokens[refresh_token] = open_id
+        return self._reply({'code': 0, 'access_token': stub.issue_access_token('u', open_id), 'refresh_token': refresh_token,
+                            'expires_in': stub.config.token_ttl, 'refresh_token_expires_in': 604800,
+                            'token_type': 'Bearer', 'scope': ''})
+
+    def _create_task(self, body):
+        stub = self.stub
+        with stub.lock:
+            guid = stub.client_tokens.get(body.get('client_token'))
+            if guid is not None:
+                return self._ok({'task': next(t for t in stub.tasks if t['guid'] == guid)})
+        now = str(int(time.time() * 1000))
+        task = dict(body, guid=stub._next('task'), status='todo', completed_at='0', created_at=now, updated_at=now)
+        task.pop('client_token', None)
+        with stub.lock:
+            stub.tasks.append(task)
+            if body.get('client_token'):
+                stub.client_tokens[body['client_token']] = task['guid']
+        return self._ok({'task': task})
+
+    def _bitable_records(self, records, rest, query, body):
+        stub = self.stub
+        now = int(time.time() * 1000)
+        if rest == ['search'] and self.command == 'POST':
+            conditions = (body.get('filter') or {}).get('conditions') or []
+            with stub.lock:
+                matched = [r for r in records if all(
+                    c.get('operator') != 'isGreater' or int(r['fields'].get(c['field_name']) or 0) > int(c['value'][-1])
+                    for c in conditions)]
+            return self._ok(_page(matched, query, 20))
+        if not rest and self.command == 'POST':
+            record = stub._record(stub._next('rec'), body.get('fields') or {}, now, now)
+            with stub.lock:
+                records.append(record)
+            return self._ok({'record': record})
+        with stub.lock:
+            record = next((r for r in records if rest and r['record_id'] == rest[0]), None)
+            if record is None:
+                return self._reply({'code': 1254043, 'msg': 'RecordIdNotFound'}, 404)
+            if self.command == 'DELETE':
+                records.remove(record)
+                return self._ok({'deleted': True, 'record_id': rest[0]})
+            if self.command == 'PUT':
+                record.update(stub._record(record['record_id'], dict(record['fields'], **(body.get('fields') or {})),
+                                           record['created_time'], now))
+            return self._ok({'record': dict(record)})
+
+    def _query_list(self, name):
+        """同じ名前で繰り返し指定されたクエリパラメータ（user_ids=a&user_ids=b）"""
+        return parse_qs(urlsplit(self.path).query).get(name, [])
+
+    def _update_task(self, guid, body):
+        stub = self.stub
+        with stub.lock:
+            task = next((t for t in stub.tasks if t['guid'] == guid), None)
+            if task is None:
+                return self._reply({'code': 1470404, 'msg': 'task not found'}, 404)
+            if self.command == 'DELETE':
+                stub.tasks.remove(task)
+                return self._ok({})
+            changes = body.get('task') or {}
+            for field in body.get('update_fields') or []:
+                task[field] = changes.get(field)
+            if 'completed_at' in (body.get('update_fields') or []):
+                task['status'] = 'done' if int(task.get('completed_at') or 0) else 'todo'
+            task['updated_at'] = str(int(time.time() * 1000))
+            return self._ok({'task': dict(task)})
+
+    def _list_messages(self, query):
+        messages = self.stub.messages.get(query.get('container_id'), [])
+        start = int(query.get('start_time') or 0) * 1000
+        end = int(query['end_time']) * 1000 + 999 if query.get('end_time') else None
+        messages = [m for m in messages if int(m['create_time']) >= start and (end is None or int(m['create_time']) <= end)]
+        if query.get('sort_type') == 'ByCreateTimeDesc':
+            messages = messages[::-1]
+        return _page(messages, query)
+
+    def _append_message(self, chat_id, body, parent_id=''):
+        stub = self.stub
+        message = stub._message(chat_id, stub._next('om'), int(time.time() * 1000), '')
+        message['msg_type'] = body.get('msg_type', 'text')
+        message['body'] = {'content': body.get('content', '')}
+        message['parent_id'] = parent_id
+        with stub.lock:
+            stub.messages.setdefault(chat_id, []).append(message)
+        return message
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+
+def add_arguments(parser):
+    """スタブの設定用の引数（loadtest.py と共通）"""
+    parser.add_argument('--latency', type=float, default=0.05, help='スタブの応答にかける秒数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='応答時間に加えるランダムな揺らぎ（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='500を返す割合（0〜1）')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='429を返す割合（0〜1）')
+    parser.add_argument('--token-ttl', type=int, default=7200, help='発行するトークンの有効期限（秒）')
+
+
+def config_from_args(args):
+    return StubConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      rate_limit_rate=args.rate_limit_rate, token_ttl=args.token_ttl)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = LarkStub(config_from_args(args)).serve(args.host, args.port)
+    print(f"Lark stub: http://{args.host}:{server.server_port}/open-apis （初期Refresh Token: r-initial）")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+負荷試験（ローカルのLarkスタブを使用し、実際のLarkには接続しない）
+
+スタブ（lark_stub.py）とgunicornで起動したこのサーバーに対し、シナリオのルートへ並列でリクエストを送り、
+ルートごとのRPS・p50/p95/p99・エラー数と、スタブ側で数えた上流の呼び出し回数を表示する。
+
+シナリオ:
+  mixed          : 実際の利用に近い組み合わせ（既定）
+  proxy          : /api/lark/... の中継のみ（キャッシュ対象外、プロキシのオーバーヘッドと接続の再利用）
+  cached         : キャッシュ・同時リクエストの集約が効く一覧系のみ
+  messages       : /api/messages（メッセージインデックス経由）
+  refresh-storm  : トークンの期限切れ直後に同時アクセス（--token-ttl 305 などと組み合わせる）
+
+    python bench/loadtest.py --scenario mixed --concurrency 50 --duration 20 --latency 0.05
+    python bench/loadtest.py --scenario refresh-storm --token-ttl 305 --duration 30 --json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+import requests
+
+from lark_stub import LarkStub, add_arguments, config_from_args
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = 'bench-key'
+
+
+def _chat(i):
+    return f'oc_{random.randrange(50):05d}'
+
+
+def _task(i):
+    return f'task-{random.randrange(200):05d}'
+
+
+# (ルート名, メソッド, パスを作る関数, 重み, 本文)
+SCENARIOS = {
+    'mixed': [
+        ('GET /api/tasks', 'GET', lambda i: '/api/tasks', 3, None),
+        ('GET /api/chats', 'GET', lambda i: '/api/chats', 2, None),
+        ('GET /api/messages/:chat', 'GET', lambda i: f'/api/messages/{_chat(i)}', 3, None),
+        ('GET /api/lark/task/v2/tasks/:id', 'GET', lambda i: f'/api/lark/task/v2/tasks/{_task(i)}', 2, None),
+        ('POST /api/lark/echo', 'POST', lambda i: f'/api/lark/bench/echo/{i}', 1, {'value': 1}),
+        ('POST /api/send_message/:chat', 'POST', lambda i: f'/api/send_message/{_chat(i)}', 1, {'text': 'load test'}),
+        ('GET /api/token', 'GET', lambda i: '/api/token', 1, None),
+    ],
+    'proxy': [
+        ('GET /api/lark/echo', 'GET', lambda i: f'/api/lark/bench/echo/{i}', 1, None),
+    ],
+    'cached': [
+        ('GET /api/tasks', 'GET', lambda i: '/api/tasks', 1, None),
+        ('GET /api/chats', 'GET', lambda i: '/api/chats', 1, None),
+        ('GET /api/lark/task/v2/tasks/:id', 'GET', lambda i: f'/api/lark/task/v2/tasks/{_task(i)}', 1, None),
+    ],
+    'messages': [
+        ('GET /api/messages/:chat', 'GET', lambda i: f'/api/messages/{_chat(i)}', 1, None),
+    ],
+    'refresh-storm': [
+        ('GET /api/token', 'GET', lambda i: '/api/token', 2, None),
+        ('GET /api/tasks', 'GET', lambda i: '/api/tasks', 1, None),
+        ('GET /api/lark/echo', 'GET', lambda i: f'/api/lark/bench/echo/{i}', 1, None),
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(stub_url, mode='async', workers=1, data_dir=None, extra_env=None):
+    """スタブに接続するgunicornを起動し、(process, base_url) を返す"""
+    port = free_port()
+    data_dir = data_dir or tempfile.mkdtemp(prefix='lark-bench-')
+    env = dict(
+        os.environ,
+        SERVER_MODE=mode,
+        API_KEY=API_KEY,
+        LARK_API_BASE=f'{stub_url}/open-apis',
+        INITIAL_REFRESH_TOKEN='r-initial',
+        TOKEN_STORE_BACKEND='sqlite',
+        TOKEN_STORE_PATH=os.path.join(data_dir, 'tokens.db'),
+        BACKGROUND_REFRESH='0',
+        RATE_LIMIT_DEFAULT_RPS='100000',
+        MESSAGE_INDEX_PATH=os.path.join(data_dir, 'messages.db'),
+        EVENT_LOG_PATH=os.path.join(data_dir, 'events.db'),
+        TASK_MIRROR_PATH=os.path.join(data_dir, 'tasks.db'),
+    )
+    env.update(extra_env or {})
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '-b', f'127.0.0.1:{port}', '-w', str(workers), '--chdir', ROOT, 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{base}/health', timeout=1)
+            return process, base
+        except requests.exceptions.RequestException:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{mode} モードのサーバーが起動しませんでした')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def run_load(base, routes, concurrency, duration=None, total=None, api_key=API_KEY):
+    """
+    duration 秒（または total 件）の間、concurrency 並列でリクエストを送る
+    戻り値: ({ルート名: {'latencies': [...], 'errors': n}}, 経過秒数)
+    """
+    headers = {'Authorization': f'Bearer {api_key}'}
+    weights = [route[3] for route in routes]
+    results = defaultdict(lambda: {'latencies': [], 'errors': 0})
+    results_lock = threading.Lock()
+    counter = iter(range(total if total is not None else sys.maxsize))
+    counter_lock = threading.Lock()
+    stop_at = time.monotonic() + duration if duration else None
+
+    def worker():
+        session = requests.Session()
+        while stop_at is None or time.monotonic() < stop_at:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            name, method, path, _, body = random.choices(routes, weights)[0]
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base + path(i), headers=headers, json=body, timeout=60)
+                ok = response.status_code < 400
+            except requests.exceptions.RequestException:
+                ok = False
+            latency = time.perf_counter() - started
+            with results_lock:
+                if ok:
+                    results[name]['latencies'].append(latency)
+                else:
+                    results[name]['errors'] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict(results), time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    """ルートごとの RPS・パーセンタイル（ミリ秒）"""
+    summary = {}
+    for name, result in sorted(results.items()):
+        latencies = result['latencies']
+        summary[name] = {
+            'requests': len(latencies) + result['errors'],
+            'errors': result['errors'],
+            'rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        }
+    all_latencies = [latency for result in results.values() for latency in result['latencies']]
+    summary['TOTAL'] = {
+        'requests': sum(s['requests'] for s in summary.values()),
+        'errors': sum(s['errors'] for s in summary.values()),
+        'rps': round(len(all_latencies) / elapsed, 1),
+        'p50_ms': round(percentile(all_latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(all_latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(all_latencies, 99) * 1000, 1),
+    }
+    return summary
+
+
+def print_table(title, rows, columns):
+    width = max([len(name) for name in rows] + [len(title)]) + 2
+    print(f"{title:<{width}}" + ''.join(f"{c:>{max(len(c), 8) + 2}}" for c in columns))
+    for name, row in rows.items():
+        print(f"{name:<{width}}" + ''.join(f"{row.get(c, ''):>{max(len(c), 8) + 2}}" for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20, help='計測する秒数')
+    parser.add_argument('--requests', type=int, help='指定すると秒数ではなく件数で終える')
+    parser.add_argument('--mode', choices=['async', 'sync'], default='async', help='SERVER_MODE')
+    parser.add_argument('--workers', type=int, default=1, help='gunicornのワーカー数')
+    parser.add_argument('--app-env', action='append', default=[], metavar='KEY=VALUE', help='サーバーに渡す環境変数')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    stub = LarkStub(config_from_args(args))
+    stub_server = stub.serve()
+    stub_url = f'http://127.0.0.1:{stub_server.server_port}'
+    extra_env = dict(item.split('=', 1) for item in args.app_env)
+    process, base = start_app(stub_url, args.mode, args.workers, extra_env=extra_env)
+    try:
+        # トークン取得を済ませてから計測する
+        requests.get(f'{base}/api/tasks', headers={'Authorization': f'Bearer {API_KEY}'}, timeout=60)
+        stub.reset()
+        results, elapsed = run_load(base, SCENARIOS[args.scenario], args.concurrency,
+                                    duration=None if args.requests else args.duration, total=args.requests)
+        upstream = stub.stats()
+        status = requests.get(f'{base}/api/status', headers={'Authorization': f'Bearer {API_KEY}'}, timeout=10).json()
+    finally:
+        process.terminate()
+        process.wait()
+        stub_server.shutdown()
+
+    report = {
+        'scenario': args.scenario,
+        'mode': args.mode,
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'elapsed_s': round(elapsed, 2),
+        'routes': summarize(results, elapsed),
+        'upstream_calls': dict(sorted(upstream.items())),
+        'upstream_calls_total': sum(upstream.values()),
+        'app': {
+            'pool': {k: status['upstream'].get(k) for k in ('requests', 'new_connections', 'pool_hit_ratio', 'peak_in_flight')},
+            'cache': status.get('cache'),
+            'coalescing': status.get('coalescing'),
+        },
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"scenario={args.scenario} mode={args.mode} workers={args.workers} concurrency={args.concurrency} "
+          f"elapsed={report['elapsed_s']}s stub latency={args.latency}s error_rate={args.error_rate} "
+          f"rate_limit_rate={args.rate_limit_rate} token_ttl={args.token_ttl}s")
+    print()
+    print_table('route', report['routes'], ['requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms'])
+    print()
+    print_table('upstream (stub)', {k: {'calls': v} for k, v in report['upstream_calls'].items()}, ['calls'])
+    print()
+    print(f"pool: {report['app']['pool']}")
+    if report['app']['cache']:
+        print(f"cache: hits={report['app']['cache'].get('hits')} misses={report['app']['cache'].get('misses')}")
+    print(f"coalescing: {report['app']['coalescing']}")
+
+
+if __name__ == '__main__':
+    main()
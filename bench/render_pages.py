@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+HTMLページ描画のマイクロベンチマーク（Larkには接続しない）
+
+従来の書き方（リクエストごとに render_template_string で文字列からテンプレートを作り、認可URLを全パラメータ分
+エンコードし直す）と、現在の書き方（起動時にコンパイル済みのテンプレート・組み立て済みの認可URL）を比べる。
+GET / はアプリ全体（Flaskのディスパッチを含む）を通した1回あたりの時間と、ETagが一致した場合（304）の時間。
+
+    python bench/render_pages.py --number 2000
+"""
+
+import os
+import sys
+import timeit
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_app(data_dir):
+    os.environ.update(
+        BASE_URL='https://example.com',
+        BACKGROUND_REFRESH='0',
+        METRICS='0',
+        MESSAGE_INDEX_PATH=os.path.join(data_dir, 'messages.db'),
+        EVENT_LOG_PATH=os.path.join(data_dir, 'events.db'),
+        TASK_MIRROR_PATH=os.path.join(data_dir, 'tasks.db'),
+    )
+    import app
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000, help='1項目あたりの実行回数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        app = load_app(data_dir)
+        from flask import render_template_string
+        import requests
+
+        def legacy_auth_url():
+            params = {
+                'client_id': app.APP_ID,
+                'redirect_uri': app.get_redirect_uri(),
+                'response_type': 'code',
+                'scope': app.SCOPES,
+                'state': 'state-value',
+                'code_challenge': 'challenge-value',
+                'code_challenge_method': 'S256'
+            }
+            return f"{app.AUTH_URL}?" + "&".join([f"{k}={requests.utils.quote(str(v))}" for k, v in params.items()])
+
+        client = app.app.test_client()
+        etag = client.get('/').headers['ETag']
+        cases = [
+            ('index: render_template_string', lambda: render_template_string(
+                app.INDEX_HTML, has_token=True, updated_at='2026-01-01T00:00:00')),
+            ('index: compiled template', lambda: app.INDEX_TEMPLATE.render(
+                has_token=True, updated_at='2026-01-01T00:00:00')),
+            ('success: render_template_string', lambda: render_template_string(
+                app.SUCCESS_HTML, access_expires=7200, refresh_expires=604800, user_name='user', api_key='lk_x')),
+            ('success: compiled template', lambda: app.SUCCESS_TEMPLATE.render(
+                access_expires=7200, refresh_expires=604800, user_name='user', api_key='lk_x')),
+            ('auth url: encode every parameter', legacy_auth_url),
+            ('auth url: precomputed prefix', lambda: app.build_auth_url('state-value', 'challenge-value')),
+        ]
+
+        print(f"{'case':<36}{'us/op':>10}")
+        with app.app.test_request_context('/'):
+            for name, fn in cases:
+                seconds = timeit.timeit(fn, number=args.number)
+                print(f"{name:<36}{seconds / args.number * 1e6:>10.1f}")
+        for name, headers in (('GET / (200)', {}), ('GET / (304, If-None-Match)', {'If-None-Match': etag})):
+            seconds = timeit.timeit(lambda: client.get('/', headers=headers), number=args.number)
+            print(f"{name:<36}{seconds / args.number * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,568 @@
+"""
+Bitable（Base）テーブルのローカルミラー（SQLite）
+- BITABLE_MIRRORS に設定したテーブル（app_token × table_id）のレコードを取り込み、絞り込み・並べ替え・
+  項目の選択・集計を上流を呼ばずに返す
+- 初回は全件を取り込み、以降は「更新日時」の項目（設定した場合）で変更のあったレコードだけを取り直す
+  更新日時の項目がないテーブル・定期的な全件の照合では全ページをたどるが、書き込むのは last_modified_time が
+  進んだレコードだけにする
+- 全件をたどり終えた同期で見つからなかったレコードは削除済みとして残し、?since= の差分でわかるようにする
+- レコードの書き込み・削除ごとにテーブル内の連番（seq）を振り、?since= でその続きの変更だけを返す
+  （modified_at は上流の last_modified_time だけを保持し、差分同期の起点に使う）
+- レコードの値は上流の形（fields）のほかに、テキストの断片を連結・ユーザーを名前にするなどした比較用の値（flat）を
+  保存し、問い合わせは flat に対して行う
+"""
+
+import json
+import time
+import threading
+
+from localdb import LocalDatabase
+
+
+class BitableQueryError(Exception):
+    """問い合わせの内容が不正"""
+
+
+# スキーマを変更したら上げる（ミラーは上流から取り直せるため、古いものは作り直す）
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bitable_records (
+    table_key TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT 0,
+    modified_at INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    deleted_at INTEGER NOT NULL DEFAULT 0,
+    fields TEXT NOT NULL,
+    flat TEXT NOT NULL,
+    PRIMARY KEY (table_key, record_id)
+);
+CREATE INDEX IF NOT EXISTS bitable_records_created ON bitable_records (table_key, deleted, created_at);
+CREATE INDEX IF NOT EXISTS bitable_records_modified ON bitable_records (table_key, modified_at);
+CREATE INDEX IF NOT EXISTS bitable_records_seq ON bitable_records (table_key, seq);
+CREATE TABLE IF NOT EXISTS bitable_tables (
+    table_key TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL DEFAULT 0,
+    full_synced_at REAL NOT NULL DEFAULT 0,
+    dirty INTEGER NOT NULL DEFAULT 0,
+    sync_started_at REAL NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+# テーブル内の次の連番
+NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM bitable_records WHERE table_key = ?)"
+
+# 削除済みとして残したレコードを消すまでの期間（秒）
+TOMBSTONE_RETENTION = 7 * 24 * 3600
+
+# 差分同期で前回の最新の更新時刻から遡る幅（ミリ秒。日付の条件は日単位で比べられるため1日分を取り直す）
+MODIFIED_OVERLAP_MS = 24 * 3600 * 1000
+
+# 問い合わせで使える比較・集計
+COMPARISONS = {'eq': '=', 'ne': 'IS NOT', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+OPERATORS = tuple(COMPARISONS) + ('in', 'contains', 'empty', 'not_empty')
+AGGREGATES = ('count', 'count_distinct', 'sum', 'avg', 'min', 'max')
+MAX_GROUP_BY = 5
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def table_key(app_token, table_id):
+    return f'{app_token}/{table_id}'
+
+
+def parse_mirrors(value):
+    """
+    BITABLE_MIRRORS の値を table_key -> 設定 にする
+    "app_token:table_id[:更新日時の項目名],..."（項目名を省略したテーブルは毎回全ページをたどる）
+    """
+    tables = {}
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        app_token, _, rest = entry.partition(':')
+        table_id, _, modified_field = rest.partition(':')
+        if not app_token or not table_id:
+            raise ValueError(f'invalid BITABLE_MIRRORS entry: {entry}')
+        tables[table_key(app_token, table_id)] = {
+            'app_token': app_token,
+            'table_id': table_id,
+            'modified_field': modified_field.strip()
+        }
+    return tables
+
+
+def table_key_from_path(path):
+    """
+    プロキシ経由の書き込み先のパスから (table_key, 全件の取り直しが必要か) を返す（Bitableのテーブルでなければ None）
+    項目（fields）の変更は既存レコードの更新日時を進めないため、全件を取り直す
+    """
+    parts = path.strip('/').split('/')
+    if parts[:3] != ['bitable', 'v1', 'apps'] or len(parts) < 6 or parts[4] != 'tables':
+        return None
+    return table_key(parts[3], parts[5]), parts[6:7] == ['fields']
+
+
+def search_body(modified_field=None, since=None):
+    """records/search のリクエストボディ（since を指定すると更新日時の項目がそれより後のレコードだけ）"""
+    body = {'automatic_fields': True}
+    if modified_field and since is not None:
+        body['filter'] = {'conjunction': 'and', 'conditions': [
+            {'field_name': modified_field, 'operator': 'isGreater', 'value': ['ExactDate', str(since)]}
+        ]}
+    return body
+
+
+def flat_value(value):
+    """
+    比較・集計に使う値
+    テキスト（断片の配列）は連結した文字列、ユーザー・添付ファイルなどは名前、数式・参照は計算結果、
+    リンクはレコードIDの配列にする。数値・日付（ミリ秒）・チェックボックス・選択肢はそのまま
+    """
+    if isinstance(value, dict):
+        if 'value' in value and 'type' in value:
+            result = flat_value(value['value'])
+            return result[0] if isinstance(result, list) and len(result) == 1 else result
+        if 'link_record_ids' in value:
+            return value['link_record_ids']
+        for key in ('text', 'name', 'full_address', 'link'):
+            if key in value:
+                return value[key]
+        return value
+    if isinstance(value, list):
+        if value and all(isinstance(v, dict) and 'text' in v and 'name' not in v for v in value):
+            return ''.join(str(v.get('text') or '') for v in value)
+        return [flat_value(v) for v in value]
+    return value
+
+
+def record_item(record_id, created_at, modified_at, deleted, fields):
+    """返却するレコード（records/search と同じ形）"""
+    item = {'record_id': record_id, 'fields': fields, 'created_time': created_at, 'last_modified_time': modified_at}
+    if deleted:
+        item['deleted'] = True
+    return item
+
+
+def _field_path(name):
+    if not isinstance(name, str) or not name or '"' in name or '\\' in name:
+        raise BitableQueryError(f'invalid field name: {name!r}')
+    return f'$."{name}"'
+
+
+def _scalar(value, where):
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        raise BitableQueryError(f'{where}.value must be a string, number, boolean or null')
+    return value
+
+
+def parse_query(payload, max_limit):
+    """
+    問い合わせの内容を検証して返す
+    {
+        "filter": [{"field": "状態", "op": "eq", "value": "完了"}, ...],
+        "conjunction": "and" | "or",
+        "sort": [{"field": "金額", "desc": true}],
+        "fields": ["名前", "金額"],
+        "group_by": ["担当者"],
+        "aggregates": [{"op": "sum", "field": "金額", "as": "合計"}],
+        "format": "raw" | "flat",
+        "limit": 100, "offset": 0
+    }
+    """
+    if not isinstance(payload, dict):
+        raise BitableQueryError('query must be an object')
+    query = {
+        'filter': [],
+        'conjunction': payload.get('conjunction', 'and'),
+        'sort': [],
+        'fields': payload.get('fields'),
+        'group_by': payload.get('group_by') or [],
+        'aggregates': [],
+        'format': payload.get('format', 'raw')
+    }
+    if query['conjunction'] not in ('and', 'or'):
+        raise BitableQueryError('conjunction must be and or or')
+    if query['format'] not in ('raw', 'flat'):
+        raise BitableQueryError('format must be raw or flat')
+
+    for index, condition in enumerate(payload.get('filter') or []):
+        where = f'filter[{index}]'
+        if not isinstance(condition, dict) or condition.get('op') not in OPERATORS:
+            raise BitableQueryError(f"{where}.op must be one of {', '.join(OPERATORS)}")
+        value = condition.get('value')
+        if condition['op'] == 'in':
+            if not isinstance(value, list) or not value:
+                raise BitableQueryError(f'{where}.value must be a non-empty array')
+            value = [_scalar(v, where) for v in value]
+        elif condition['op'] not in ('empty', 'not_empty'):
+            value = _scalar(value, where)
+        query['filter'].append({'path': _field_path(condition.get('field')), 'op': condition['op'], 'value': value})
+
+    if query['fields'] is not None:
+        if not isinstance(query['fields'], list) or not all(isinstance(name, str) for name in query['fields']):
+            raise BitableQueryError('fields must be an array of field names')
+    if not isinstance(query['group_by'], list) or len(query['group_by']) > MAX_GROUP_BY:
+        raise BitableQueryError(f'group_by must be an array of at most {MAX_GROUP_BY} field names')
+    for name in query['group_by']:
+        _field_path(name)
+
+    names = set(query['group_by'])
+    for index, aggregate in enumerate(payload.get('aggregates') or []):
+        where = f'aggregates[{index}]'
+        if not isinstance(aggregate, dict) or aggregate.get('op') not in AGGREGATES:
+            raise BitableQueryError(f"{where}.op must be one of {', '.join(AGGREGATES)}")
+        field = aggregate.get('field')
+        if field is None and aggregate['op'] != 'count':
+            raise BitableQueryError(f'{where}.field is required')
+        name = str(aggregate.get('as') or (f"{aggregate['op']}:{field}" if field is not None else aggregate['op']))
+        if name in names:
+            raise BitableQueryError(f'{where}: duplicate name {name}')
+        names.add(name)
+        query['aggregates'].append({
+            'op': aggregate['op'],
+            'path': _field_path(field) if field is not None else None,
+            'as': name
+        })
+    if query['group_by'] and not query['aggregates']:
+        query['aggregates'].append({'op': 'count', 'path': None, 'as': 'count'})
+
+    for index, order in enumerate(payload.get('sort') or []):
+        if not isinstance(order, dict):
+            raise BitableQueryError(f'sort[{index}] must be an object')
+        field = order.get('field')
+        if query['aggregates']:
+            if field not in names:
+                raise BitableQueryError(f'sort[{index}].field must be a group_by field or an aggregate name')
+            path = None
+        else:
+            path = _field_path(field)
+        query['sort'].append({'field': field, 'path': path, 'desc': bool(order.get('desc'))})
+
+    try:
+        limit = int(payload.get('limit', 100))
+        offset = int(payload.get('offset', 0))
+    except (TypeError, ValueError):
+        raise BitableQueryError('limit and offset must be integers')
+    query['limit'] = max(1, min(limit, max_limit))
+    query['offset'] = max(0, offset)
+    return query
+
+
+def _condition_sql(condition):
+    """1つの条件を (SQL, パラメータ) にする"""
+    path, op, value = condition['path'], condition['op'], condition['value']
+    if op in COMPARISONS:
+        return f"json_extract(flat, ?) {COMPARISONS[op]} ?", [path, value]
+    if op == 'in':
+        return f"json_extract(flat, ?) IN ({', '.join('?' * len(value))})", [path] + value
+    if op == 'contains':
+        # 複数の値を持つ項目（複数選択・ユーザーなど）は要素の一致、テキストは部分一致
+        return ("CASE json_type(flat, ?) WHEN 'array' THEN EXISTS (SELECT 1 FROM json_each(flat, ?) WHERE value = ?)"
+                " ELSE instr(json_extract(flat, ?), ?) > 0 END", [path, path, value, path, value])
+    empty = "COALESCE(json_extract(flat, ?), '') IN ('', '[]')"
+    return (empty if op == 'empty' else f"NOT {empty}"), [path]
+
+
+class BitableMirror:
+    """設定したテーブルのレコードをSQLiteに保持する"""
+
+    def __init__(self, path, tables, max_age=300, full_sync_interval=3600, sync_lease=300, retry_base=30,
+                 retry_max=3600):
+        self.db = LocalDatabase(path)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.connect().executescript(
+                "DROP TABLE IF EXISTS bitable_records; DROP TABLE IF EXISTS bitable_tables;"
+                + SCHEMA + f"PRAGMA user_version = {SCHEMA_VERSION};"
+            )
+        self.tables = tables
+        self.max_age = max_age
+        self.full_sync_interval = full_sync_interval  # 差分同期のテーブルでも全件を照合する（削除を反映する）間隔
+        self.sync_lease = sync_lease  # バックグラウンド同期を1つのワーカーに任せる秒数
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(['queries', 'upstream_syncs', 'full_syncs', 'sync_failures',
+                                     'records_written', 'records_deleted'], 0)
+        # 設定から外したテーブルは削除し、新しいテーブルは未同期として登録する
+        with self.db.transaction() as conn:
+            keys = list(tables)
+            placeholders = ', '.join('?' * len(keys)) or "''"
+            conn.execute(f"DELETE FROM bitable_records WHERE table_key NOT IN ({placeholders})", keys)
+            conn.execute(f"DELETE FROM bitable_tables WHERE table_key NOT IN ({placeholders})", keys)
+            conn.executemany("INSERT OR IGNORE INTO bitable_tables (table_key) VALUES (?)", [(key,) for key in keys])
+
+    def _incr(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    # ---- 同期 ----
+
+    def known_versions(self, key):
+        """取り込み済みのレコード: record_id -> modified_at（削除済みを除く）"""
+        rows = self.db.execute(
+            "SELECT record_id, modified_at FROM bitable_records WHERE table_key = ? AND deleted = 0", (key,)
+        ).fetchall()
+        return dict(rows)
+
+    def incremental_since(self, key):
+        """
+        差分同期で取り直す起点（ミリ秒）。全件をたどる必要があれば None
+        更新日時の項目がない・全件の照合から full_sync_interval 秒たった・全件の取り直しを要求された場合
+        """
+        if not self.tables[key]['modified_field']:
+            return None
+        row = self.db.execute("SELECT full_synced_at FROM bitable_tables WHERE table_key = ?", (key,)).fetchone()
+        if row is None or row[0] + self.full_sync_interval < time.time():
+            return None
+        latest = self.db.execute(
+            "SELECT COALESCE(MAX(modified_at), 0) FROM bitable_records WHERE table_key = ? AND deleted = 0", (key,)
+        ).fetchone()[0]
+        return max(0, latest - MODIFIED_OVERLAP_MS)
+
+    def upsert(self, key, records, known):
+        """
+        last_modified_time が known（known_versions の結果）より進んだレコード・新しいレコードだけを書き込む
+        known は書き込んだ分を更新する。戻り値: 書き込んだ件数
+        """
+        changed = [
+            record for record in records
+            if record.get('record_id')
+            and (not record.get('last_modified_time')
+                 or int(record['last_modified_time']) > known.get(record['record_id'], -1))
+        ]
+        if not changed:
+            return 0
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO bitable_records"
+                " (table_key, record_id, created_at, modified_at, seq, deleted, fields, flat)"
+                f" VALUES (?, ?, ?, ?, {NEXT_SEQ}, 0, ?, ?)",
+                [
+                    (key, record['record_id'], int(record.get('created_time') or 0),
+                     int(record.get('last_modified_time') or 0), key,
+                     json.dumps(record.get('fields') or {}, ensure_ascii=False),
+                     json.dumps({name: flat_value(value) for name, value in (record.get('fields') or {}).items()},
+                                ensure_ascii=False))
+                    for record in changed
+                ]
+            )
+        for record in changed:
+            known[record['record_id']] = int(record.get('last_modified_time') or 0)
+        self._incr('records_written', len(changed))
+        return len(changed)
+
+    def delete_records(self, key, record_ids):
+        """レコードを削除済みにする（削除の通知・全件の照合で見つからなかったレコード）。戻り値: 件数"""
+        deleted_at = now_ms()
+        with self.db.transaction() as conn:
+            count = conn.executemany(
+                f"UPDATE bitable_records SET deleted = 1, deleted_at = ?, seq = {NEXT_SEQ}"
+                " WHERE table_key = ? AND record_id = ? AND deleted = 0",
+                [(deleted_at, key, key, record_id) for record_id in record_ids]
+            ).rowcount
+            # 最新の連番を持つレコードは残す（消すと連番が巻き戻り、?since= の続きを取りこぼす）
+            conn.execute(
+                "DELETE FROM bitable_records WHERE table_key = ? AND deleted = 1 AND deleted_at < ?"
+                " AND seq < (SELECT MAX(seq) FROM bitable_records WHERE table_key = ?)",
+                (key, deleted_at - TOMBSTONE_RETENTION * 1000, key)
+            )
+        self._incr('records_deleted', count)
+        return count
+
+    def mark_missing_deleted(self, key, seen):
+        """全件をたどった同期で見つからなかったレコードを削除済みにする"""
+        return self.delete_records(key, [record_id for record_id in self.known_versions(key) if record_id not in seen])
+
+    def claim_sync(self, key, min_ttl=0):
+        """
+        バックグラウンド同期を始めてよければ True
+        他のワーカーが同期中・再試行待ち・すでに同期済み（due(min_ttl) の対象外）なら False
+        """
+        now = time.time()
+        return self.db.execute(
+            "UPDATE bitable_tables SET sync_started_at = ?, dirty = 0"
+            " WHERE table_key = ? AND sync_started_at < ? AND retry_at <= ? AND (dirty = 1 OR synced_at + ? < ?)",
+            (now, key, now - self.sync_lease, now, self.max_age, now + min_ttl)
+        ).rowcount == 1
+
+    def mark_synced(self, key, full):
+        """上流の変更分（full なら全件）を取り込んだ"""
+        self._incr('upstream_syncs')
+        if full:
+            self._incr('full_syncs')
+        now = time.time()
+        self.db.execute(
+            "UPDATE bitable_tables SET synced_at = ?, full_synced_at = CASE WHEN ? THEN ? ELSE full_synced_at END,"
+            " sync_started_at = 0, failures = 0, retry_at = 0 WHERE table_key = ?",
+            (now, full, now, key)
+        )
+
+    def record_failure(self, key):
+        """同期に失敗したテーブルは指数バックオフでバックグラウンド同期の対象から外す"""
+        self._incr('sync_failures')
+        row = self.db.execute("SELECT failures FROM bitable_tables WHERE table_key = ?", (key,)).fetchone()
+        failures = (row[0] if row else 0) + 1
+        delay = min(self.retry_max, self.retry_base * (2 ** (failures - 1)))
+        self.db.execute(
+            "UPDATE bitable_tables SET failures = ?, retry_at = ?, sync_started_at = 0 WHERE table_key = ?",
+            (failures, time.time() + delay, key)
+        )
+
+    def mark_dirty(self, key=None, full=False):
+        """
+        レコードの変更を知った（key 省略時は全テーブル）。ミラーは引き続き返し、次の同期で取り直す
+        full: 次の同期で全件をたどる（項目の変更など、更新日時では変更がわからない場合）
+        """
+        sql = "UPDATE bitable_tables SET dirty = 1" + (", full_synced_at = 0" if full else "")
+        if key is None:
+            self.db.execute(sql)
+        else:
+            self.db.execute(sql + " WHERE table_key = ?", (key,))
+
+    def is_synced(self, key):
+        row = self.db.execute("SELECT synced_at FROM bitable_tables WHERE table_key = ?", (key,)).fetchone()
+        return row is not None and row[0] + self.max_age > time.time()
+
+    def synced_at(self, key):
+        row = self.db.execute("SELECT synced_at FROM bitable_tables WHERE table_key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def next_expiry(self):
+        """再同期が必要になる最も早い時刻（未同期・変更通知を受けたテーブルがあれば現在時刻。対象がなければ None）"""
+        row = self.db.execute(
+            "SELECT MIN(CASE WHEN dirty THEN 0 ELSE synced_at + ? END) FROM bitable_tables WHERE retry_at <= ?",
+            (self.max_age, time.time())
+        ).fetchone()
+        return None if row[0] is None else max(row[0], 0) or time.time()
+
+    def due(self, min_ttl):
+        """残りmin_ttl秒以内に再同期が必要なテーブル・未同期・変更通知を受けたテーブル（同期の古い順）"""
+        now = time.time()
+        rows = self.db.execute(
+            "SELECT table_key FROM bitable_tables WHERE retry_at <= ? AND (dirty = 1 OR synced_at + ? < ?)"
+            " ORDER BY synced_at",
+            (now, self.max_age, now + min_ttl)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    # ---- 問い合わせ ----
+
+    def records(self, key, since=None, limit=500, offset=0):
+        """
+        レコードを作成順に返す（records/search と同じ形）
+        since（high_water の値）を指定した場合は、それより後に書き込み・削除されたレコードを変更順に返す
+        戻り値: (items, has_more, 次回の ?since= に渡す連番)
+        連番は since を指定した場合は最後に返したレコードの連番（なければ since）、それ以外は問い合わせる前の最新の連番
+        """
+        self._incr('queries')
+        high_water = since if since is not None else self.high_water(key)
+        if since is None:
+            where, params, order = "table_key = ? AND deleted = 0", [key], "created_at, record_id"
+        else:
+            where, params, order = "table_key = ? AND seq > ?", [key, since], "seq"
+        rows = self.db.execute(
+            f"SELECT record_id, created_at, modified_at, deleted, fields, seq FROM bitable_records"
+            f" WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [limit + 1, offset]
+        ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if since is not None and rows:
+            high_water = rows[-1][5]
+        return [record_item(*row[:4], json.loads(row[4])) for row in rows], has_more, high_water
+
+    def query(self, key, query):
+        """
+        parse_query の結果で問い合わせる
+        集計なし: {'items': [...], 'total': 条件に合う件数, 'has_more': ...}
+        集計あり: {'groups': [{group_by の項目..., 集計名: 値}], 'has_more': ...}
+        """
+        self._incr('queries')
+        where, params = ["table_key = ?", "deleted = 0"], [key]
+        if query['filter']:
+            conditions = [_condition_sql(condition) for condition in query['filter']]
+            where.append('(' + f" {query['conjunction'].upper()} ".join(sql for sql, _ in conditions) + ')')
+            for _, condition_params in conditions:
+                params += condition_params
+        where_sql = ' AND '.join(where)
+        if query['aggregates']:
+            return self._aggregate(query, where_sql, params)
+
+        order = [f"json_extract(flat, ?) {'DESC' if order['desc'] else 'ASC'}" for order in query['sort']]
+        order_params = [order['path'] for order in query['sort']]
+        column = 'flat' if query['format'] == 'flat' else 'fields'
+        rows = self.db.execute(
+            f"SELECT record_id, created_at, modified_at, {column} FROM bitable_records WHERE {where_sql}"
+            f" ORDER BY {', '.join(order + ['created_at', 'record_id'])} LIMIT ? OFFSET ?",
+            params + order_params + [query['limit'] + 1, query['offset']]
+        ).fetchall()
+        total = self.db.execute(f"SELECT COUNT(*) FROM bitable_records WHERE {where_sql}", params).fetchone()[0]
+        items = []
+        for record_id, created_at, modified_at, values in rows[:query['limit']]:
+            values = json.loads(values)
+            if query['fields'] is not None:
+                values = {name: values[name] for name in query['fields'] if name in values}
+            items.append(record_item(record_id, created_at, modified_at, False, values))
+        return {'items': items, 'total': total, 'has_more': len(rows) > query['limit']}
+
+    def _aggregate(self, query, where_sql, params):
+        columns, select_params = [], []
+        for index, name in enumerate(query['group_by']):
+            columns += [f"json_extract(flat, ?) AS g{index}", f"json_type(flat, ?) AS t{index}"]
+            select_params += [_field_path(name)] * 2
+        for index, aggregate in enumerate(query['aggregates']):
+            op, path = aggregate['op'], aggregate['path']
+            if path is None:
+                columns.append(f"COUNT(*) AS a{index}")
+                continue
+            expression = {'count': 'COUNT({})', 'count_distinct': 'COUNT(DISTINCT {})', 'sum': 'TOTAL({})',
+                          'avg': 'AVG({})', 'min': 'MIN({})', 'max': 'MAX({})'}[op]
+            # 空の値（'' や []）は件数・集計に含めない
+            columns.append(expression.format("NULLIF(NULLIF(json_extract(flat, ?), ''), '[]')") + f" AS a{index}")
+            select_params.append(path)
+        aliases = {name: f'g{index}' for index, name in enumerate(query['group_by'])}
+        aliases.update({aggregate['as']: f'a{index}' for index, aggregate in enumerate(query['aggregates'])})
+        order = [f"{aliases[order['field']]} {'DESC' if order['desc'] else 'ASC'}" for order in query['sort']]
+        order += [f'g{index}' for index in range(len(query['group_by']))]
+        group_sql = f" GROUP BY {', '.join(f'g{index}' for index in range(len(query['group_by'])))}" \
+            if query['group_by'] else ''
+        rows = self.db.execute(
+            f"SELECT {', '.join(columns)} FROM bitable_records WHERE {where_sql}{group_sql}"
+            + (f" ORDER BY {', '.join(order)}" if order else '') + " LIMIT ? OFFSET ?",
+            select_params + params + [query['limit'] + 1, query['offset']]
+        ).fetchall()
+        groups = []
+        group_count = len(query['group_by'])
+        for row in rows[:query['limit']]:
+            group = {}
+            for index, name in enumerate(query['group_by']):
+                value, value_type = row[index * 2], row[index * 2 + 1]
+                # 複数の値を持つ項目は値の組み合わせごとにまとめる（JSONの配列として返す）
+                group[name] = json.loads(value) if value_type in ('array', 'object') else value
+            for index, aggregate in enumerate(query['aggregates']):
+                group[aggregate['as']] = row[group_count * 2 + index]
+            groups.append(group)
+        return {'groups': groups, 'has_more': len(rows) > query['limit']}
+
+    def high_water(self, key):
+        """このテーブルの最新の連番（この時点より後に書き込み・削除されたレコードは、これより大きい連番を持つ）"""
+        return self.db.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM bitable_records WHERE table_key = ?", (key,)
+        ).fetchone()[0]
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['records'] = self.db.execute("SELECT COUNT(*) FROM bitable_records WHERE deleted = 0").fetchone()[0]
+        stats['tables'] = len(self.tables)
+        stats['synced_tables'] = self.db.execute("SELECT COUNT(*) FROM bitable_tables WHERE synced_at > 0").fetchone()[0]
+        stats['max_age'] = self.max_age
+        return stats
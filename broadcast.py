@@ -0,0 +1,82 @@
+"""
+複数チャットへの一斉送信
+- 送信は並行して行い、レート制限は共通クライアント側（im/v1/messages × tenant）で調整
+- 通信エラー・5xx・レート制限は再試行（同じuuidで送るため、Lark側で重複送信にならない）
+- チャットごとの配信結果を返す
+"""
+
+import json
+import time
+import uuid as uuid_lib
+
+import requests
+
+from ratelimit import RateLimitExceeded
+
+
+class BroadcastValidationError(Exception):
+    """一斉送信の内容が不正"""
+
+
+def build_message(payload):
+    """text または card から (msg_type, content) を作る"""
+    if payload.get('card'):
+        card = payload['card']
+        return 'interactive', card if isinstance(card, str) else json.dumps(card, ensure_ascii=False)
+    if payload.get('text'):
+        return 'text', json.dumps({'text': payload['text']}, ensure_ascii=False)
+    raise BroadcastValidationError('text or card is required')
+
+
+def broadcast_id(payload):
+    """再試行時の重複防止に使うID（クライアント指定があればそれを使う）"""
+    value = str(payload.get('broadcast_id') or uuid_lib.uuid4().hex)
+    return value[:32]
+
+
+def message_uuid(base, chat_id):
+    """Larkの重複排除用uuid（最大50文字）: 一斉送信ID + チャットIDのハッシュ"""
+    return f"{base}-{uuid_lib.uuid5(uuid_lib.NAMESPACE_URL, chat_id).hex[:16]}"
+
+
+def deliver(send, chat_id, max_attempts=3, backoff=0.5):
+    """
+    1チャットへ送信し、結果を返す
+    send(chat_id) -> requests.Response
+    """
+    started = time.monotonic()
+    result = {'chat_id': chat_id, 'ok': False, 'attempts': 0}
+    for attempt in range(1, max_attempts + 1):
+        result['attempts'] = attempt
+        transient = False
+        try:
+            response = send(chat_id)
+            try:
+                body = response.json()
+            except ValueError:
+                body = {'code': None, 'msg': f'HTTP {response.status_code}'}
+            result['code'] = body.get('code')
+            result['msg'] = body.get('msg')
+            if response.status_code == 200 and body.get('code') == 0:
+                result['ok'] = True
+                result['message_id'] = (body.get('data') or {}).get('message_id')
+                break
+            transient = response.status_code >= 500
+        except RateLimitExceeded as e:
+            result['code'], result['msg'] = None, str(e)
+            transient = True
+            time.sleep(min(e.retry_after, 5.0))
+        except requests.exceptions.RequestException as e:
+            result['code'], result['msg'] = None, str(e)
+            transient = True
+        if not transient:
+            break
+        if attempt < max_attempts:
+            time.sleep(backoff * (2 ** (attempt - 1)))
+    result['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+    return result
+
+
+def summarize(results):
+    delivered = sum(1 for r in results if r['ok'])
+    return {'total': len(results), 'delivered': delivered, 'failed': len(results) - delivered}
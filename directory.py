@@ -0,0 +1,117 @@
+"""
+ユーザー・部署のディレクトリキャッシュ
+- contact/v3 の batch API で取得したユーザー・部署をワーカー内のLRU（件数上限 + 有効期限）に保持する
+- メッセージ・タスクに含まれる open_id に名前と部署を付けるときに使い、未取得の分だけをまとめて1回で取得する
+  （1人ずつ contact/v3/users/<id> を呼ばない）
+- 有効期限の refresh_ratio を過ぎた項目は古い値を返したまま、バックグラウンドで取り直す
+- 上流に存在しない（権限がない・退職済みなど）IDも短い期間だけ覚えておき、毎回問い合わせない
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+# ユーザー・部署を1回の batch API で取得できる件数
+BATCH_SIZE = 50
+
+# ?expand=users で返すユーザーの項目
+USER_FIELDS = ('name', 'en_name', 'email', 'job_title', 'department_ids')
+
+
+def user_summary(item):
+    """contact/v3 のユーザーから返す項目だけを取り出す"""
+    summary = {name: item[name] for name in USER_FIELDS if item.get(name)}
+    avatar = (item.get('avatar') or {}).get('avatar_72')
+    if avatar:
+        summary['avatar'] = avatar
+    return summary
+
+
+def department_summary(item):
+    return {'name': item.get('name', ''), 'parent_department_id': item.get('parent_department_id', '')}
+
+
+def chunks(ids, size=BATCH_SIZE):
+    ids = list(ids)
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+class DirectoryCache:
+    """種類（'user' / 'department'）ごとの ID -> 値 のLRU"""
+
+    def __init__(self, max_entries=10000, ttl=3600.0, negative_ttl=300.0, refresh_ratio=0.5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl  # 上流に存在しなかったIDを覚えておく秒数
+        self.refresh_ratio = refresh_ratio  # 有効期限のこの割合を過ぎたら取り直す
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (kind, entry_id) -> (取得時刻, 有効期限, 値 or None)
+        self._pending = set()  # バックグラウンドで取り直し中の (kind, entry_id)
+        self._stats = dict.fromkeys(['hits', 'misses', 'negative_hits', 'refreshes', 'evictions'], 0)
+
+    def lookup(self, kind, ids):
+        """
+        キャッシュから引く
+        戻り値: (found, missing, stale)
+          found: id -> 値（上流に存在しなかったIDは含めない）
+          missing: 未取得・期限切れのID（呼び出し側でまとめて取得する）
+          stale: 返した値のうち取り直し時期を過ぎたID
+        """
+        now = time.time()
+        found, missing, stale = {}, [], []
+        with self._lock:
+            for entry_id in dict.fromkeys(ids):
+                entry = self._entries.get((kind, entry_id))
+                if entry is None or entry[1] <= now:
+                    missing.append(entry_id)
+                    self._stats['misses'] += 1
+                    continue
+                self._entries.move_to_end((kind, entry_id))
+                fetched_at, expires_at, value = entry
+                if value is None:
+                    self._stats['negative_hits'] += 1
+                    continue
+                self._stats['hits'] += 1
+                found[entry_id] = value
+                if now - fetched_at > (expires_at - fetched_at) * self.refresh_ratio:
+                    stale.append(entry_id)
+        return found, missing, stale
+
+    def store(self, kind, requested, values):
+        """
+        取得した値を保存する
+        requested のうち values に含まれなかったIDは「存在しない」として negative_ttl 秒覚えておく
+        """
+        now = time.time()
+        with self._lock:
+            for entry_id in requested:
+                value = values.get(entry_id)
+                ttl = self.ttl if value is not None else self.negative_ttl
+                self._entries[(kind, entry_id)] = (now, now + ttl, value)
+                self._entries.move_to_end((kind, entry_id))
+                self._pending.discard((kind, entry_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def claim_refresh(self, kind, ids):
+        """バックグラウンドでの取り直しを始めるIDを返す（他のスレッドが取り直し中のIDは除く）"""
+        with self._lock:
+            claimed = [entry_id for entry_id in ids if (kind, entry_id) not in self._pending]
+            self._pending.update((kind, entry_id) for entry_id in claimed)
+            if claimed:
+                self._stats['refreshes'] += 1
+        return claimed
+
+    def release_refresh(self, kind, ids):
+        """取り直しに失敗した場合（次のアクセスで再度取り直す）"""
+        with self._lock:
+            self._pending.difference_update((kind, entry_id) for entry_id in ids)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        return stats
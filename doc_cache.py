@@ -0,0 +1,242 @@
+"""
+ドキュメント（docx）の内容キャッシュ
+- ブロック一覧の全ページとテキスト化した本文を document_id × revision_id ごとにファイルへ保存する
+- 読み出しのたびに上流のメタデータ（docx/v1/documents/<id>、1回の軽い呼び出し）で現在の revision_id を確認し、
+  変わっていなければ保存済みの内容を返す（ブロックをたどり直さない）
+  メタデータは呼び出したユーザーのトークンで取得するため、権限のないユーザーには保存済みの内容も返さない
+- 保存先は全ワーカーで共有するディレクトリ。合計サイズが上限を超えたら最後に読まれたのが古いものから削除する
+- 大きなファイルはメモリに読み込まず mmap して少しずつ送る
+"""
+
+import os
+import re
+import json
+import mmap
+import time
+import threading
+
+# ブロックの種類（block_type）→ 本文を持つキーとテキスト化の接頭辞
+HEADING_TYPES = {3 + level: f'heading{level + 1}' for level in range(9)}
+BLOCK_TEXT_KEYS = {1: 'page', 2: 'text', 12: 'bullet', 13: 'ordered', 14: 'code', 15: 'quote', 17: 'todo',
+                   **HEADING_TYPES}
+DIVIDER_TYPE = 22
+
+# ファイル名に使えるID
+SAFE_ID = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+# mmap したファイルを送る単位（バイト）
+CHUNK_SIZE = 64 * 1024
+
+
+def element_text(element):
+    """テキスト要素（text_run・メンション・数式など）の文字列"""
+    if 'text_run' in element:
+        return element['text_run'].get('content', '')
+    if 'mention_user' in element:
+        return '@' + element['mention_user'].get('user_id', '')
+    if 'mention_doc' in element:
+        return element['mention_doc'].get('title') or element['mention_doc'].get('url', '')
+    if 'equation' in element:
+        return element['equation'].get('content', '')
+    return ''
+
+
+def block_line(block):
+    """1ブロック分のテキスト（本文を持たないブロックは None）"""
+    block_type = block.get('block_type')
+    if block_type == DIVIDER_TYPE:
+        return '---'
+    key = BLOCK_TEXT_KEYS.get(block_type)
+    if key is None or key not in block:
+        return None
+    body = block[key]
+    text = ''.join(element_text(element) for element in body.get('elements') or [])
+    if block_type in HEADING_TYPES:
+        return '#' * (block_type - 2) + ' ' + text
+    if key == 'bullet':
+        return '- ' + text
+    if key == 'ordered':
+        return '1. ' + text
+    if key == 'todo':
+        return ('[x] ' if (body.get('style') or {}).get('done') else '[ ] ') + text
+    if key == 'quote':
+        return '> ' + text
+    if key == 'code':
+        return '```\n' + text + '\n```'
+    return text
+
+
+def render_text(document_id, blocks):
+    """
+    ブロック一覧をプレーンテキスト（Markdown風）にする
+    ルート（page）ブロックから children の順にたどり、親が見つからないブロックは最後に一覧の順で出す
+    """
+    by_id = {block.get('block_id'): block for block in blocks}
+    root = by_id.get(document_id) or next((b for b in blocks if b.get('block_type') == 1), None)
+    lines = []
+    visited = set()
+    stack = [root['block_id']] if root else []
+    while stack:
+        block_id = stack.pop()
+        block = by_id.get(block_id)
+        if block is None or block_id in visited:
+            continue
+        visited.add(block_id)
+        line = block_line(block)
+        if line is not None:
+            lines.append(line)
+        stack.extend(reversed(block.get('children') or []))
+    for block in blocks:
+        if block.get('block_id') not in visited:
+            line = block_line(block)
+            if line is not None:
+                lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def is_older_revision(name, revision_id):
+    """保存済みの revision（ファイル名）が revision_id より古いか（他のワーカーが保存した新しい revision は消さない）"""
+    try:
+        return int(name) < int(revision_id)
+    except ValueError:
+        return name != str(revision_id)
+
+
+class DocumentCache:
+    """<directory>/<document_id>/<revision_id>.json（ブロック）・.txt（テキスト）"""
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, mmap_threshold=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mmap_threshold = mmap_threshold  # これより大きいファイルは mmap して送る
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(['hits', 'misses', 'not_modified', 'evictions', 'mmap_reads'], 0)
+        os.makedirs(directory, exist_ok=True)
+
+    def _incr(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def path(self, document_id, revision_id, fmt):
+        """fmt: 'json' / 'txt'（IDはファイル名に使うため英数字・_・- のみ）"""
+        if not SAFE_ID.match(document_id) or not SAFE_ID.match(str(revision_id)):
+            raise ValueError(f'invalid document id: {document_id}@{revision_id}')
+        return os.path.join(self.directory, document_id, f'{revision_id}.{fmt}')
+
+    def has(self, document_id, revision_id):
+        return os.path.exists(self.path(document_id, revision_id, 'txt'))
+
+    def note_not_modified(self):
+        self._incr('not_modified')
+
+    def put(self, document_id, revision_id, body, text):
+        """
+        ブロック一覧のレスポンス本文（bytes）とテキストを保存し、同じドキュメントの古い revision を削除する
+        一時ファイル経由で置き換えるため、他のワーカーは書きかけのファイルを読まない（.txt を最後に書く）
+        """
+        self._incr('misses')
+        directory = os.path.join(self.directory, document_id)
+        os.makedirs(directory, exist_ok=True)
+        for fmt, data in (('json', body), ('txt', text.encode())):
+            path = self.path(document_id, revision_id, fmt)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        for name in os.listdir(directory):
+            if not name.endswith('.tmp') and is_older_revision(name.split('.')[0], revision_id):
+                self._remove(os.path.join(directory, name))
+        self.evict()
+
+    def read(self, document_id, revision_id, fmt):
+        """
+        保存済みの内容を (サイズ, チャンクを返すイテレータ) で返す（なければ None）
+        読んだファイルは更新時刻を進め、削除の順番を後ろにする
+        """
+        path = self.path(document_id, revision_id, fmt)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        size = os.fstat(f.fileno()).st_size
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._incr('hits')
+        if size < self.mmap_threshold or size == 0:
+            with f:
+                data = f.read()
+            return size, iter([data])
+        self._incr('mmap_reads')
+        return size, self._iter_mmap(f, size)
+
+    @staticmethod
+    def _iter_mmap(f, size):
+        # 削除・置き換えされても開いたファイルはそのまま読める（POSIX）
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in range(0, size, CHUNK_SIZE):
+                yield mapped[offset:offset + CHUNK_SIZE]
+
+    def _files(self):
+        """(最終アクセス時刻, サイズ, パス) の一覧"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            for file in os.scandir(entry.path):
+                if file.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file.path))
+        return files
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """合計サイズが max_bytes を超えていれば、最後に読まれたのが古いドキュメントから削除する"""
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return 0
+        # 同じ revision の .json と .txt はまとめて消す
+        revisions = {}
+        for mtime, size, path in files:
+            key = os.path.splitext(path)[0]
+            last, revision_size = revisions.get(key, (0, 0))
+            revisions[key] = (max(last, mtime), revision_size + size)
+        evicted = 0
+        for key, (_, size) in sorted(revisions.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            for fmt in ('txt', 'json'):
+                self._remove(f'{key}.{fmt}')
+            total -= size
+            evicted += 1
+        self._incr('evictions', evicted)
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        files = self._files()
+        stats['documents'] = sum(1 for _, _, path in files if path.endswith('.txt'))
+        stats['bytes'] = sum(size for _, size, _ in files)
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+def document_body(document, blocks):
+    """保存・返却するレスポンス本文（docx/v1 の形式に合わせる）"""
+    return json.dumps({'code': 0, 'msg': 'success', 'data': {
+        'document': document,
+        'items': blocks,
+        'cached_at': int(time.time())
+    }}, ensure_ascii=False).encode()
@@ -0,0 +1,181 @@
+"""
+新着メッセージ・タスク変更の配信用イベントログ
+- イベントはSQLiteに連番（seq）付きで追記し、全ワーカーで共有する（seq が SSE の id / Last-Event-ID）
+- ワーカーごとに1本のスレッドが新着をまとめて読み、メモリ上のリングバッファに載せて待機中の購読者を起こす
+  （購読者はDBを読まずに待つだけなので、接続を開いたままの購読者が多くても負荷が増えない）
+- 古いイベントは保持期間・件数の上限を超えたものから削除する
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+from localdb import LocalDatabase
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def format_sse(event):
+    """SSEの1イベント分の文字列"""
+    data = json.dumps({'topic': event['topic'], 'data': event['data']}, ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+
+
+class EventLog:
+    """SQLite上のイベントログ + ワーカー内の通知"""
+
+    def __init__(self, path, retention=86400, max_events=100000, poll_interval=1.0, buffer_size=10000):
+        self.db = LocalDatabase(path, SCHEMA)
+        self.retention = retention
+        self.max_events = max_events
+        self.poll_interval = poll_interval
+        self._buffer = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._latest = self._max_seq()
+        self._pid = None
+        self._appends = 0
+        self._subscribers = 0
+
+    def _max_seq(self):
+        return self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+
+    def _row(self, row):
+        return {'id': row[0], 'topic': row[1], 'event': row[2], 'data': json.loads(row[3])}
+
+    def append(self, topic, kind, data):
+        """イベントを追記し、このワーカーの購読者にすぐ知らせる"""
+        return self.append_many([(topic, kind, data)])
+
+    def append_many(self, events):
+        """
+        複数のイベント（(topic, kind, data) の列）を1つのトランザクションで追記する
+        戻り値: 最後のイベントの連番（なければ None）
+        """
+        if not events:
+            return None
+        now = time.time()
+        with self._cond:
+            # 1件目・1001件目…を追記するときに古いイベントを削除する
+            prune = (self._appends - 1) // 1000 != (self._appends + len(events) - 1) // 1000
+            self._appends += len(events)
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO events (topic, kind, data, created_at) VALUES (?, ?, ?, ?)",
+                [(topic, kind, json.dumps(data, ensure_ascii=False), now) for topic, kind, data in events]
+            )
+            seq = conn.execute("SELECT MAX(seq) FROM events").fetchone()[0]
+            if prune:
+                conn.execute(
+                    "DELETE FROM events WHERE created_at < ? OR seq <= ?",
+                    (now - self.retention, seq - self.max_events)
+                )
+        self._wakeup.set()
+        return seq
+
+    def ensure_started(self):
+        """ワーカーごとに新着を読むスレッドを起動（fork後は起動し直す）"""
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._buffer.clear()
+            self._latest = self._max_seq()
+            threading.Thread(target=self._run, name='event-log-poller', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                rows = self.db.execute(
+                    "SELECT seq, topic, kind, data FROM events WHERE seq > ? ORDER BY seq LIMIT 1000",
+                    (self._latest,)
+                ).fetchall()
+            except Exception:
+                continue
+            if not rows:
+                continue
+            with self._cond:
+                self._buffer.extend(self._row(row) for row in rows)
+                self._latest = rows[-1][0]
+                self._cond.notify_all()
+            if len(rows) == 1000:
+                self._wakeup.set()
+
+    def last_id(self):
+        self.ensure_started()
+        return self._latest
+
+    def oldest_id(self):
+        """保持している最も古いイベントの連番（なければ None）"""
+        row = self.db.execute("SELECT MIN(seq) FROM events").fetchone()
+        return row[0]
+
+    def read(self, after, match, limit=500):
+        """
+        連番 after より後のイベントのうち match(topic) が真のものを返す
+        戻り値: (events, 次回の after)
+        """
+        self.ensure_started()
+        with self._cond:
+            latest = self._latest
+            buffered = list(self._buffer) if (
+                (self._buffer and self._buffer[0]['id'] <= after + 1) or after >= latest
+            ) else None
+        if buffered is not None:
+            scanned = [event for event in buffered if event['id'] > after][:limit]
+        else:
+            # バッファより古い位置からの再開はDBから読む
+            scanned = [self._row(row) for row in self.db.execute(
+                "SELECT seq, topic, kind, data FROM events WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                (after, latest, limit)
+            ).fetchall()]
+        if not scanned:
+            return [], after
+        return [event for event in scanned if match(event['topic'])], scanned[-1]['id']
+
+    def wait(self, after, timeout):
+        """連番 after より新しいイベントが届くまで最大 timeout 秒待つ"""
+        self.ensure_started()
+        with self._cond:
+            return self._cond.wait_for(lambda: self._latest > after, timeout=timeout)
+
+    def subscribe(self):
+        """購読者数を数える（stats用）。with で使う"""
+        return _Subscription(self)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'last_event_id': self._latest,
+                'buffered': len(self._buffer),
+                'subscribers': self._subscribers
+            }
+
+
+class _Subscription:
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        with self.log._cond:
+            self.log._subscribers += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.log._cond:
+            self.log._subscribers -= 1
@@ -0,0 +1,25 @@
+"""
+Gunicornの設定（gunicorn app:app で自動的に読み込まれる）
+SERVER_MODE=async（既定）: geventワーカー。上流の通信待ちの間は他のリクエストを処理するため、
+                          1プロセスで数百の同時リクエスト（Lark API呼び出し・SSE接続）を扱える
+                          ローカルのSQLite（メッセージ索引・イベントログ・ミラー・トークン）はロックを待つ間も
+                          他のリクエストを処理し、WALのチェックポイントはハブのスレッドプールで行う（localdb.py）
+SERVER_MODE=sync        : 従来の同期ワーカー（同時に処理できるのはワーカー数まで）
+"""
+
+import os
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'async')
+
+if SERVER_MODE == 'async':
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', '1000'))
+    # 同時に上流へ出るリクエストが増えるため、keep-aliveで保持する接続数も増やす
+    os.environ.setdefault('UPSTREAM_POOL_SIZE', '100')
+elif SERVER_MODE == 'sync':
+    worker_class = 'sync'
+else:
+    raise RuntimeError(f"不明な SERVER_MODE: {SERVER_MODE}")
+
+# SSE・ロングポーリングの接続を保持しても、ワーカーが応答なしとして再起動されないようにする
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
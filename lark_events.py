@@ -0,0 +1,128 @@
+"""
+Larkのイベント購読（Webhook）の受信処理
+- 署名検証: sha256(timestamp + nonce + encrypt_key + body) と X-Lark-Signature を比較
+- 暗号化: AES-256-CBC（鍵は encrypt_key の sha256、先頭16バイトがIV）
+- Verification Token の照合（v1 / v2 どちらの形式にも対応）
+"""
+
+import json
+import base64
+import hashlib
+import hmac
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # 暗号化を使わない場合は不要
+    Cipher = None
+
+
+class EventVerificationError(Exception):
+    """署名・トークン・暗号化の検証に失敗した"""
+
+
+def verify_signature(encrypt_key, timestamp, nonce, body, signature):
+    """X-Lark-Signature を検証"""
+    content = (timestamp + nonce + encrypt_key).encode() + body
+    expected = hashlib.sha256(content).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def decrypt(encrypt_key, encrypted):
+    """暗号化されたイベント本文を復号してdictで返す"""
+    if Cipher is None:
+        raise EventVerificationError("暗号化イベントの復号には cryptography パッケージが必要です（pip install cryptography）")
+    try:
+        data = base64.b64decode(encrypted)
+        key = hashlib.sha256(encrypt_key.encode()).digest()
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(data[:16])).decryptor()
+        plain = decryptor.update(data[16:]) + decryptor.finalize()
+        # PKCS#7 パディングを除去
+        plain = plain[:-plain[-1]]
+        return json.loads(plain)
+    except (ValueError, IndexError) as e:
+        raise EventVerificationError(f"イベントの復号に失敗しました: {e}")
+
+
+def parse_event(body, headers, verification_token='', encrypt_key=''):
+    """
+    受信したリクエストを検証し、イベント本文（dict）を返す
+    encrypt_key 設定時は署名ヘッダーがあれば署名を検証し、encrypt を復号する
+    """
+    if not verification_token and not encrypt_key:
+        raise EventVerificationError("LARK_VERIFICATION_TOKEN または LARK_ENCRYPT_KEY が未設定です")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise EventVerificationError("本文がJSONではありません")
+    if not isinstance(payload, dict):
+        raise EventVerificationError("本文がJSONオブジェクトではありません")
+
+    signature = headers.get('X-Lark-Signature')
+    if encrypt_key and signature:
+        timestamp = headers.get('X-Lark-Request-Timestamp', '')
+        nonce = headers.get('X-Lark-Request-Nonce', '')
+        if not verify_signature(encrypt_key, timestamp, nonce, body, signature):
+            raise EventVerificationError("署名が一致しません")
+
+    if 'encrypt' in payload:
+        if not encrypt_key:
+            raise EventVerificationError("暗号化イベントを受信しましたが LARK_ENCRYPT_KEY が未設定です")
+        payload = decrypt(encrypt_key, payload['encrypt'])
+    elif encrypt_key and not signature:
+        raise EventVerificationError("署名のない平文イベントは受け付けません")
+
+    if verification_token:
+        token = payload.get('token') or (payload.get('header') or {}).get('token', '')
+        if not hmac.compare_digest(str(token), verification_token):
+            raise EventVerificationError("Verification Token が一致しません")
+    return payload
+
+
+def event_type(payload):
+    """イベントの種類（url_verification / im.message.receive_v1 など）"""
+    if payload.get('type') == 'url_verification':
+        return 'url_verification'
+    return (payload.get('header') or {}).get('event_type') or (payload.get('event') or {}).get('type', '')
+
+
+def event_id(payload):
+    """重複配信の判定に使うID"""
+    return (payload.get('header') or {}).get('event_id') or payload.get('uuid', '')
+
+
+def message_item(event):
+    """
+    im.message.receive_v1 のイベントを im/v1/messages の一覧と同じ形のアイテムに変換
+    """
+    message = event.get('message') or {}
+    sender = event.get('sender') or {}
+    sender_id = sender.get('sender_id') or {}
+    return {
+        'message_id': message.get('message_id', ''),
+        'root_id': message.get('root_id', ''),
+        'parent_id': message.get('parent_id', ''),
+        'thread_id': message.get('thread_id', ''),
+        'msg_type': message.get('message_type', ''),
+        'create_time': str(message.get('create_time', '')),
+        'update_time': str(message.get('update_time') or message.get('create_time', '')),
+        'deleted': False,
+        'updated': False,
+        'chat_id': message.get('chat_id', ''),
+        'sender': {
+            'id': sender_id.get('open_id', ''),
+            'id_type': 'open_id',
+            'sender_type': sender.get('sender_type', ''),
+            'tenant_key': sender.get('tenant_key', '')
+        },
+        'body': {'content': message.get('content', '')},
+        'mentions': [
+            {
+                'key': mention.get('key', ''),
+                'id': (mention.get('id') or {}).get('open_id', ''),
+                'id_type': 'open_id',
+                'name': mention.get('name', ''),
+                'tenant_key': mention.get('tenant_key', '')
+            }
+            for mention in message.get('mentions') or []
+        ]
+    }
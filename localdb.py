@@ -0,0 +1,135 @@
+"""
+ローカルSQLiteデータベースの共通処理
+- WALモードで開き、複数のgunicornワーカーから同時に読み書きできるようにする
+- 接続はスレッドごと・プロセスごとに作る（fork後に接続を共有しない）
+- geventのワーカー（threading がパッチされている場合）では、SQLiteの呼び出し中はgeventに制御が戻らないため
+  - ロック待ちはSQLite側では待たず（busy timeout 0）、グリーンレットで間隔を空けて再試行する
+  - WALのチェックポイント（ディスクへの書き戻し・fsync）は自動では行わず、CHECKPOINT_INTERVAL 回の書き込みごとに
+    ハブのスレッドプールで実行する
+  それ以外の文はその場で実行する（WALの読み取りは書き込みを待たず、synchronous=NORMAL のCOMMITはfsyncしない。
+  リクエストごとの小さな読み書きをスレッドプールに渡すと、受け渡しの待ちでかえって応答が遅くなる）
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# ロックの解放を待つ最大秒数
+BUSY_TIMEOUT = 30
+
+# geventのワーカーでチェックポイントを行う書き込み（COMMIT）の回数
+# 1回の書き込みで数ページ変わるため、SQLiteの自動チェックポイント（1000ページごと）と同程度になるようにする
+CHECKPOINT_INTERVAL = 250
+
+
+def _gevent():
+    """geventで threading がパッチされていれば gevent モジュール（なければ None）"""
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None or not monkey.is_module_patched('threading'):
+        return None
+    import gevent
+    return gevent
+
+
+def _checkpoint(conn):
+    # スレッドプールで例外を送出するとハブがトレースバックを出力するため、ここで握りつぶす（次の機会に再実行される）
+    try:
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    except sqlite3.Error:
+        pass
+
+
+class _CooperativeConnection:
+    """ロック待ち・チェックポイントでgeventのハブを止めない接続"""
+
+    def __init__(self, conn, db, gevent):
+        self._conn = conn
+        self._db = db
+        self._gevent = gevent
+
+    def _run(self, method, sql, *args):
+        write = method != 'execute' or sql.lstrip()[:6].upper() != 'SELECT'
+        if write and not self._conn.in_transaction:
+            # チェックポイント中は書き込みを始めない（書き込みが続くとWALを先頭から使い直せず、大きくなり続ける）
+            while self._db._checkpointing:
+                self._gevent.sleep(0.001)
+        deadline = time.monotonic() + BUSY_TIMEOUT
+        delay = 0.001
+        while True:
+            try:
+                cursor = getattr(self._conn, method)(sql, *args)
+                break
+            except sqlite3.OperationalError as e:
+                # ロックされていれば実行されていないため、そのまま再試行できる
+                if 'locked' not in str(e) or time.monotonic() > deadline:
+                    raise
+            self._gevent.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        if write and not self._conn.in_transaction:
+            self._db._writes += 1
+            if self._db._writes % CHECKPOINT_INTERVAL == 0:
+                self._db._checkpointing = True
+                try:
+                    self._gevent.get_hub().threadpool.apply(_checkpoint, (self._conn,))
+                finally:
+                    self._db._checkpointing = False
+        return cursor
+
+    def execute(self, sql, params=()):
+        return self._run('execute', sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run('executemany', sql, seq_of_params)
+
+    def executescript(self, script):
+        return self._run('executescript', script)
+
+
+class LocalDatabase:
+    """スレッドごとの接続を管理するSQLiteデータベース"""
+
+    def __init__(self, path, schema=''):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0  # geventのワーカーでの書き込みの回数（チェックポイントの間隔）
+        self._checkpointing = False
+        if schema:
+            self.connect().executescript(schema)
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        gevent = _gevent()
+        if gevent is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        else:
+            # チェックポイントはスレッドプールのスレッドで実行するため、別スレッドからの利用を許可する
+            conn = sqlite3.connect(self.path, timeout=0, isolation_level=None, check_same_thread=False)
+            conn = _CooperativeConnection(conn, self, gevent)
+            conn.execute("PRAGMA wal_autocheckpoint=0")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """書き込みトランザクション（BEGIN IMMEDIATE 〜 COMMIT / ROLLBACK）"""
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
@@ -0,0 +1,244 @@
+"""
+チャットメッセージのローカルインデックス（SQLite）
+- Webhookで受信したメッセージを chat_id × create_time で保持する
+- チャットごとに最後に上流と同期した時刻を記録し、同期済みのチャットはインデックスから返す
+- 同期から max_age 秒たったチャットは上流の新着分を取り込む（イベントの取りこぼし対策）
+- チャットごとに上流から取り込んだ最新の create_time（high water）を持ち、次回はその続きから取得する
+- メッセージの追加・変更ごとにチャット内の連番（seq）を振り、カーソル以降の差分だけを返せるようにする
+"""
+
+import json
+import time
+import base64
+import threading
+
+from localdb import LocalDatabase
+
+
+# スキーマを変更したら上げる（インデックスは上流から取り直せるため、古いものは作り直す）
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    create_time INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    version TEXT NOT NULL DEFAULT '',
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat_id, create_time, message_id);
+CREATE INDEX IF NOT EXISTS messages_chat_seq ON messages (chat_id, seq);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL DEFAULT 0,
+    last_event_at REAL NOT NULL DEFAULT 0,
+    high_water INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_id TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+"""
+
+# 重複配信の判定に使うイベントIDの保持期間（秒）
+EVENT_ID_RETENTION = 24 * 3600
+
+# チャット内の次の連番
+NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE chat_id = ?)"
+
+
+def message_version(item):
+    """
+    内容が変わったかの比較に使う値
+    Webhook・送信結果・一覧APIでアイテムの形（項目の有無・順序）が違うため、内容に関わる項目だけを比べる
+    """
+    return json.dumps([
+        str(item.get('update_time') or item.get('create_time') or ''),
+        bool(item.get('deleted')),
+        (item.get('body') or {}).get('content', ''),
+        sorted([mention.get('key', ''), mention.get('id', '')] for mention in item.get('mentions') or [])
+    ], ensure_ascii=False)
+
+
+def encode_cursor(seq):
+    """差分取得用のカーソル（中身はクライアントに依存させない）"""
+    return base64.urlsafe_b64encode(f"v1:{seq}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソルから連番を取り出す（空文字は先頭から）。不正な値は ValueError"""
+    if not cursor:
+        return 0
+    try:
+        version, seq = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        if version != 'v1':
+            raise ValueError(version)
+        return int(seq)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"invalid cursor: {cursor}")
+
+
+def split_windows(start_time, end_time, count):
+    """[start_time, end_time]（秒）を重ならない count 個の期間に分割"""
+    count = max(1, min(count, end_time - start_time + 1))
+    bounds = [start_time + (end_time - start_time + 1) * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(count)]
+
+
+class MessageIndex:
+    """chat_id ごとのメッセージ一覧をSQLiteに保持する"""
+
+    def __init__(self, path, max_age=3600):
+        self.db = LocalDatabase(path)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.connect().executescript(
+                "DROP TABLE IF EXISTS messages; DROP TABLE IF EXISTS chats; DROP TABLE IF EXISTS processed_events;"
+                + SCHEMA + f"PRAGMA user_version = {SCHEMA_VERSION};"
+            )
+        self.max_age = max_age
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(['index_hits', 'delta_queries', 'upstream_syncs', 'events', 'duplicate_events'], 0)
+        self._claims = 0
+
+    def _incr(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def upsert(self, items):
+        """
+        メッセージを追加・更新し、内容（message_version）が変わったものだけ連番を進める
+        取り消し済みのメッセージは取り消し状態のまま変更しない
+        戻り値: 追加・変更されたメッセージのリスト
+        """
+        items = [item for item in items if item.get('message_id') and item.get('chat_id')]
+        if not items:
+            return []
+        changed = []
+        with self.db.transaction() as conn:
+            for item in items:
+                cursor = conn.execute(
+                    "INSERT INTO messages (message_id, chat_id, create_time, seq, deleted, version, item)"
+                    f" VALUES (?, ?, ?, {NEXT_SEQ}, ?, ?, ?)"
+                    " ON CONFLICT (message_id) DO UPDATE SET"
+                    " item = excluded.item, deleted = excluded.deleted, version = excluded.version, seq = excluded.seq"
+                    " WHERE messages.deleted = 0 AND messages.version != excluded.version",
+                    (item['message_id'], item['chat_id'], int(item.get('create_time') or 0),
+                     item['chat_id'], 1 if item.get('deleted') else 0, message_version(item),
+                     json.dumps(item, ensure_ascii=False))
+                )
+                if cursor.rowcount:
+                    changed.append(item)
+        return changed
+
+    def advance_high_water(self, chat_id, create_time):
+        """上流から取り込んだ最新の create_time（ミリ秒）を記録"""
+        self.db.execute(
+            "INSERT INTO chats (chat_id, high_water) VALUES (?, ?)"
+            " ON CONFLICT (chat_id) DO UPDATE SET high_water = MAX(high_water, excluded.high_water)",
+            (chat_id, int(create_time))
+        )
+
+    def high_water(self, chat_id):
+        """上流から取り込んだ最新の create_time（ミリ秒）。未同期なら None"""
+        row = self.db.execute("SELECT high_water FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row and row[0] else None
+
+    def mark_recalled(self, message_id):
+        """取り消されたメッセージを deleted: true にし、変更後のメッセージを返す（未登録なら None）"""
+        with self.db.transaction() as conn:
+            row = conn.execute("SELECT item FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+            if row is None:
+                return None
+            item = json.loads(row[0])
+            item['deleted'] = True
+            conn.execute(
+                f"UPDATE messages SET deleted = 1, version = ?, item = ?, seq = {NEXT_SEQ} WHERE message_id = ?",
+                (message_version(item), json.dumps(item, ensure_ascii=False), item['chat_id'], message_id)
+            )
+        return item
+
+    def note_event(self, chat_id):
+        """チャットのイベント受信時刻を記録"""
+        self.db.execute(
+            "INSERT INTO chats (chat_id, last_event_at) VALUES (?, ?)"
+            " ON CONFLICT (chat_id) DO UPDATE SET last_event_at = excluded.last_event_at",
+            (chat_id, time.time())
+        )
+
+    def mark_synced(self, chat_id):
+        """上流から最新ページを取り込んだ"""
+        self._incr('upstream_syncs')
+        self.db.execute(
+            "INSERT INTO chats (chat_id, synced_at) VALUES (?, ?)"
+            " ON CONFLICT (chat_id) DO UPDATE SET synced_at = excluded.synced_at",
+            (chat_id, time.time())
+        )
+
+    def invalidate_chat(self, chat_id):
+        """イベントが届かなくなったチャット（ボット退出・解散）は次回上流から取り直す"""
+        self.db.execute("UPDATE chats SET synced_at = 0 WHERE chat_id = ?", (chat_id,))
+
+    def is_synced(self, chat_id):
+        row = self.db.execute("SELECT synced_at FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row is not None and row[0] + self.max_age > time.time()
+
+    def latest(self, chat_id, limit, descending=False):
+        """
+        最新 limit 件を返す（既定は古い順に並べる）
+        戻り値: (items, seq) — seq はこのチャットの現在の連番（カーソルに使う）
+        """
+        self._incr('index_hits')
+        conn = self.db.connect()
+        # 連番を先に読む（間に追加されたものは次の差分で重複して返るだけで、取りこぼさない）
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        rows = conn.execute(
+            "SELECT item FROM messages WHERE chat_id = ?"
+            " ORDER BY create_time DESC, message_id DESC LIMIT ?",
+            (chat_id, limit)
+        ).fetchall()
+        items = [json.loads(row[0]) for row in rows]
+        return (items if descending else items[::-1]), seq
+
+    def changes_since(self, chat_id, seq, limit):
+        """
+        連番 seq より後に追加・変更されたメッセージを変更順に返す
+        戻り値: (items, has_more, 最後に返した連番)
+        """
+        self._incr('delta_queries')
+        rows = self.db.execute(
+            "SELECT seq, item FROM messages WHERE chat_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (chat_id, seq, limit + 1)
+        ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return [json.loads(row[1]) for row in rows], has_more, (rows[-1][0] if rows else seq)
+
+    def claim_event(self, event_id):
+        """初めて受信したイベントなら True（Larkの再送による重複を除く）"""
+        if not event_id:
+            return True
+        now = time.time()
+        with self._stats_lock:
+            self._claims += 1
+            prune = self._claims % 100 == 1
+        if prune:
+            self.db.execute("DELETE FROM processed_events WHERE received_at < ?", (now - EVENT_ID_RETENTION,))
+        claimed = self.db.execute(
+            "INSERT OR IGNORE INTO processed_events (event_id, received_at) VALUES (?, ?)", (event_id, now)
+        ).rowcount == 1
+        self._incr('events' if claimed else 'duplicate_events')
+        return claimed
+
+    def release_event(self, event_id):
+        """処理に失敗したイベントは、再送されたときに処理し直せるよう記録を消す"""
+        self.db.execute("DELETE FROM processed_events WHERE event_id = ?", (event_id,))
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['messages'] = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        stats['chats'] = self.db.execute("SELECT COUNT(*) FROM chats WHERE synced_at > 0").fetchone()[0]
+        stats['max_age'] = self.max_age
+        return stats
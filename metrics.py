@@ -0,0 +1,332 @@
+"""
+Prometheus形式のメトリクス
+- 記録はワーカー内のメモリ上で行う（ロック1回と加算のみなので、本番で常時有効にしてよい）
+- 各ワーカーは定期的に METRICS_DIR/<pid>-<起動時刻>.json へスナップショットを書き出し、
+  /metrics は全ワーカーのスナップショットを合算して返す（どのワーカーが応答しても同じ値になる）
+- counter・histogram は終了したワーカーの分も残す（再起動で値が巻き戻らないように）
+  終了したワーカーのスナップショットは retired.json に合算して削除し、ファイルが増え続けないようにする
+  gauge は最近書き出したワーカーの分だけを合計する
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# リクエスト・上流呼び出しの所要時間（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# ロック待ちなど短い待ち時間（秒）
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# 終了したワーカーの counter・histogram を合算したスナップショット
+RETIRED_FILE = 'retired.json'
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metrics:
+    """ワーカー内のメトリクス + ワーカー間の集計"""
+
+    def __init__(self, directory, flush_interval=5.0, enabled=True):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        # 書き出しがこの秒数止まっていて、プロセスも存在しないワーカーを終了したものとして合算する
+        self.retire_after = max(flush_interval * 12, 60.0)
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, buckets)
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [バケットごとの件数..., 合計, 件数]
+        self._collectors = []  # 書き出し時に呼ぶ関数: () -> [(type, name, labels, value)]
+        self._ratios = []  # (name, 分子のcounter, [分母のcounter])
+        self._pid = None
+        self._path = None
+        self._thread = None
+
+    # ---- 定義 ----
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self._meta[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help, tuple(buckets))
+
+    def ratio(self, name, help, numerator, denominators):
+        """集計後の counter から求める比率（ラベルが同じもの同士で割る）"""
+        self._meta[name] = ('gauge', help, None)
+        self._ratios.append((name, numerator, list(denominators)))
+
+    def add_collector(self, fn):
+        """他モジュールの stats を書き出し時に取り込む"""
+        self._collectors.append(fn)
+
+    # ---- 記録 ----
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        """gauge を増減する"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self._meta[name][2]
+        index = bisect.bisect_left(buckets, value)
+        key = _key(name, labels)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def timed_lock(self, name, lock=None):
+        """with で使うと取得までの待ち時間を name の histogram に記録するロック"""
+        return TimedLock(self, name, lock or threading.Lock())
+
+    # ---- ワーカーごとのスナップショット ----
+
+    def ensure_started(self):
+        """ワーカーごとに書き出しスレッドを起動（fork後は親の値を引き継がずに数え直す）"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self._counters.clear()
+                self._gauges.clear()
+                self._histograms.clear()
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f'{self._pid}-{time.time_ns()}.json')
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def _snapshot(self):
+        counters, gauges = [], []
+        for collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception:
+                continue
+            for kind, name, labels, value in samples:
+                (counters if kind == 'counter' else gauges).append([name, labels, value])
+        with self._lock:
+            counters += [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            gauges += [[name, dict(labels), value] for (name, labels), value in self._gauges.items()]
+            histograms = [[name, dict(labels), list(values)] for (name, labels), values in self._histograms.items()]
+        return {'pid': os.getpid(), 'written_at': time.time(),
+                'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def flush(self):
+        """このワーカーの現在値を書き出す（一時ファイル経由で置き換えるため、読み手は途中の状態を見ない）"""
+        self.ensure_started()
+        if not self.enabled:
+            return
+        tmp = f'{self._path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp, self._path)
+
+    # ---- 集計・出力 ----
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load_snapshots(self):
+        """ファイル名 -> スナップショット"""
+        snapshots = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                snapshot = self._read(name)
+                if snapshot is not None:
+                    snapshots[name] = snapshot
+        return snapshots
+
+    def _retire(self, names):
+        """終了したワーカーのスナップショットを retired.json に合算して削除する（合算は全ワーカーで1つずつ）"""
+        with open(os.path.join(self.directory, 'retired.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                retired = self._read(RETIRED_FILE) or {'pid': 0, 'written_at': 0, 'counters': [], 'histograms': []}
+                counters = {_key(name, labels): value for name, labels, value in retired['counters']}
+                histograms = {_key(name, labels): values for name, labels, values in retired['histograms']}
+                merged = []
+                for name in names:
+                    # 他のワーカーが先に合算したものは読めない
+                    snapshot = self._read(name)
+                    if snapshot is None:
+                        continue
+                    merged.append(name)
+                    for metric, labels, value in snapshot['counters']:
+                        key = _key(metric, labels)
+                        counters[key] = counters.get(key, 0) + value
+                    for metric, labels, values in snapshot['histograms']:
+                        key = _key(metric, labels)
+                        current = histograms.get(key)
+                        histograms[key] = values if current is None else [a + b for a, b in zip(current, values)]
+                if not merged:
+                    return
+                retired['counters'] = [[name, dict(labels), value] for (name, labels), value in counters.items()]
+                retired['histograms'] = [[name, dict(labels), values] for (name, labels), values in histograms.items()]
+                retired['gauges'] = []
+                path = os.path.join(self.directory, RETIRED_FILE)
+                with open(f'{path}.tmp', 'w') as f:
+                    json.dump(retired, f)
+                os.replace(f'{path}.tmp', path)
+                for name in merged:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def collect(self):
+        """全ワーカーの値を合算: (counters, gauges, histograms) それぞれ {(name, labels): value}"""
+        self.flush()
+        snapshots = self._load_snapshots()
+        if fcntl is not None:
+            retire_before = time.time() - self.retire_after
+            dead = [
+                name for name, snapshot in snapshots.items()
+                if name != RETIRED_FILE and os.path.join(self.directory, name) != self._path
+                and snapshot['written_at'] < retire_before and not _pid_alive(snapshot['pid'])
+            ]
+            if dead:
+                self._retire(dead)
+                snapshots = self._load_snapshots()
+        counters, gauges, histograms = {}, {}, {}
+        # 書き出しが2回分以上止まっているワーカーは終了したものとして gauge を数えない
+        live_after = time.time() - self.flush_interval * 2 - 1
+        for snapshot in snapshots.values():
+            for name, labels, value in snapshot['counters']:
+                key = _key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = _key(name, labels)
+                merged = histograms.get(key)
+                histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+            if snapshot['written_at'] >= live_after:
+                for name, labels, value in snapshot['gauges']:
+                    key = _key(name, labels)
+                    gauges[key] = gauges.get(key, 0) + value
+        for name, numerator, denominators in self._ratios:
+            for (counter, labels), value in list(counters.items()):
+                if counter != numerator:
+                    continue
+                total = sum(counters.get((d, labels), 0) for d in denominators)
+                gauges[(name, labels)] = round(value / total, 4) if total else 0.0
+        return counters, gauges, histograms
+
+    def render(self):
+        """Prometheusのテキスト形式（version 0.0.4）"""
+        counters, gauges, histograms = self.collect()
+        families = {}
+        for samples in (counters, gauges, histograms):
+            for (name, labels), value in samples.items():
+                families.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(families):
+            kind, help, buckets = self._meta.get(name, ('untyped', '', None))
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(families[name]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, ("le", _format_value(bound)))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-2])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+class TimedLock:
+    """取得待ちの時間を記録する threading.Lock の代わり（待たずに取れた場合も 0 として数える）"""
+
+    def __init__(self, metrics, name, lock):
+        self._metrics = metrics
+        self._name = name
+        self._lock = lock
+
+    def __enter__(self):
+        if self._lock.acquire(False):
+            self._metrics.observe(self._name, 0.0)
+            return self
+        started = time.perf_counter()
+        self._lock.acquire()
+        self._metrics.observe(self._name, time.perf_counter() - started)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
@@ -0,0 +1,72 @@
+"""
+OAuthの state（CSRF対策）と PKCE の code_verifier の保存
+- ログイン開始ごとに別の state を発行し、複数の認証を同時に進められるようにする
+- 保存先は store_backend（全ワーカーで共有。コールバックはどのワーカーが受けてもよい）
+- コールバックでは state を取り出すと同時に削除する（1回限り、有効期限つき）
+- 期限切れの state は発行のたびに少しずつ掃除し、件数が上限を超えた場合は古いものから捨てる
+  （クローラーがログインURLを大量に踏んでもストアが増え続けない）
+"""
+
+import time
+import base64
+import hashlib
+import secrets
+import threading
+
+from token_backend import StoreDict
+
+
+def pkce_pair():
+    """PKCEの (code_verifier, code_challenge)（S256）"""
+    verifier = secrets.token_urlsafe(48)
+    challenge = base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest()).rstrip(b'=').decode()
+    return verifier, challenge
+
+
+class OAuthStateStore:
+    """発行済みの state → [有効期限, code_verifier]"""
+
+    def __init__(self, backend, ttl=600.0, max_pending=10000, prune_every=100):
+        self.states = StoreDict(backend, 'oauth_states')
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.prune_every = prune_every  # 何回の発行ごとに掃除するか（ワーカーごと）
+        self._issued = 0
+        self._lock = threading.Lock()
+
+    def issue(self, code_verifier=''):
+        """新しい state を発行して保存"""
+        state = secrets.token_urlsafe(24)
+        self.states[state] = [time.time() + self.ttl, code_verifier]
+        with self._lock:
+            self._issued += 1
+            prune = self._issued % self.prune_every == 1
+        if prune:
+            self.prune()
+        return state
+
+    def consume(self, state):
+        """
+        state を取り出して削除し、code_verifier を返す
+        未発行・使用済み・期限切れの場合は None
+        """
+        if not state:
+            return None
+        entry = self.states.pop(state, None)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def prune(self):
+        """期限切れの state を削除し、上限を超えた分は期限の近い（古い）ものから削除"""
+        now = time.time()
+        entries = self.states.snapshot()
+        expired = [state for state, (expires_at, _) in entries.items() if expires_at < now]
+        alive = sorted(
+            ((expires_at, state) for state, (expires_at, _) in entries.items() if expires_at >= now),
+            reverse=True
+        )
+        overflow = [state for _, state in alive[self.max_pending:]]
+        if expired or overflow:
+            self.states.delete_many(expired + overflow)
+        return len(expired) + len(overflow)
@@ -0,0 +1,133 @@
+"""
+Lark APIの一覧系エンドポイントの自動ページング
+- has_more / page_token をサーバー側でたどり、全件（または max_items 件）を1回のレスポンスで返す
+- 次のページの取得をバックグラウンドで先行させ、クライアントへの送信と重ねる
+  （page_tokenは前のページの結果でしか得られないため、ページ取得そのものは順番に行う）
+- 結果は NDJSON または チャンク送信のJSON配列 としてストリーミングし、メモリ使用量を一定に保つ
+"""
+
+import json
+import queue
+import threading
+
+
+class PageError(Exception):
+    """ページ取得がエラーを返した"""
+
+    def __init__(self, message, body=None):
+        super().__init__(message)
+        self.body = body
+
+
+_DONE = object()
+
+
+def parse_page(status, body):
+    """lark_get の結果から data（items / has_more / page_token）を取り出す"""
+    try:
+        result = json.loads(body)
+    except ValueError:
+        raise PageError(f"JSONではないレスポンス（HTTP {status}）")
+    if status != 200 or result.get('code', 0) != 0:
+        raise PageError(result.get('msg', f"HTTP {status}"), result)
+    return result.get('data') or {}
+
+
+class Paginator:
+    """
+    fetch_page(page_token) -> data を繰り返し呼び、アイテムを順に返す
+    最初のページは first_page() で同期的に取得し、エラーを通常のレスポンスとして返せるようにする
+    """
+
+    def __init__(self, fetch_page, max_items=None, max_pages=1000, prefetch=2):
+        self.fetch_page = fetch_page
+        self.max_items = max_items
+        self.max_pages = max_pages
+        self.prefetch = prefetch
+        self.pages = 0
+        self.items = 0
+        self._first = None
+
+    def first_page(self):
+        """最初のページを取得（PageError はそのまま送出）"""
+        self._first = self.fetch_page('')
+        self.pages = 1
+        return self._first
+
+    def _produce(self, q, stop):
+        data = self._first
+        try:
+            while True:
+                if not self._put(q, stop, data):
+                    return
+                page_token = data.get('page_token')
+                if not data.get('has_more') or not page_token or self.pages >= self.max_pages:
+                    break
+                data = self.fetch_page(page_token)
+                self.pages += 1
+        except Exception as e:
+            self._put(q, stop, e)
+            return
+        self._put(q, stop, _DONE)
+
+    @staticmethod
+    def _put(q, stop, value):
+        # クライアントが切断した場合（stopが立った場合）は取得をやめる
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        """アイテムを返す。途中のページでエラーになった場合は PageError を送出"""
+        if self._first is None:
+            self.first_page()
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(q, stop), name='paginator', daemon=True)
+        producer.start()
+        try:
+            while True:
+                data = q.get()
+                if data is _DONE:
+                    return
+                if isinstance(data, Exception):
+                    raise data if isinstance(data, PageError) else PageError(str(data))
+                for item in data.get('items') or []:
+                    if self.max_items is not None and self.items >= self.max_items:
+                        return
+                    self.items += 1
+                    yield item
+                if self.max_items is not None and self.items >= self.max_items:
+                    return
+        finally:
+            stop.set()
+
+
+def _error_object(e):
+    return {'error': 'PageError', 'message': str(e), 'response': e.body}
+
+
+def stream_ndjson(paginator):
+    """1行1アイテムのNDJSON。途中でエラーになった場合は最後の行にエラーを出力"""
+    try:
+        for item in paginator:
+            yield json.dumps(item, ensure_ascii=False) + '\n'
+    except PageError as e:
+        yield json.dumps(_error_object(e), ensure_ascii=False) + '\n'
+
+
+def stream_json_array(paginator):
+    """JSON配列をアイテムごとに送信。途中でエラーになった場合は最後の要素にエラーを入れる"""
+    yield '['
+    first = True
+    try:
+        for item in paginator:
+            yield ('' if first else ',') + json.dumps(item, ensure_ascii=False)
+            first = False
+    except PageError as e:
+        yield ('' if first else ',') + json.dumps(_error_object(e), ensure_ascii=False)
+    yield ']'
@@ -0,0 +1,143 @@
+"""
+Lark API呼び出しのクライアント側レート制限
+- APIの種類（family）× 認証情報（user / tenant）ごとのトークンバケット
+- 上限を超えた分はエラーにせず、max_wait 秒まで順番待ちさせる
+- 429 / 頻度制限エラー（code 99991400）を受けたら一時停止してレートを下げ、成功が続けば戻す
+- バケットの状態は共有ストアに置くため、gunicornの全ワーカーで合計した呼び出し数を制限できる
+"""
+
+import time
+import threading
+from urllib.parse import urlsplit
+
+from token_backend import LockTimeout
+from response_cache import resource_family
+
+
+# Larkの頻度制限エラーコード
+RATE_LIMIT_CODES = (99991400,)
+
+# APIの種類ごとの上限（回/秒）。記載のないものは既定値を使う
+DEFAULT_FAMILY_RATES = {
+    'im/v1/messages': 50.0,
+    'im/v1/chats': 20.0,
+    'task/v2/tasks': 20.0,
+    'contact/v3/users': 20.0,
+    'bitable/v1/apps': 20.0,
+    'docx/v1/documents': 5.0,
+}
+
+
+class RateLimitExceeded(Exception):
+    """max_wait 秒以内に送信枠が空かない、または上流の制限が解除されない"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def api_family(url):
+    """URLからAPIの種類を求める（例: .../open-apis/im/v1/messages/xxx → im/v1/messages）"""
+    path = urlsplit(url).path
+    if '/open-apis/' in path:
+        path = path.split('/open-apis/', 1)[1]
+    return resource_family(path)
+
+
+class TokenBucketLimiter:
+    """共有ストア上のトークンバケット（枠を先に予約し、待ち時間だけ眠る）"""
+
+    def __init__(self, store, default_rate=20.0, burst_seconds=1.0, max_wait=10.0,
+                 family_rates=None, min_rate=0.5):
+        self.store = store  # dict互換（StoreDict）
+        self.default_rate = default_rate
+        self.burst_seconds = burst_seconds  # 何秒分の呼び出しをまとめて許可するか
+        self.max_wait = max_wait
+        self.family_rates = dict(DEFAULT_FAMILY_RATES if family_rates is None else family_rates)
+        self.min_rate = min_rate
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(['acquired', 'waited', 'rejected', 'limited_responses'], 0)
+        self._wait_seconds = 0.0
+
+    def _incr(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def ceiling(self, family):
+        return self.family_rates.get(family, self.default_rate)
+
+    def _load(self, key, family, now):
+        ceiling = self.ceiling(family)
+        state = self.store.get(key) or {
+            'tokens': ceiling * self.burst_seconds,
+            'rate': ceiling,
+            'updated': now,
+            'paused_until': 0.0
+        }
+        # 経過時間分を補充（上限はバースト分）
+        capacity = state['rate'] * self.burst_seconds
+        state['tokens'] = min(capacity, state['tokens'] + (now - state['updated']) * state['rate'])
+        state['updated'] = now
+        return state
+
+    def acquire(self, family, credential, max_wait=None):
+        """送信枠を1つ確保し、必要なら待つ。待った秒数を返す"""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        key = f"{credential}:{family}"
+        try:
+            with self.store.lock(key, timeout=max_wait):
+                now = time.time()
+                state = self._load(key, family, now)
+                # 一時停止中は解除時刻から、それ以外は不足分が補充されるまで待つ
+                start = max(now, state['paused_until'])
+                wait = (start - now) + max(0.0, 1.0 - state['tokens']) / state['rate']
+                if wait > max_wait:
+                    self.store[key] = state
+                    self._incr('rejected')
+                    raise RateLimitExceeded(f"{family} のレート制限（待ち時間 {wait:.1f}秒）", wait)
+                state['tokens'] -= 1.0
+                self.store[key] = state
+        except LockTimeout:
+            self._incr('rejected')
+            raise RateLimitExceeded(f"{family} のレート制限（順番待ちがタイムアウト）", max_wait)
+        self._incr('acquired')
+        if wait > 0:
+            self._incr('waited')
+            with self._stats_lock:
+                self._wait_seconds += wait
+            time.sleep(wait)
+        return wait
+
+    def on_limited(self, family, credential, reset_after=None, limit=None):
+        """上流で制限された：reset_after 秒停止し、レートを半分に下げる"""
+        key = f"{credential}:{family}"
+        self._incr('limited_responses')
+        with self.store.lock(key, timeout=self.max_wait):
+            now = time.time()
+            state = self._load(key, family, now)
+            if limit:
+                self.family_rates[family] = min(self.ceiling(family), float(limit))
+            state['rate'] = max(self.min_rate, min(state['rate'] * 0.5, self.ceiling(family)))
+            state['tokens'] = min(state['tokens'], 0.0)
+            state['paused_until'] = max(state['paused_until'], now + (reset_after if reset_after else 1.0))
+            self.store[key] = state
+
+    def on_success(self, family, credential):
+        """成功時：下げていたレートを少しずつ上限まで戻す"""
+        key = f"{credential}:{family}"
+        state = self.store.get(key)
+        ceiling = self.ceiling(family)
+        if state is None or state['rate'] >= ceiling:
+            return
+        with self.store.lock(key, timeout=self.max_wait):
+            state = self._load(key, family, time.time())
+            state['rate'] = min(ceiling, state['rate'] + ceiling * 0.05)
+            self.store[key] = state
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['wait_seconds'] = round(self._wait_seconds, 3)
+        stats['default_rate'] = self.default_rate
+        stats['max_wait'] = self.max_wait
+        return stats
@@ -0,0 +1,147 @@
+"""
+バックグラウンドのトークン更新スケジューラ
+- 有効期限の少し前（ジッター付き）にトークンを更新し、リクエスト処理側は常に有効なトークンを読むだけにする
+- 失敗時は指数バックオフで再試行
+- 定期的に更新することで、アクセスがなくてもRefresh Token（約7日間有効）を延命する
+"""
+
+import os
+import time
+import random
+import threading
+from datetime import datetime
+
+
+class RefreshJob:
+    """1種類のトークンの更新ジョブ"""
+
+    def __init__(self, name, expires_at_fn, refresh_fn, lead):
+        self.name = name
+        self.expires_at_fn = expires_at_fn  # 現在のトークンの有効期限（UNIX時刻）。更新不要なら None
+        self.refresh_fn = refresh_fn  # refresh_fn(min_ttl) -> (token, error)。残り有効期間がmin_ttl秒未満なら更新
+        self.lead = lead  # 有効期限の何秒前に更新するか
+        self.jitter_offset = 0.0  # 更新周期ごとに引き直すジッター
+        self.next_run = 0.0
+        self.not_before = 0.0
+        self.last_run = None
+        self.last_latency_ms = None
+        self.last_error = None
+        self.consecutive_failures = 0
+        self.runs = 0
+
+    def state(self):
+        return {
+            'next_run': datetime.fromtimestamp(self.next_run).isoformat() if self.next_run else None,
+            'last_run': datetime.fromtimestamp(self.last_run).isoformat() if self.last_run else None,
+            'last_latency_ms': self.last_latency_ms,
+            'last_error': self.last_error,
+            'consecutive_failures': self.consecutive_failures,
+            'runs': self.runs
+        }
+
+
+class BackgroundRefresher:
+    """
+    登録されたジョブを1本のデーモンスレッドで順に実行する
+    gunicornの各ワーカーで動くが、更新自体はプロセス間ロックと期限の再確認で1回にまとまる
+    """
+
+    def __init__(self, jitter=60.0, idle_interval=60.0, min_interval=30.0, backoff_base=5.0, backoff_max=600.0):
+        self.jitter = jitter
+        self.idle_interval = idle_interval  # トークン未取得時などの確認間隔
+        self.min_interval = min_interval  # 同じジョブを連続実行する最短間隔
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jobs = []
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            jitter=float(os.environ.get('BACKGROUND_REFRESH_JITTER', '60')),
+            idle_interval=float(os.environ.get('BACKGROUND_REFRESH_IDLE_INTERVAL', '60')),
+            backoff_max=float(os.environ.get('BACKGROUND_REFRESH_BACKOFF_MAX', '600')),
+        )
+
+    def add_job(self, name, expires_at_fn, refresh_fn, lead):
+        job = RefreshJob(name, expires_at_fn, refresh_fn, lead)
+        self.jobs.append(job)
+        return job
+
+    def ensure_started(self):
+        """スレッドを起動（fork後のワーカーでは起動し直す）"""
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            now = time.time()
+            for job in self.jobs:
+                job.jitter_offset = random.uniform(0, self.jitter)
+                job.next_run = self._schedule(job, now)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._loop, name='token-refresher', daemon=True)
+            self._thread.start()
+
+    def wakeup(self):
+        """トークンが差し替わった時などにスケジュールを再計算させる"""
+        for job in self.jobs:
+            job.next_run = self._schedule(job, time.time())
+        self._wakeup.set()
+
+    def _schedule(self, job, now):
+        """次回の実行時刻（有効期限 - lead - ジッター）"""
+        expires_at = job.expires_at_fn()
+        if expires_at is None:
+            return now + self.idle_interval
+        return max(now, job.not_before, expires_at - job.lead - job.jitter_offset)
+
+    def _backoff(self, job, now):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (job.consecutive_failures - 1)))
+        return now + delay * random.uniform(0.5, 1.0)
+
+    def _run(self, job):
+        started = time.monotonic()
+        try:
+            # 他のワーカーが更新済みなら再利用される（ジッター幅まで含めて判定）
+            _, error = job.refresh_fn(job.lead + self.jitter)
+        except Exception as e:
+            error = str(e)
+        now = time.time()
+        job.runs += 1
+        job.last_run = now
+        job.not_before = now + self.min_interval
+        job.last_latency_ms = round((time.monotonic() - started) * 1000, 1)
+        job.last_error = error
+        if error:
+            job.consecutive_failures += 1
+            job.next_run = self._backoff(job, now)
+        else:
+            job.consecutive_failures = 0
+            job.jitter_offset = random.uniform(0, self.jitter)
+            job.next_run = self._schedule(job, now)
+
+    def _loop(self):
+        while True:
+            now = time.time()
+            for job in self.jobs:
+                if job.next_run <= now:
+                    self._run(job)
+            next_run = min((job.next_run for job in self.jobs), default=now + self.idle_interval)
+            self._wakeup.wait(max(0.0, min(next_run - time.time(), self.idle_interval)))
+            self._wakeup.clear()
+            # 待機中に他のワーカーやコールバックでトークンが差し替わっている可能性があるため再計算
+            now = time.time()
+            for job in self.jobs:
+                if job.consecutive_failures == 0:
+                    job.next_run = self._schedule(job, now)
+
+    def state(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+            'jobs': {job.name: job.state() for job in self.jobs}
+        }
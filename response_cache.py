@@ -0,0 +1,187 @@
+"""
+読み取り系Lark APIレスポンスのキャッシュ
+- キーは「エンドポイント + 正規化したクエリ + トークンの識別子」
+- ルートごとのTTL、バイト数上限によるLRU削除
+- 書き込み（POST等）時にリソース単位（family）で無効化
+  無効化は世代番号を共有ストアに記録するため、他のワーカーのキャッシュにも反映される
+"""
+
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# (上流パスの正規表現, TTL秒) 最初に一致したものを使う。一致しないGETはキャッシュしない
+DEFAULT_TTL_RULES = [
+    (r'^task/v2/tasks(/[^/]+)?$', 30),
+    (r'^task/v2/tasklists(/[^/]+)?$', 60),
+    (r'^im/v1/chats(/[^/]+)?$', 60),
+    (r'^im/v1/messages$', 10),
+    (r'^contact/v3/(users|departments)(/.*)?$', 300),
+    (r'^wiki/v2/spaces(/.*)?$', 60),
+    (r'^bitable/v1/apps/[^/]+$', 60),
+]
+
+# familyの細分化に使うクエリパラメータ（メッセージはチャット単位で無効化）
+SUBFAMILY_PARAMS = {
+    'im/v1/messages': 'container_id',
+}
+
+
+def resource_family(path):
+    """上流パスからリソースの単位を求める（例: im/v1/messages/xxx/reply → im/v1/messages）"""
+    return '/'.join(path.strip('/').split('/')[:3])
+
+
+def make_etag(body):
+    """本文のハッシュ（引用符なしのETag値）"""
+    return hashlib.sha1(body).hexdigest()
+
+
+def token_identity(token):
+    """トークンそのものをキーに残さないためのハッシュ"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+class CachedResponse:
+    __slots__ = ('status', 'headers', 'body', 'etag', 'expires_at', 'generations', 'size')
+
+    def __init__(self, status, headers, body, expires_at, generations):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = make_etag(body)
+        self.expires_at = expires_at
+        self.generations = generations
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers) + 200
+
+
+class ResponseCache:
+    """プロセス内のLRUキャッシュ（無効化の世代番号は generations ストアで共有）"""
+
+    def __init__(self, generations, max_bytes=64 * 1024 * 1024, max_entry_bytes=2 * 1024 * 1024,
+                 rules=DEFAULT_TTL_RULES, enabled=True):
+        self.generations = generations  # dict互換（StoreDict）: family -> 世代番号
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.rules = [(re.compile(pattern), ttl) for pattern, ttl in rules]
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(['hits', 'misses', 'stores', 'evictions', 'invalidations', 'not_modified'], 0)
+
+    def _incr(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def ttl_for(self, path):
+        """GETのTTL（キャッシュ対象外なら None）"""
+        if not self.enabled:
+            return None
+        path = path.strip('/')
+        for pattern, ttl in self.rules:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def families_for(self, path, params=()):
+        """キャッシュエントリが属するfamily（全体 + 細分化したもの）"""
+        family = resource_family(path)
+        families = [family]
+        sub_param = SUBFAMILY_PARAMS.get(family)
+        if sub_param:
+            for key, value in params:
+                if key == sub_param:
+                    families.append(f"{family}:{value}")
+        return families
+
+    def make_key(self, path, params, token, extra=''):
+        normalized = sorted((str(k), str(v)) for k, v in params)
+        return json.dumps([path.strip('/'), normalized, token_identity(token), extra], ensure_ascii=False)
+
+    def _current_generations(self, families):
+        return tuple(self.generations.get(family, 0) for family in families)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.expires_at <= time.time() or \
+                self._current_generations(entry.generations[0]) != entry.generations[1]:
+            if entry is not None:
+                self._remove(key)
+            self._incr('misses')
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        self._incr('hits')
+        return entry
+
+    def put(self, key, families, ttl, status, headers, body):
+        """保存（大きすぎるものは保存しない）。保存したエントリを返す"""
+        if len(body) > self.max_entry_bytes:
+            return None
+        entry = CachedResponse(
+            status, headers, body, time.time() + ttl,
+            (tuple(families), self._current_generations(families))
+        )
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._stats['stores'] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats['evictions'] += 1
+        return entry
+
+    def _remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def invalidate(self, family):
+        """familyの世代を進め、そのfamilyに属する全ワーカーのキャッシュを無効にする"""
+        with self.generations.lock('bump', timeout=5):
+            self.generations[family] = self.generations.get(family, 0) + 1
+        self._incr('invalidations')
+
+    def invalidate_path(self, path, sub_key=None):
+        """書き込み先のパスから無効化（sub_key指定時は細分化したfamilyのみ）"""
+        family = resource_family(path)
+        self.invalidate(f"{family}:{sub_key}" if sub_key else family)
+
+    def note_not_modified(self):
+        self._incr('not_modified')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['max_bytes'] = self.max_bytes
+        stats['enabled'] = self.enabled
+        return stats
+
+
+def is_cacheable(status, headers, body):
+    """成功したレスポンスのみ保存（JSONで code != 0 のものは保存しない）"""
+    if status != 200:
+        return False
+    header_map = {k.lower(): v for k, v in headers}
+    if 'json' in header_map.get('content-type', '') and not header_map.get('content-encoding'):
+        try:
+            return json.loads(body).get('code', 0) == 0
+        except (ValueError, AttributeError):
+            return False
+    return True
@@ -0,0 +1,72 @@
+"""
+Single-flight 実行ヘルパー
+- 同じキーの処理が同時に要求された場合、実際の処理は1回だけ行う
+- 後続の呼び出し元は先行処理の結果を期限付きで待つ
+"""
+
+import threading
+
+
+class SingleFlightTimeout(Exception):
+    """先行処理の完了待ちがタイムアウトした"""
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つに制限する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'leaders': 0, 'shared': 0, 'timeouts': 0}
+
+    def do(self, key, fn, timeout=None):
+        """
+        fn() を実行して結果を返す
+        同じキーの処理が実行中ならその結果を待つ（timeout秒で SingleFlightTimeout）
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.stats['leaders'] += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.stats['shared'] += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+            return call.result
+
+        if not call.event.wait(timeout):
+            with self._lock:
+                self.stats['timeouts'] += 1
+            raise SingleFlightTimeout(key)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self):
+        """実行中のキー一覧"""
+        with self._lock:
+            return list(self._calls)
@@ -0,0 +1,176 @@
+"""
+タスクの一括作成・更新
+- create / patch / complete の操作を並行して実行し、レート制限は共通クライアント側（task/v2 × user）で調整
+- 操作ごとに冪等キーを持ち、同じキーで再送された操作は実行済みの結果を返す（上流を呼ばない）
+  作成は冪等キーから決めた client_token を付けるため、結果を記録する前に失敗した場合もLark側で重複しない
+- 通信エラー・5xx・レート制限は再試行し、操作ごとの結果を返す
+"""
+
+import time
+import uuid as uuid_lib
+import threading
+
+import requests
+
+from ratelimit import RateLimitExceeded
+from token_backend import StoreDict
+
+
+class TaskBulkValidationError(Exception):
+    """一括操作の内容が不正"""
+
+
+OPERATIONS = ('create', 'patch', 'complete')
+
+
+def bulk_id(payload):
+    """再送時に同じ操作を見分けるためのID（クライアント指定があればそれを使う）"""
+    value = str(payload.get('bulk_id') or uuid_lib.uuid4().hex)
+    return value[:64]
+
+
+def parse_operations(payload, max_operations, base_id):
+    """
+    リクエストボディから操作の一覧を取り出す
+    {"operations": [{"id": "...", "op": "create", "task": {...}},
+                    {"op": "patch", "guid": "...", "task": {...}, "update_fields": [...]},
+                    {"op": "complete", "guid": "..."}]}
+    各操作の冪等キーは idempotency_key（なければ bulk_id + id、id もなければ位置）
+    """
+    items = payload.get('operations') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise TaskBulkValidationError('operations must be a non-empty array')
+    if len(items) > max_operations:
+        raise TaskBulkValidationError(f'too many operations (max {max_operations})')
+
+    completed_at = str(int(time.time() * 1000))
+    parsed = []
+    keys = set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or item.get('op') not in OPERATIONS:
+            raise TaskBulkValidationError(f"operations[{index}].op must be one of {', '.join(OPERATIONS)}")
+        op = item['op']
+        task = item.get('task') or {}
+        if not isinstance(task, dict):
+            raise TaskBulkValidationError(f'operations[{index}].task must be an object')
+        if op == 'create' and not task.get('summary'):
+            raise TaskBulkValidationError(f'operations[{index}].task.summary is required')
+        if op != 'create' and not (isinstance(item.get('guid'), str) and item['guid']):
+            raise TaskBulkValidationError(f'operations[{index}].guid is required')
+        if op == 'patch' and not task:
+            raise TaskBulkValidationError(f'operations[{index}].task is required')
+        if op == 'complete':
+            task = {'completed_at': completed_at}
+        item_id = item.get('id', index)
+        key = str(item.get('idempotency_key') or f'{base_id}:{item_id}')
+        if key in keys:
+            raise TaskBulkValidationError(f'operations[{index}]: duplicate idempotency key {key}')
+        keys.add(key)
+        parsed.append({
+            'id': item_id,
+            'op': op,
+            'guid': item.get('guid', ''),
+            'task': task,
+            'update_fields': item.get('update_fields') or list(task),
+            'key': key
+        })
+    return parsed
+
+
+def client_token(open_id, key):
+    """作成時にLarkへ渡す冪等用トークン（ユーザーごとに別の値にする）"""
+    return uuid_lib.uuid5(uuid_lib.NAMESPACE_URL, f'{open_id}:{key}').hex
+
+
+def build_request(operation, open_id):
+    """操作を (method, path, body) にする"""
+    if operation['op'] == 'create':
+        return 'POST', 'task/v2/tasks', dict(operation['task'], client_token=client_token(open_id, operation['key']))
+    return 'PATCH', f"task/v2/tasks/{operation['guid']}", {
+        'task': operation['task'],
+        'update_fields': operation['update_fields']
+    }
+
+
+class IdempotencyStore:
+    """実行済みの操作の結果: ユーザー + 冪等キー -> [有効期限, 結果]"""
+
+    def __init__(self, backend, ttl=86400.0, prune_every=1000):
+        self.results = StoreDict(backend, 'task_bulk_results')
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    def get(self, open_id, key):
+        entry = self.results.get(f'{open_id}:{key}')
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def put(self, open_id, key, result):
+        self.results[f'{open_id}:{key}'] = [time.time() + self.ttl, result]
+        with self._lock:
+            self._saved += 1
+            prune = self._saved % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self.results.snapshot().items() if expires_at < now]
+        if expired:
+            self.results.delete_many(expired)
+        return len(expired)
+
+
+def run_operation(send, operation, max_attempts=3, backoff=0.5):
+    """
+    1件の操作を実行し、結果を返す
+    send(operation) -> requests.Response
+    """
+    started = time.monotonic()
+    result = {'id': operation['id'], 'op': operation['op'], 'ok': False, 'attempts': 0}
+    for attempt in range(1, max_attempts + 1):
+        result['attempts'] = attempt
+        transient = False
+        try:
+            response = send(operation)
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+            if not isinstance(body, dict):
+                body = {'code': None, 'msg': f'HTTP {response.status_code}'}
+            result['status'] = response.status_code
+            result['code'] = body.get('code')
+            result['msg'] = body.get('msg')
+            if response.status_code == 200 and body.get('code') == 0:
+                result['ok'] = True
+                data = body.get('data')
+                result['task'] = data.get('task') if isinstance(data, dict) else None
+                break
+            transient = response.status_code >= 500 or response.status_code == 429
+        except RateLimitExceeded as e:
+            result['code'], result['msg'] = None, str(e)
+            transient = True
+            time.sleep(min(e.retry_after, 5.0))
+        except requests.exceptions.RequestException as e:
+            result['code'], result['msg'] = None, str(e)
+            transient = True
+        if not transient:
+            break
+        if attempt < max_attempts:
+            time.sleep(backoff * (2 ** (attempt - 1)))
+    result['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+    return result
+
+
+def summarize_operations(results):
+    succeeded = sum(1 for r in results if r['ok'])
+    return {
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'replayed': sum(1 for r in results if r.get('replayed'))
+    }
@@ -0,0 +1,333 @@
+"""
+タスクのローカルミラー（SQLite）
+- task/v2/tasks（ユーザーのタスク一覧）をユーザー（open_id）ごとに取り込み、状態・期限・担当者・タスクリスト・
+  更新時刻の索引を張って、絞り込みを上流を呼ばずに返す
+- 一覧APIには更新時刻での絞り込みがないため同期では全ページをたどるが、書き込むのは updated_at が
+  前回より進んだタスクだけにする（変更のないタスクは読み比べるだけ）
+- 全ページをたどり終えた同期で見つからなかったタスクは削除済み（deleted: true）として残し、
+  差分の取得で削除もわかるようにする
+- タスクの書き込み・削除ごとにユーザー内の連番（seq）を振り、?since= でその続きの変更だけを返す
+  （更新時刻は上流で決まり、取り込む順番とは一致しないため、差分のカーソルには使わない）
+- 同期済みかどうか・再同期が必要か（Webhookでのタスク変更通知）をユーザーごとに記録する
+"""
+
+import json
+import time
+import threading
+from datetime import datetime
+
+from localdb import LocalDatabase
+
+
+# スキーマを変更したら上げる（ミラーは上流から取り直せるため、古いものは作り直す）
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    owner TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    status TEXT NOT NULL,
+    due_at INTEGER,
+    updated_at INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    item TEXT NOT NULL,
+    PRIMARY KEY (owner, guid)
+);
+CREATE INDEX IF NOT EXISTS tasks_owner_seq ON tasks (owner, seq);
+CREATE INDEX IF NOT EXISTS tasks_owner_status_due ON tasks (owner, deleted, status, due_at);
+CREATE INDEX IF NOT EXISTS tasks_owner_due ON tasks (owner, deleted, due_at);
+CREATE INDEX IF NOT EXISTS tasks_owner_updated ON tasks (owner, updated_at);
+CREATE TABLE IF NOT EXISTS task_assignees (
+    owner TEXT NOT NULL,
+    assignee TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    PRIMARY KEY (owner, assignee, guid)
+);
+CREATE TABLE IF NOT EXISTS task_tasklists (
+    owner TEXT NOT NULL,
+    tasklist_guid TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    PRIMARY KEY (owner, tasklist_guid, guid)
+);
+CREATE TABLE IF NOT EXISTS task_owners (
+    owner TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL DEFAULT 0,
+    dirty INTEGER NOT NULL DEFAULT 0,
+    sync_started_at REAL NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+# 削除済みとして残したタスクを消すまでの期間（秒）
+TOMBSTONE_RETENTION = 7 * 24 * 3600
+
+# ユーザー内の次の連番
+NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM tasks WHERE owner = ?)"
+
+# ?order= で指定できる並び順
+ORDERS = {
+    'due': "due_at IS NULL, due_at, guid",
+    'updated': "updated_at, guid",
+    '-updated': "updated_at DESC, guid"
+}
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def parse_time_ms(value):
+    """
+    クエリパラメータの時刻をミリ秒に変換
+    数字はUNIX時刻（10桁程度なら秒、13桁ならミリ秒）、それ以外はISO 8601（タイムゾーンなしはサーバーのローカル時刻）
+    不正な値は ValueError
+    """
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return number * 1000 if number < 10 ** 11 else number
+    try:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+    except ValueError:
+        raise ValueError(f"invalid time: {value}")
+
+
+def task_status(item):
+    """'todo' / 'done'（status がなければ completed_at から判定）"""
+    if item.get('status') in ('todo', 'done'):
+        return item['status']
+    return 'done' if int(item.get('completed_at') or 0) else 'todo'
+
+
+def task_due_at(item):
+    """期限（ミリ秒）。期限なしは None"""
+    timestamp = int((item.get('due') or {}).get('timestamp') or 0)
+    return timestamp or None
+
+
+def task_assignees(item):
+    return {member['id'] for member in item.get('members') or []
+            if member.get('id') and member.get('role', 'assignee') == 'assignee'}
+
+
+def task_tasklists(item):
+    return {tasklist['tasklist_guid'] for tasklist in item.get('tasklists') or [] if tasklist.get('tasklist_guid')}
+
+
+class TaskMirror:
+    """open_id ごとのタスク一覧をSQLiteに保持する"""
+
+    def __init__(self, path, max_age=600, sync_lease=120, retry_base=30, retry_max=3600):
+        self.db = LocalDatabase(path)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.connect().executescript(
+                "DROP TABLE IF EXISTS tasks; DROP TABLE IF EXISTS task_assignees;"
+                " DROP TABLE IF EXISTS task_tasklists; DROP TABLE IF EXISTS task_owners;"
+                + SCHEMA + f"PRAGMA user_version = {SCHEMA_VERSION};"
+            )
+        self.max_age = max_age
+        self.sync_lease = sync_lease  # バックグラウンド同期を1つのワーカーに任せる秒数
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(['queries', 'upstream_syncs', 'sync_failures', 'tasks_written', 'tasks_deleted'], 0)
+
+    def _incr(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    # ---- 同期 ----
+
+    def known_versions(self, owner):
+        """取り込み済みのタスク: guid -> updated_at（削除済みを除く）"""
+        rows = self.db.execute("SELECT guid, updated_at FROM tasks WHERE owner = ? AND deleted = 0", (owner,)).fetchall()
+        return dict(rows)
+
+    def upsert(self, owner, items, known):
+        """
+        updated_at が known（known_versions の結果）より進んだタスク・新しいタスクだけを書き込む
+        known は書き込んだ分を更新する。戻り値: 書き込んだ件数
+        """
+        changed = [
+            item for item in items
+            if item.get('guid') and int(item.get('updated_at') or 0) > known.get(item['guid'], -1)
+        ]
+        if not changed:
+            return 0
+        with self.db.transaction() as conn:
+            for item in changed:
+                guid = item['guid']
+                conn.execute(
+                    "INSERT OR REPLACE INTO tasks (owner, guid, status, due_at, updated_at, seq, deleted, item)"
+                    f" VALUES (?, ?, ?, ?, ?, {NEXT_SEQ}, 0, ?)",
+                    (owner, guid, task_status(item), task_due_at(item), int(item.get('updated_at') or 0),
+                     owner, json.dumps(item, ensure_ascii=False))
+                )
+                conn.execute("DELETE FROM task_assignees WHERE owner = ? AND guid = ?", (owner, guid))
+                conn.execute("DELETE FROM task_tasklists WHERE owner = ? AND guid = ?", (owner, guid))
+                conn.executemany("INSERT INTO task_assignees (owner, assignee, guid) VALUES (?, ?, ?)",
+                                 [(owner, assignee, guid) for assignee in task_assignees(item)])
+                conn.executemany("INSERT INTO task_tasklists (owner, tasklist_guid, guid) VALUES (?, ?, ?)",
+                                 [(owner, tasklist, guid) for tasklist in task_tasklists(item)])
+                known[guid] = int(item.get('updated_at') or 0)
+        self._incr('tasks_written', len(changed))
+        return len(changed)
+
+    def mark_missing_deleted(self, owner, seen):
+        """全ページをたどった同期で見つからなかったタスクを削除済みにする。戻り値: 件数"""
+        missing = [guid for guid in self.known_versions(owner) if guid not in seen]
+        deleted_at = now_ms()
+        with self.db.transaction() as conn:
+            for guid in missing:
+                row = conn.execute("SELECT item FROM tasks WHERE owner = ? AND guid = ?", (owner, guid)).fetchone()
+                item = dict(json.loads(row[0]), deleted=True)
+                conn.execute(
+                    f"UPDATE tasks SET deleted = 1, updated_at = ?, seq = {NEXT_SEQ}, item = ? WHERE owner = ? AND guid = ?",
+                    (deleted_at, owner, json.dumps(item, ensure_ascii=False), owner, guid)
+                )
+                conn.execute("DELETE FROM task_assignees WHERE owner = ? AND guid = ?", (owner, guid))
+                conn.execute("DELETE FROM task_tasklists WHERE owner = ? AND guid = ?", (owner, guid))
+            conn.execute("DELETE FROM tasks WHERE owner = ? AND deleted = 1 AND updated_at < ?",
+                         (owner, deleted_at - TOMBSTONE_RETENTION * 1000))
+        self._incr('tasks_deleted', len(missing))
+        return len(missing)
+
+    def claim_sync(self, owner, min_ttl=0):
+        """
+        バックグラウンド同期を始めてよければ True
+        他のワーカーが同期中・再試行待ち・すでに同期済み（due(min_ttl) の対象外）なら False
+        再同期の要求（dirty）はここで消し、同期中に届いた通知は次の同期で反映する
+        """
+        now = time.time()
+        return self.db.execute(
+            "UPDATE task_owners SET sync_started_at = ?, dirty = 0"
+            " WHERE owner = ? AND sync_started_at < ? AND retry_at <= ? AND (dirty = 1 OR synced_at + ? < ?)",
+            (now, owner, now - self.sync_lease, now, self.max_age, now + min_ttl)
+        ).rowcount == 1
+
+    def mark_synced(self, owner):
+        """上流の全ページを取り込んだ"""
+        self._incr('upstream_syncs')
+        self.db.execute(
+            "INSERT INTO task_owners (owner, synced_at) VALUES (?, ?)"
+            " ON CONFLICT (owner) DO UPDATE SET synced_at = excluded.synced_at,"
+            " sync_started_at = 0, failures = 0, retry_at = 0",
+            (owner, time.time())
+        )
+
+    def record_failure(self, owner):
+        """同期に失敗したユーザーは指数バックオフでバックグラウンド同期の対象から外す"""
+        self._incr('sync_failures')
+        row = self.db.execute("SELECT failures FROM task_owners WHERE owner = ?", (owner,)).fetchone()
+        failures = (row[0] if row else 0) + 1
+        delay = min(self.retry_max, self.retry_base * (2 ** (failures - 1)))
+        self.db.execute(
+            "INSERT INTO task_owners (owner, failures, retry_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (owner) DO UPDATE SET failures = excluded.failures, retry_at = excluded.retry_at,"
+            " sync_started_at = 0",
+            (owner, failures, time.time() + delay)
+        )
+
+    def mark_dirty(self, owner=None):
+        """タスクの変更通知を受けた（owner 省略時は全ユーザー）。ミラーは引き続き返し、次の同期で取り直す"""
+        if owner is None:
+            self.db.execute("UPDATE task_owners SET dirty = 1")
+        else:
+            self.db.execute("UPDATE task_owners SET dirty = 1 WHERE owner = ?", (owner,))
+
+    def drop_owner(self, owner):
+        with self.db.transaction() as conn:
+            for table in ('tasks', 'task_assignees', 'task_tasklists', 'task_owners'):
+                conn.execute(f"DELETE FROM {table} WHERE owner = ?", (owner,))
+
+    def is_synced(self, owner):
+        row = self.db.execute("SELECT synced_at FROM task_owners WHERE owner = ?", (owner,)).fetchone()
+        return row is not None and row[0] + self.max_age > time.time()
+
+    def synced_at(self, owner):
+        row = self.db.execute("SELECT synced_at FROM task_owners WHERE owner = ?", (owner,)).fetchone()
+        return row[0] if row else 0
+
+    def next_expiry(self):
+        """再同期が必要になる最も早い時刻（変更通知を受けたユーザーがいれば現在時刻。対象がなければ None）"""
+        row = self.db.execute(
+            "SELECT MIN(CASE WHEN dirty THEN 0 ELSE synced_at + ? END) FROM task_owners"
+            " WHERE synced_at > 0 AND retry_at <= ?",
+            (self.max_age, time.time())
+        ).fetchone()
+        return None if row[0] is None else max(row[0], 0) or time.time()
+
+    def due(self, min_ttl):
+        """残りmin_ttl秒以内に再同期が必要なユーザー・変更通知を受けたユーザー（同期の古い順）"""
+        now = time.time()
+        rows = self.db.execute(
+            "SELECT owner FROM task_owners WHERE synced_at > 0 AND retry_at <= ?"
+            " AND (dirty = 1 OR synced_at + ? < ?) ORDER BY synced_at",
+            (now, self.max_age, now + min_ttl)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    # ---- 問い合わせ ----
+
+    def query(self, owner, status=None, due_after=None, due_before=None, assignee=None, tasklist=None,
+              updated_since=None, since=None, order='due', limit=100, offset=0):
+        """
+        条件に合うタスクを返す（時刻はミリ秒、due_after / due_before は両端を含む）
+        updated_since（更新時刻）・since（high_water の連番）を指定した場合だけ削除済みのタスクも返す
+        （since は変更順、updated_since は更新の古い順）
+        戻り値: (items, has_more, 次回の ?since= に渡す連番)
+        連番は since を指定した場合は最後に返したタスクの連番（なければ since）、それ以外は問い合わせる前の最新の連番
+        """
+        self._incr('queries')
+        high_water = since if since is not None else self.high_water(owner)
+        where = ["owner = ?"]
+        params = [owner]
+        order_sql = ORDERS[order]
+        if since is None and updated_since is None:
+            where.append("deleted = 0")
+        if updated_since is not None:
+            where.append("updated_at > ?")
+            params.append(updated_since)
+            order_sql = ORDERS['updated']
+        if since is not None:
+            where.append("seq > ?")
+            params.append(since)
+            order_sql = "seq"
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        if due_after is not None:
+            where.append("due_at >= ?")
+            params.append(due_after)
+        if due_before is not None:
+            where.append("due_at <= ?")
+            params.append(due_before)
+        if assignee is not None:
+            where.append("guid IN (SELECT guid FROM task_assignees WHERE owner = ? AND assignee = ?)")
+            params += [owner, assignee]
+        if tasklist is not None:
+            where.append("guid IN (SELECT guid FROM task_tasklists WHERE owner = ? AND tasklist_guid = ?)")
+            params += [owner, tasklist]
+        rows = self.db.execute(
+            f"SELECT seq, item FROM tasks WHERE {' AND '.join(where)} ORDER BY {order_sql} LIMIT ? OFFSET ?",
+            params + [limit + 1, offset]
+        ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if since is not None and rows:
+            high_water = rows[-1][0]
+        return [json.loads(row[1]) for row in rows], has_more, high_water
+
+    def high_water(self, owner):
+        """このユーザーの最新の連番（この時点より後に書き込み・削除されたタスクは、これより大きい連番を持つ）"""
+        return self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM tasks WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['tasks'] = self.db.execute("SELECT COUNT(*) FROM tasks WHERE deleted = 0").fetchone()[0]
+        stats['owners'] = self.db.execute("SELECT COUNT(*) FROM task_owners WHERE synced_at > 0").fetchone()[0]
+        stats['max_age'] = self.max_age
+        return stats
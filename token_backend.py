@@ -0,0 +1,507 @@
+"""
+トークンストアのバックエンド
+- memory: プロセス内の辞書（従来の動作、ワーカー間で共有されない）
+- sqlite: ローカルSQLite（WALモード）+ fcntlによるプロセス間ロック
+- redis : Redis互換クライアント（SET NX PXによる分散ロック）
+
+StoreDict を使うと、従来の dict と同じ書き方（store['key'] / store.get('key')）で
+どのバックエンドでも読み書きできる。
+StoreIndex はキー → スコア（数値）の索引で、スコアの小さい順に必要な分だけ読める
+（SQLiteはスコアの索引つきテーブル、Redisはソート済みセット）。
+"""
+
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+
+from localdb import LocalDatabase
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class LockTimeout(Exception):
+    """プロセス間ロックを期限内に取得できなかった"""
+
+
+_MISSING = object()
+
+
+# ========================================
+# メモリバックエンド
+# ========================================
+
+class MemoryBackend:
+    """プロセス内の辞書に保持（再起動で消える・ワーカー間で共有されない）"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._data = {}
+        self._data_lock = threading.Lock()
+        self._locks = {}
+        self._indexes = {}  # namespace -> (キー -> スコア, スコア順の [(スコア, キー)])
+
+    def get(self, namespace, key, default=None):
+        with self._data_lock:
+            return self._data.get(namespace, {}).get(key, default)
+
+    def get_all(self, namespace):
+        with self._data_lock:
+            return dict(self._data.get(namespace, {}))
+
+    def set_many(self, namespace, mapping):
+        with self._data_lock:
+            self._data.setdefault(namespace, {}).update(mapping)
+
+    def delete(self, namespace, key):
+        with self._data_lock:
+            self._data.get(namespace, {}).pop(key, None)
+
+    def delete_many(self, namespace, keys):
+        with self._data_lock:
+            data = self._data.get(namespace, {})
+            for key in keys:
+                data.pop(key, None)
+
+    def pop(self, namespace, key, default=None):
+        with self._data_lock:
+            return self._data.get(namespace, {}).pop(key, default)
+
+    def index_set(self, namespace, mapping):
+        with self._data_lock:
+            scores, ordered = self._indexes.setdefault(namespace, ({}, []))
+            for key, score in mapping.items():
+                if key in scores:
+                    ordered.remove((scores[key], key))
+                scores[key] = score
+                bisect.insort(ordered, (score, key))
+
+    def index_delete(self, namespace, keys):
+        with self._data_lock:
+            scores, ordered = self._indexes.get(namespace, ({}, []))
+            for key in keys:
+                if key in scores:
+                    ordered.remove((scores.pop(key), key))
+
+    def index_range(self, namespace, max_score=None, limit=None):
+        with self._data_lock:
+            ordered = self._indexes.get(namespace, ({}, []))[1]
+            end = len(ordered) if max_score is None else bisect.bisect_right(ordered, (max_score, '\U0010ffff'))
+            if limit is not None:
+                end = min(end, limit)
+            return [(key, score) for score, key in ordered[:end]]
+
+    @contextmanager
+    def lock(self, name, timeout=None):
+        with self._data_lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        if not lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise LockTimeout(name)
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+# ========================================
+# SQLiteバックエンド
+# ========================================
+
+class SQLiteBackend:
+    """
+    SQLite（WAL）に保持し、fcntl.flock でプロセス間ロックを取る
+    同一ホスト上の複数gunicornワーカーで共有でき、再起動後も残る
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_locks = {}
+        self._thread_locks_guard = threading.Lock()
+        self.db = LocalDatabase(path, (
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, key));"
+            "CREATE TABLE IF NOT EXISTS kv_index ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " score REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key));"
+            "CREATE INDEX IF NOT EXISTS kv_index_score ON kv_index (namespace, score);"
+        ))
+
+    def get(self, namespace, key, default=None):
+        row = self.db.execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_all(self, namespace):
+        rows = self.db.execute(
+            "SELECT key, value FROM kv WHERE namespace = ?", (namespace,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_many(self, namespace, mapping):
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?)"
+                " ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                [(namespace, key, json.dumps(value)) for key, value in mapping.items()]
+            )
+
+    def delete(self, namespace, key):
+        self.db.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def delete_many(self, namespace, keys):
+        with self.db.transaction() as conn:
+            conn.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", [(namespace, key) for key in keys])
+
+    def pop(self, namespace, key, default=None):
+        # 読み取りと削除を1トランザクションで行い、同時に取り出せるのは1つの呼び出し元だけにする
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        return json.loads(row[0]) if row else default
+
+    def index_set(self, namespace, mapping):
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO kv_index (namespace, key, score) VALUES (?, ?, ?)"
+                " ON CONFLICT (namespace, key) DO UPDATE SET score = excluded.score",
+                [(namespace, key, score) for key, score in mapping.items()]
+            )
+
+    def index_delete(self, namespace, keys):
+        with self.db.transaction() as conn:
+            conn.executemany("DELETE FROM kv_index WHERE namespace = ? AND key = ?", [(namespace, key) for key in keys])
+
+    def index_range(self, namespace, max_score=None, limit=None):
+        sql, params = "SELECT key, score FROM kv_index WHERE namespace = ?", [namespace]
+        if max_score is not None:
+            sql += " AND score <= ?"
+            params.append(max_score)
+        rows = self.db.execute(
+            sql + " ORDER BY score, key LIMIT ?", params + [-1 if limit is None else limit]
+        ).fetchall()
+        return [(key, score) for key, score in rows]
+
+    @contextmanager
+    def lock(self, name, timeout=None):
+        # プロセス内はthreading.Lock、プロセス間はロックファイルのflockで排他
+        with self._thread_locks_guard:
+            thread_lock = self._thread_locks.setdefault(name, threading.Lock())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise LockTimeout(name)
+        try:
+            if fcntl is None:
+                yield
+                return
+            safe_name = ''.join(c if c.isalnum() else '_' for c in name)
+            with open(f"{self.path}.{safe_name}.lock", 'a') as f:
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if deadline is not None and time.monotonic() >= deadline:
+                            raise LockTimeout(name)
+                        time.sleep(0.05)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            thread_lock.release()
+
+
+# ========================================
+# Redisバックエンド
+# ========================================
+
+class RedisBackend:
+    """
+    Redis互換クライアントに保持（ネームスペースごとにハッシュ1つ、索引はソート済みセット1つ）
+    使用するメソッド: hget / hgetall / hset(mapping=) / hdel / set(nx, px) / get / delete / zadd / zrem / zrangebyscore
+    """
+
+    name = 'redis'
+
+    def __init__(self, client, prefix='lark-oauth:', lock_ttl=60):
+        self.client = client
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+
+    def _key(self, namespace):
+        return f"{self.prefix}{namespace}"
+
+    def get(self, namespace, key, default=None):
+        value = self.client.hget(self._key(namespace), key)
+        return json.loads(value) if value is not None else default
+
+    def get_all(self, namespace):
+        return {
+            (k.decode() if isinstance(k, bytes) else k): json.loads(v)
+            for k, v in self.client.hgetall(self._key(namespace)).items()
+        }
+
+    def set_many(self, namespace, mapping):
+        if mapping:
+            self.client.hset(self._key(namespace), mapping={k: json.dumps(v) for k, v in mapping.items()})
+
+    def delete(self, namespace, key):
+        self.client.hdel(self._key(namespace), key)
+
+    def delete_many(self, namespace, keys):
+        if keys:
+            self.client.hdel(self._key(namespace), *keys)
+
+    def pop(self, namespace, key, default=None):
+        # 同時に取り出した場合は hdel で実際に削除できた呼び出し元だけが値を受け取る
+        value = self.client.hget(self._key(namespace), key)
+        if value is None or not self.client.hdel(self._key(namespace), key):
+            return default
+        return json.loads(value)
+
+    def index_set(self, namespace, mapping):
+        if mapping:
+            self.client.zadd(f"{self.prefix}index:{namespace}", mapping)
+
+    def index_delete(self, namespace, keys):
+        if keys:
+            self.client.zrem(f"{self.prefix}index:{namespace}", *keys)
+
+    def index_range(self, namespace, max_score=None, limit=None):
+        rows = self.client.zrangebyscore(
+            f"{self.prefix}index:{namespace}", '-inf', '+inf' if max_score is None else max_score,
+            start=None if limit is None else 0, num=limit, withscores=True
+        )
+        return [(key.decode() if isinstance(key, bytes) else key, score) for key, score in rows]
+
+    @contextmanager
+    def lock(self, name, timeout=None):
+        # ロックが残り続けないよう lock_ttl 秒で自動解放される
+        lock_key = f"{self.prefix}lock:{name}"
+        owner = uuid.uuid4().hex
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.client.set(lock_key, owner, nx=True, px=int(self.lock_ttl * 1000)):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise LockTimeout(name)
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            current = self.client.get(lock_key)
+            if current is not None and (current.decode() if isinstance(current, bytes) else current) == owner:
+                self.client.delete(lock_key)
+
+
+class FakeRedis:
+    """RedisBackend が使うメソッドだけを実装したインメモリのRedis互換クライアント（ローカル検証用）"""
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data[key] if self._alive(key) else None
+
+    def set(self, key, value, nx=False, px=None):
+        with self._lock:
+            if nx and self._alive(key):
+                return None
+            self._data[key] = value
+            if px is not None:
+                self._expires[key] = time.monotonic() + px / 1000
+            else:
+                self._expires.pop(key, None)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = 0
+            for key in keys:
+                if self._alive(key):
+                    removed += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+
+    def hget(self, name, key):
+        with self._lock:
+            return self._data.get(name, {}).get(key) if self._alive(name) else None
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._data.get(name, {})) if self._alive(name) else {}
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self._lock:
+            if not self._alive(name):
+                self._data[name] = {}
+            items = dict(mapping or {})
+            if key is not None:
+                items[key] = value
+            self._data[name].update(items)
+            return len(items)
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            if not self._alive(name):
+                return 0
+            return sum(1 for key in keys if self._data[name].pop(key, _MISSING) is not _MISSING)
+
+    def zadd(self, name, mapping):
+        return self.hset(name, mapping={key: float(score) for key, score in mapping.items()})
+
+    def zrem(self, name, *keys):
+        return self.hdel(name, *keys)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False):
+        with self._lock:
+            members = self._data.get(name, {}) if self._alive(name) else {}
+            low, high = float(min), float(max)
+            rows = sorted((score, key) for key, score in members.items() if low <= score <= high)
+        if start is not None:
+            rows = rows[start:start + num]
+        return [(key, score) if withscores else key for score, key in rows]
+
+
+# ========================================
+# dict互換ビュー
+# ========================================
+
+class StoreDict(MutableMapping):
+    """バックエンドの1ネームスペースを dict として扱うビュー"""
+
+    def __init__(self, backend, namespace, defaults=None):
+        self.backend = backend
+        self.namespace = namespace
+        self.defaults = dict(defaults or {})
+
+    def __getitem__(self, key):
+        value = self.backend.get(self.namespace, key, _MISSING)
+        if value is _MISSING:
+            if key in self.defaults:
+                return self.defaults[key]
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.backend.get(self.namespace, key, _MISSING)
+        if value is _MISSING:
+            return self.defaults.get(key, default)
+        return value
+
+    def __setitem__(self, key, value):
+        self.backend.set_many(self.namespace, {key: value})
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.backend.delete(self.namespace, key)
+
+    def __contains__(self, key):
+        return key in self.defaults or self.backend.get(self.namespace, key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def pop(self, key, default=_MISSING):
+        """取り出して削除（他のワーカーと同時に呼んでも値を受け取るのは1つだけ）"""
+        value = self.backend.pop(self.namespace, key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    def delete_many(self, keys):
+        self.backend.delete_many(self.namespace, list(keys))
+
+    def update(self, *args, **kwargs):
+        """複数キーを1回の書き込みで更新（SQLiteでは1トランザクション）"""
+        self.backend.set_many(self.namespace, dict(*args, **kwargs))
+
+    def snapshot(self):
+        """デフォルト値を含めた現在の内容を dict で返す"""
+        data = dict(self.defaults)
+        data.update(self.backend.get_all(self.namespace))
+        return data
+
+    def lock(self, name, timeout=None):
+        return self.backend.lock(f"{self.namespace}:{name}", timeout=timeout)
+
+
+class StoreIndex:
+    """バックエンドの1ネームスペースの索引（キー → スコア）。スコアの小さい順に読める"""
+
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+
+    def set(self, key, score):
+        self.backend.index_set(self.namespace, {key: score})
+
+    def update(self, mapping):
+        """複数キーを1回の書き込みで登録（SQLiteでは1トランザクション）"""
+        self.backend.index_set(self.namespace, dict(mapping))
+
+    def discard(self, key):
+        self.backend.index_delete(self.namespace, [key])
+
+    def discard_many(self, keys):
+        self.backend.index_delete(self.namespace, list(keys))
+
+    def range(self, max_score=None, limit=None):
+        """スコアが max_score 以下のキーをスコアの小さい順に [(キー, スコア)] で返す（最大 limit 件）"""
+        return self.backend.index_range(self.namespace, max_score, limit)
+
+
+def create_backend_from_env():
+    """環境変数 TOKEN_STORE_BACKEND からバックエンドを生成"""
+    kind = os.environ.get('TOKEN_STORE_BACKEND', 'memory').lower()
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(os.environ.get('TOKEN_STORE_PATH', 'data/tokens.db'))
+    if kind == 'redis':
+        prefix = os.environ.get('TOKEN_STORE_PREFIX', 'lark-oauth:')
+        redis_url = os.environ.get('REDIS_URL', '')
+        if redis_url == 'fake://':
+            return RedisBackend(FakeRedis(), prefix=prefix)
+        if not redis_url:
+            raise RuntimeError("TOKEN_STORE_BACKEND=redis には REDIS_URL が必要です")
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("TOKEN_STORE_BACKEND=redis には redis パッケージが必要です（pip install redis）")
+        return RedisBackend(redis.Redis.from_url(redis_url), prefix=prefix)
+    raise RuntimeError(f"不明な TOKEN_STORE_BACKEND: {kind}")
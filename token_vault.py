@@ -0,0 +1,247 @@
+"""
+複数ユーザーのトークン保管庫
+- ユーザー（Larkの open_id）ごとに Access Token / Refresh Token を保持し、ユーザーごとのAPIキーで引く
+- 保存先は store_backend（全ワーカーで共有）。ワーカー内では open_id → UserToken の辞書で引き、
+  Access Tokenが有効な間は共有ストアを読まない
+- APIキーはハッシュだけを保存する（ハッシュ → open_id の索引で O(1) に引く）
+- 更新のプロセス間ロックは open_id のハッシュで固定数にまとめる（ユーザー数だけロックを作らない）
+- バックグラウンド更新の対象は Access Token の有効期限の索引から期限の近いユーザーだけを読む（全ユーザーを読まない）
+"""
+
+import time
+import zlib
+import hashlib
+import secrets
+import threading
+from datetime import datetime
+
+from token_backend import StoreDict, StoreIndex
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class UserToken:
+    """1ユーザー分のトークン（数千人分をワーカーごとに保持するため __slots__ で小さくする）"""
+
+    __slots__ = ('open_id', 'name', 'access_token', 'refresh_token', 'expires_at',
+                 'refresh_expires_at', 'updated_at', 'api_key_hash')
+
+    def __init__(self, open_id, name='', access_token='', refresh_token='', expires_at=0.0,
+                 refresh_expires_at=0.0, updated_at=0.0, api_key_hash=''):
+        self.open_id = open_id
+        self.name = name
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.refresh_expires_at = refresh_expires_at  # 0 は不明（期限切れとして扱わない）
+        self.updated_at = updated_at
+        self.api_key_hash = api_key_hash
+
+    def to_record(self):
+        """共有ストアに保存する形（キー名を繰り返さない配列）"""
+        return [self.name, self.access_token, self.refresh_token, self.expires_at,
+                self.refresh_expires_at, self.updated_at, self.api_key_hash]
+
+    @classmethod
+    def from_record(cls, open_id, record):
+        return cls(open_id, *record)
+
+    def is_fresh(self, min_ttl, now=None):
+        """Access Tokenが残りmin_ttl秒以上有効か"""
+        return bool(self.access_token) and self.expires_at > (now or time.time()) + min_ttl
+
+    def can_refresh(self, now=None):
+        return bool(self.refresh_token) and (
+            not self.refresh_expires_at or self.refresh_expires_at > (now or time.time())
+        )
+
+    def expiry_score(self):
+        """有効期限の索引に載せる値（Access Tokenがなければすぐに更新の対象にする）"""
+        return self.expires_at if self.access_token else 0.0
+
+    def public(self):
+        """API・画面に出す情報（トークンそのものは含めない）"""
+        return {
+            'open_id': self.open_id,
+            'name': self.name,
+            'authenticated': self.can_refresh(),
+            'expires_at': self.expires_at,
+            'refresh_expires_at': self.refresh_expires_at or None,
+            'updated_at': datetime.fromtimestamp(self.updated_at).isoformat() if self.updated_at else ''
+        }
+
+
+class TokenVault:
+    """open_id ごとのトークンを共有ストアに保持し、ワーカー内で索引する"""
+
+    def __init__(self, backend, lock=None, lock_stripes=64, api_key_cache_ttl=30.0,
+                 retry_base=30.0, retry_max=3600.0):
+        self.tokens = StoreDict(backend, 'user_tokens')  # open_id -> UserToken.to_record()
+        self.api_keys = StoreDict(backend, 'user_api_keys')  # hash_api_key(APIキー) -> open_id
+        self.meta = StoreDict(backend, 'user_vault')  # default_open_id
+        self.expiry = StoreIndex(backend, 'user_token_expiry')  # 更新できるユーザーの open_id -> Access Tokenの有効期限
+        self.lock_stripes = lock_stripes
+        self.api_key_cache_ttl = api_key_cache_ttl  # 失効したAPIキーが他のワーカーで使えてしまう最大秒数
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = lock or threading.Lock()
+        self._tokens = {}  # open_id -> UserToken
+        self._api_keys = {}  # APIキーのハッシュ -> (open_id, 確認した時刻)
+        self._failures = {}  # open_id -> (連続失敗回数, 次に再試行する時刻)
+        if not self.meta.get('expiry_index'):
+            # 索引がなかった頃の保存内容から一度だけ作る
+            self.expiry.update({token.open_id: token.expiry_score() for token in self.users() if token.can_refresh()})
+            self.meta['expiry_index'] = 1
+
+    # ---- 読み書き ----
+
+    def get(self, open_id, min_ttl=0):
+        """
+        ユーザーのトークンを返す（なければ None）
+        ワーカー内の値が残りmin_ttl秒以上有効ならそれを返し、そうでなければ共有ストアから読み直す
+        """
+        with self._lock:
+            token = self._tokens.get(open_id)
+            if token is not None and token.is_fresh(min_ttl):
+                return token
+        return self.load(open_id)
+
+    def load(self, open_id):
+        """共有ストアから読み直す（他のワーカーの更新を反映）"""
+        record = self.tokens.get(open_id)
+        with self._lock:
+            if record is None:
+                self._tokens.pop(open_id, None)
+                return None
+            token = self._tokens[open_id] = UserToken.from_record(open_id, record)
+            return token
+
+    def save(self, token):
+        token.updated_at = time.time()
+        self.tokens[token.open_id] = token.to_record()
+        if token.can_refresh():
+            self.expiry.set(token.open_id, token.expiry_score())
+        else:
+            self.expiry.discard(token.open_id)
+        with self._lock:
+            self._tokens[token.open_id] = token
+            self._failures.pop(token.open_id, None)
+
+    def delete(self, open_id):
+        token = self.load(open_id)
+        if token is None:
+            return False
+        if token.api_key_hash:
+            self.api_keys.pop(token.api_key_hash, None)
+        self.tokens.pop(open_id, None)
+        self.expiry.discard(open_id)
+        with self._lock:
+            self._tokens.pop(open_id, None)
+            self._api_keys = {k: v for k, v in self._api_keys.items() if v[0] != open_id}
+        if self.default_open_id == open_id:
+            self.meta.pop('default_open_id', None)
+        return True
+
+    def lock(self, open_id, timeout=None):
+        """ユーザーごとの更新用プロセス間ロック（lock_stripes 個にまとめる）"""
+        stripe = zlib.crc32(open_id.encode()) % self.lock_stripes
+        return self.tokens.lock(f'refresh:{stripe}', timeout=timeout)
+
+    def users(self):
+        """全ユーザー（共有ストアの内容。全件を読むため、ユーザー一覧の表示などに使う）"""
+        return [UserToken.from_record(open_id, record) for open_id, record in self.tokens.snapshot().items()]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    # ---- 既定ユーザー（共通の API_KEY で操作するユーザー） ----
+
+    @property
+    def default_open_id(self):
+        return self.meta.get('default_open_id')
+
+    @default_open_id.setter
+    def default_open_id(self, open_id):
+        self.meta['default_open_id'] = open_id
+
+    # ---- APIキー ----
+
+    def issue_api_key(self, open_id):
+        """新しいAPIキーを発行して返す（以前のキーは無効になる）"""
+        token = self.load(open_id)
+        if token is None:
+            raise KeyError(open_id)
+        api_key = 'lk_' + secrets.token_urlsafe(32)
+        old_hash = token.api_key_hash
+        token.api_key_hash = hash_api_key(api_key)
+        self.api_keys[token.api_key_hash] = open_id
+        self.save(token)
+        if old_hash:
+            self.api_keys.pop(old_hash, None)
+            with self._lock:
+                self._api_keys.pop(old_hash, None)
+        return api_key
+
+    def resolve_api_key(self, api_key):
+        """APIキーに対応する open_id（なければ None）"""
+        key_hash = hash_api_key(api_key)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._api_keys.get(key_hash)
+            if cached is not None and now - cached[1] < self.api_key_cache_ttl:
+                return cached[0]
+        open_id = self.api_keys.get(key_hash)
+        with self._lock:
+            if open_id is None:
+                self._api_keys.pop(key_hash, None)
+            else:
+                self._api_keys[key_hash] = (open_id, now)
+        return open_id
+
+    # ---- バックグラウンド更新 ----
+
+    def record_failure(self, open_id):
+        """更新に失敗したユーザーを指数バックオフで対象から外す（このワーカー内）"""
+        with self._lock:
+            failures = self._failures.get(open_id, (0, 0.0))[0] + 1
+            delay = min(self.retry_max, self.retry_base * (2 ** (failures - 1)))
+            self._failures[open_id] = (failures, time.time() + delay)
+
+    def _backoff(self, now):
+        with self._lock:
+            return {open_id for open_id, (_, retry_at) in self._failures.items() if retry_at > now}
+
+    def next_expiry(self):
+        """更新対象のうち最も早い有効期限（対象がなければ None）"""
+        backoff = self._backoff(time.time())
+        for open_id, expires_at in self.expiry.range(limit=len(backoff) + 1):
+            if open_id not in backoff:
+                return expires_at
+        return None
+
+    def due(self, min_ttl):
+        """
+        残り有効期間がmin_ttl秒未満で更新できるユーザーの open_id（期限の早い順）
+        索引で期限の近いユーザーだけを読み、Refresh Tokenが失効・削除済みのユーザーは索引から外す
+        （保存内容と索引の期限が食い違っていれば保存内容に合わせる）
+        """
+        now = time.time()
+        backoff = self._backoff(now)
+        due, stale, repaired = [], [], {}
+        for open_id, _ in self.expiry.range(max_score=now + min_ttl):
+            if open_id in backoff:
+                continue
+            token = self.load(open_id)
+            if token is None or not token.can_refresh(now):
+                stale.append(open_id)
+            elif token.is_fresh(min_ttl, now):
+                repaired[open_id] = token.expiry_score()
+            else:
+                due.append(open_id)
+        if stale:
+            self.expiry.discard_many(stale)
+        if repaired:
+            self.expiry.update(repaired)
+        return due
@@ -0,0 +1,290 @@
+"""
+Lark API呼び出し用の共通HTTPクライアント
+- ワーカー（プロセス）ごとにkeep-aliveのコネクションプールを共有
+- 接続・読み取りタイムアウトと、リクエスト全体の期限（deadline）を適用
+- プールの再利用率などの統計を記録
+"""
+
+import os
+import re
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from ratelimit import RATE_LIMIT_CODES, RateLimitExceeded, api_family
+
+
+# プロキシで中継しないヘッダー（hop-by-hop）
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'
+])
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_API_VERSION = re.compile(r'^v\d+$')
+
+
+class UpstreamDeadlineExceeded(requests.exceptions.Timeout):
+    """リクエスト全体の期限を超えた"""
+
+
+class RequestBodyStream:
+    """
+    長さの分かっているリクエスト本文を、メモリに読み込まずに上流へ渡すためのラッパー
+    （requestsは __len__ でContent-Lengthを決め、read() で少しずつ送信する）
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def relay_headers(response, exclude=()):
+    """上流レスポンスのヘッダーから中継するものを取り出す"""
+    return [
+        (name, value) for name, value in response.headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in exclude
+    ]
+
+
+def metric_endpoint(url):
+    """メトリクスのラベル用のAPIの種類（Lark形式 xxx/v1/yyy 以外のパスはIDで種類が増えないよう末尾をまとめる）"""
+    family = api_family(url)
+    parts = family.split('/')
+    if len(parts) == 3 and not _API_VERSION.match(parts[1]):
+        return f'{parts[0]}/{parts[1]}/*'
+    return family
+
+
+def iter_raw(response):
+    """上流レスポンスの本文を解凍・デコードせずにチャンクで返し、最後に接続をプールへ戻す"""
+    try:
+        for chunk in response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+            yield chunk
+    finally:
+        response.close()
+
+
+class _Stats:
+    """スレッドセーフなカウンタ"""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(names, 0)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+def _counting_pool_classes(stats):
+    """新規接続（TCP+TLSハンドシェイク）の回数を数えるプールクラスを作る"""
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        def _new_conn(self):
+            stats.incr('new_connections')
+            return super()._new_conn()
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            stats.incr('new_connections')
+            return super()._new_conn()
+
+    return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(self._stats)
+
+
+class UpstreamClient:
+    """Lark APIへのHTTP呼び出しをまとめるクライアント"""
+
+    def __init__(self, pool_size=20, connect_timeout=5.0, read_timeout=30.0, deadline=60.0,
+                 rate_limiter=None, max_rate_limit_retries=2, metrics=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.rate_limiter = rate_limiter  # TokenBucketLimiter（credential指定の呼び出しに適用）
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.metrics = metrics  # Metrics（APIの種類ごとの所要時間を記録）
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+        self._stats = _Stats('requests', 'new_connections', 'errors', 'timeouts')
+        self._in_flight = 0
+        self._peak_in_flight = 0
+
+    @classmethod
+    def from_env(cls, rate_limiter=None, metrics=None):
+        return cls(
+            pool_size=int(os.environ.get('UPSTREAM_POOL_SIZE', '20')),
+            connect_timeout=float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.environ.get('UPSTREAM_READ_TIMEOUT', '30')),
+            deadline=float(os.environ.get('UPSTREAM_DEADLINE', '60')),
+            rate_limiter=rate_limiter,
+            metrics=metrics,
+        )
+
+    @property
+    def session(self):
+        """プロセスごとのSession（fork後は作り直す）"""
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._session_lock:
+                if self._session is None or self._session_pid != pid:
+                    session = requests.Session()
+                    adapter = _CountingAdapter(
+                        self._stats,
+                        pool_connections=4,
+                        pool_maxsize=self.pool_size,
+                        pool_block=False
+                    )
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._session_pid = pid
+        return self._session
+
+    def request(self, method, url, deadline=None, stream=False, credential=None, **kwargs):
+        """
+        HTTPリクエストを送信
+        deadline: リクエスト全体（接続〜本文の読み取り完了）の期限（秒）。省略時は既定値
+        stream=True の場合、本文の読み取りは呼び出し側で行う（deadlineは接続〜ヘッダー受信まで）
+        credential: 'user' / 'tenant' を指定するとレート制限を適用し、上流で制限された場合は待って再送する
+        """
+        deadline = self.deadline if deadline is None else deadline
+        limiter = self.rate_limiter if credential else None
+        if limiter is None:
+            return self._send(method, url, deadline, stream, **kwargs)
+        
+        family = api_family(url)
+        started = time.monotonic()
+        # 本文をストリームで送る場合は再送できない
+        retryable = not hasattr(kwargs.get('data'), 'read')
+        attempt = 0
+        while True:
+            remaining = deadline - (time.monotonic() - started)
+            limiter.acquire(family, credential, max_wait=max(0.0, min(limiter.max_wait, remaining)))
+            response = self._send(method, url, max(0.1, deadline - (time.monotonic() - started)), stream, **kwargs)
+            limited, reset_after, limit = self._rate_limit_signal(response, stream)
+            if not limited:
+                if response.status_code < 400:
+                    limiter.on_success(family, credential)
+                return response
+            limiter.on_limited(family, credential, reset_after=reset_after, limit=limit)
+            wait = reset_after or 1.0
+            if retryable and attempt < self.max_rate_limit_retries and \
+                    time.monotonic() - started + wait < deadline:
+                attempt += 1
+                response.close()
+                continue
+            if stream:
+                # プロキシはそのまま429を中継する
+                return response
+            raise RateLimitExceeded(f"{method} {family}: Larkのレート制限に達しました", wait)
+
+    @staticmethod
+    def _rate_limit_signal(response, stream):
+        """上流の頻度制限を検出: (制限されたか, 解除までの秒数, 上限値)"""
+        reset_after = response.headers.get('x-ogw-ratelimit-reset')
+        limit = response.headers.get('x-ogw-ratelimit-limit')
+        reset_after = float(reset_after) if reset_after and reset_after.replace('.', '', 1).isdigit() else None
+        limit = float(limit) if limit and limit.replace('.', '', 1).isdigit() else None
+        limited = response.status_code == 429
+        if not limited and not stream and response.status_code in (200, 400):
+            try:
+                limited = response.json().get('code') in RATE_LIMIT_CODES
+            except (ValueError, AttributeError):
+                limited = False
+        return limited, reset_after, limit
+
+    def _send(self, method, url, deadline, stream, **kwargs):
+        """1回分の送信（統計・期限の確認を含む）"""
+        started = time.monotonic()
+        kwargs.setdefault('timeout', (self.connect_timeout, min(self.read_timeout, deadline)))
+        self._stats.incr('requests')
+        with self._session_lock:
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        status = 'error'
+        try:
+            response = self.session.request(method, url, stream=True, **kwargs)
+            status = response.status_code
+            if not stream:
+                # 読み取りタイムアウトは1回のreadごとなので、全体の期限はここで確認する
+                chunks = []
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    chunks.append(chunk)
+                    if time.monotonic() - started > deadline:
+                        response.close()
+                        raise UpstreamDeadlineExceeded(f"{method} {url}: {deadline}秒の期限を超えました")
+                response._content = b''.join(chunks)
+            return response
+        except requests.exceptions.Timeout:
+            status = 'timeout'
+            self._stats.incr('timeouts')
+            raise
+        except Exception:
+            status = 'error'
+            self._stats.incr('errors')
+            raise
+        finally:
+            with self._session_lock:
+                self._in_flight -= 1
+            if self.metrics is not None:
+                # stream=True の場合はヘッダー受信までの時間
+                family = metric_endpoint(url)
+                self.metrics.observe('lark_oauth_upstream_request_duration_seconds',
+                                     time.monotonic() - started, endpoint=family, method=method)
+                self.metrics.inc('lark_oauth_upstream_requests_total', endpoint=family, method=method, status=status)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """プールの利用統計"""
+        stats = self._stats.snapshot()
+        reused = max(stats['requests'] - stats['new_connections'], 0)
+        stats['reused_connections'] = reused
+        stats['pool_hit_ratio'] = round(reused / stats['requests'], 4) if stats['requests'] else 0.0
+        stats['in_flight'] = self._in_flight
+        stats['peak_in_flight'] = self._peak_in_flight
+        stats['pool_size'] = self.pool_size
+        stats['connect_timeout'] = self.connect_timeout
+        stats['read_timeout'] = self.read_timeout
+        stats['deadline'] = self.deadline
+        if self.rate_limiter is not None:
+            stats['rate_limit'] = self.rate_limiter.stats()
+        return stats